@@ -1,15 +1,25 @@
 import datetime
 import os
-import cv2
-import numpy as np
 from flask import Flask, render_template, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 from flask_mysqldb import MySQL
 import threading
 import time
-import base64
+import atexit
 
-from python_project.vehicle_detections_system import VehicleDetectionSystem
+# Các module trong python_project import lẫn nhau theo tên phẳng (`from sort import Sort`), nên app cũng vậy:
+# mỗi module (và singleton metrics / model_registry) chỉ được nạp 1 lần
+from vehicle_detections_system import VehicleDetectionSystem
+from metrics import metrics
+from model_registry import registry as model_registry
+from video_pipeline import VideoPipeline
+from video_source import DECODERS
+from stream_manager import StreamManager
+from qos_controller import QoSController
+from frame_broadcaster import FrameBroadcaster, MJPEG_BOUNDARY
+from statistics_channel import StatisticsChannel
+from event_log import CrossingEventLog
+from statistics_queries import StatisticsCache, parse_date_range, query_statistics
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
@@ -21,11 +31,54 @@ app.config['MYSQL_PASSWORD'] = 'Truongkhi19'
 app.config['MYSQL_DB'] = 'datn'
 mysql = MySQL(app)
 
-# Khởi tạo hệ thống detection
-vehicle_detector = VehicleDetectionSystem()
+# Ghi từng lần xe qua line vào DB theo lô (thread riêng, connection pool, spool khi DB lỗi)
+event_log = CrossingEventLog({
+    'host': app.config['MYSQL_HOST'],
+    'user': app.config['MYSQL_USER'],
+    'password': app.config['MYSQL_PASSWORD'],
+    'database': app.config['MYSQL_DB'],
+})
+atexit.register(event_log.stop)
+# Tạo bảng sự kiện / bảng gộp ngay khi khởi động (thread nền, không chặn nếu DB chậm)
+# để /api/get_daily_statistics truy vấn được trước khi có xe nào qua line
+threading.Thread(target=event_log.ensure_schema, daemon=True).start()
+metrics.gauge('vehicle_event_log_pending', 'Số sự kiện qua line đang chờ ghi DB',
+              fn=lambda: event_log.get_stats()['pending'])
+metrics.counter('vehicle_event_log_written_total', 'Số sự kiện qua line đã ghi DB', fn=lambda: event_log.written)
+metrics.counter('vehicle_event_log_spooled_total', 'Số sự kiện phải lưu tạm ra file khi DB lỗi',
+                fn=lambda: event_log.spooled)
+# Cache kết quả /api/get_daily_statistics, xoá mỗi khi có sự kiện mới được ghi vào DB
+statistics_cache = StatisticsCache()
+event_log.on_written.append(statistics_cache.invalidate)
+
+# Backend chạy model: torch (mặc định) hoặc onnx / openvino / openvino-int8 cho máy không có GPU
+app.config['DETECTOR_BACKEND'] = os.environ.get('DETECTOR_BACKEND', 'torch')
+
+# Khởi tạo hệ thống detection (model được load lười qua model_registry, không chặn lúc import)
+vehicle_detector = VehicleDetectionSystem(backend=app.config['DETECTOR_BACKEND'])
+# Chạy trực tiếp (python app_vehicle_detection.py, xem cuối file) là chế độ debug có reloader
+if __name__ == '__main__':
+    app.debug = True
+# Load + warm-up model ở thread nền ngay khi khởi động (cả khi chạy qua WSGI): server nhận request ngay,
+# lần bắt đầu nhận diện đầu tiên không phải chờ. Debug có reloader: chỉ process con (WERKZEUG_RUN_MAIN)
+# chạy server nên chỉ load ở đó.
+if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    model_registry.preload(vehicle_detector.backend, vehicle_detector.yolo_weights)
+# Giữ latency của các stream bật QoS (tham số qos / target_latency_ms) bằng cách hạ / nâng chất lượng detect
+qos_controller = QoSController()
+# Nhiều camera cùng lúc: mỗi stream có tracker/line/counts riêng, dùng chung model
+stream_manager = StreamManager(vehicle_detector, event_log=event_log, qos=qos_controller)
+# Frame đã vẽ của video đang xử lý: encode JPEG 1 lần, phát cho mọi người xem
+frame_broadcaster = FrameBroadcaster()
+# Đẩy số đếm tới trình duyệt (SSE) mỗi khi có xe qua line, thay cho polling
+statistics_channel = StatisticsChannel()
+vehicle_detector.add_crossing_listener(
+    lambda event: statistics_channel.publish(vehicle_detector.get_current_counts()))
+vehicle_detector.add_crossing_listener(lambda event: event_log.record(event, vehicle_detector.stream_id))
 current_video_path = None
 is_processing = False
 processing_thread = None
+current_pipeline = None
 
 # Biến lưu trữ thống kê
 vehicle_statistics = {
@@ -70,23 +123,80 @@ def start_detection():
     video_path = data.get('video_path', 'Videos/test4.mp4')
     line_start = data.get('line_start', [337, 391])
     line_end = data.get('line_end', [917, 387])
-    
-    current_video_path = video_path
+    # live_rate=True: phát frame đúng FPS của video (như camera), mặc định chạy nhanh nhất có thể
+    live_rate = bool(data.get('live_rate', False))
+    adaptive_detection = bool(data.get('adaptive_detection', False))
 
-    
-    # Thiết lập đường đếm
-    vehicle_detector.setup_counting_line(line_start, line_end)
+    # Kiểm tra toàn bộ tham số trước, chỉ đổi vehicle_detector (dùng chung) khi mọi thứ hợp lệ
+    try:
+        # Số frame gom lại cho 1 lần gọi YOLO (video offline nên dùng 4-16)
+        batch_size = max(1, int(data.get('batch_size', 1)))
+        # Chỉ chạy YOLO mỗi detect_interval frame, frame giữa dùng Kalman predict
+        detect_interval = max(1, int(data.get('detect_interval', 1)))
+        decode_options = parse_source(data)
+        qos_target = parse_qos(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'Tham số nguồn video không hợp lệ: {e}'})
+
+    # Đường đếm: nhiều line (theo làn / hướng) + vùng nếu có, không thì 1 line line_start-line_end
+    counting = parse_counting(data)
+    try:
+        lines = VehicleDetectionSystem.parse_lines(
+            counting['lines'] or [{'name': 'main', 'start': line_start, 'end': line_end}])
+        zones = VehicleDetectionSystem.parse_zones(counting['zones'] or [])
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'status': 'error', 'message': f'Line / vùng đếm không hợp lệ: {e}'})
+    # Chỉ detect trong vùng quanh đường đếm (nếu có cấu hình)
+    try:
+        roi_box, roi_polygon, roi_margin = VehicleDetectionSystem.parse_roi(**parse_roi(data))
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'ROI không hợp lệ: {e}'})
+
+    current_video_path = video_path
+    vehicle_detector.detect_interval = detect_interval
+    vehicle_detector.adaptive_detection = adaptive_detection
+    vehicle_detector.set_counting_lines(lines)
+    vehicle_detector.set_zones(zones)
+    vehicle_detector.set_roi(box=roi_box, polygon=roi_polygon, margin=roi_margin)
     
     # Bắt đầu xử lý trong thread riêng
     is_processing = True
     processing_thread = threading.Thread(
         target=process_video_thread,
-        args=(video_path, line_start, line_end)
+        args=(video_path, line_start, line_end, batch_size, live_rate, decode_options, qos_target)
     )
     processing_thread.start()
     
     return jsonify({'status': 'success', 'message': 'Bắt đầu nhận diện'})
 
+def parse_counting(data):
+    """Line / vùng đếm từ JSON request: lines [{"name", "start": [x, y], "end": [x, y]}, ...], zones [{"name", "polygon": [[x, y], ...]}, ...]"""
+    return {'lines': data.get('lines'), 'zones': data.get('zones')}
+
+def parse_source(data):
+    """Tuỳ chọn nguồn video từ JSON request: decode_width (thu nhỏ lúc decode), decode_fps, decoder (auto / opencv / ffmpeg), hwaccel, live (camera / giả lập camera)"""
+    decoder = data.get('decoder', 'auto')
+    if decoder not in DECODERS:
+        raise ValueError(f'decoder phải là một trong {DECODERS}')
+    width = data.get('decode_width')
+    fps = data.get('decode_fps')
+    return {'decode_width': int(width) if width else None, 'decode_fps': float(fps) if fps else None,
+            'decoder': decoder, 'hwaccel': bool(data.get('hwaccel', False)),
+            'live': None if data.get('live') is None else bool(data.get('live'))}
+
+def parse_qos(data):
+    """Latency mục tiêu (giây) khi request bật qos (target_latency_ms, mặc định 250 ms), None nếu không bật"""
+    if not data.get('qos'):
+        return None
+    target = float(data.get('target_latency_ms', 250))
+    if target <= 0:
+        raise ValueError('target_latency_ms phải > 0')
+    return target / 1000.0
+
+def parse_roi(data):
+    """ROI từ JSON request: roi_margin (pixel quanh line), roi_box [x1, y1, x2, y2] hoặc roi_polygon [[x, y], ...]"""
+    return {'margin': data.get('roi_margin'), 'box': data.get('roi_box'), 'polygon': data.get('roi_polygon')}
+
 @app.route('/api/stop_detection', methods=['POST'])
 def stop_detection():
     """API dừng nhận diện"""
@@ -103,117 +213,203 @@ def get_statistics():
     # Cập nhật thống kê từ detector
     current_counts = vehicle_detector.get_current_counts()
     vehicle_statistics.update(current_counts)
+    vehicle_statistics['lines'] = vehicle_detector.get_line_counts()
+    vehicle_statistics['zones'] = vehicle_detector.get_zone_counts()
     vehicle_statistics['last_update'] = datetime.datetime.now()
     
     return jsonify(vehicle_statistics)
 
+def mjpeg_response(broadcaster):
+    return Response(broadcaster.mjpeg(),
+                    mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}')
+
+@app.route('/video_feed')
+def video_feed():
+    """Luồng MJPEG các frame đã vẽ box/line của video đang xử lý"""
+    return mjpeg_response(frame_broadcaster)
+
+@app.route('/api/get_pipeline_stats')
+def get_pipeline_stats():
+    """API lấy độ sâu queue và latency của từng stage trong pipeline đang chạy"""
+    if current_pipeline is None:
+        return jsonify({'status': 'error', 'message': 'Chưa có pipeline nào chạy'})
+    stats = current_pipeline.get_stats()
+    stats['broadcast'] = frame_broadcaster.get_stats()
+    return jsonify(stats)
+
+@app.route('/api/qos')
+def get_qos():
+    """API trạng thái QoS: latency / mục tiêu, mức chất lượng và cấu hình đang dùng của từng stream, các lần điều chỉnh gần nhất"""
+    return jsonify(qos_controller.get_stats())
+
+@app.route('/api/get_event_log_stats')
+def get_event_log_stats():
+    """API trạng thái ghi sự kiện crossing: số chờ ghi, đã ghi, đã spool, lỗi gần nhất"""
+    return jsonify(event_log.get_stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics dạng text của Prometheus: latency từng bước (histogram), FPS, số track, queue, frame bị bỏ"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/model_status')
+def model_status():
+    """API trạng thái model: loading / ready / error, thời gian load và warm-up"""
+    return jsonify({'models': model_registry.get_stats()})
+
+@app.route('/api/streams')
+def list_streams():
+    """API lấy danh sách stream (camera) và số đếm của từng stream"""
+    return jsonify({'streams': stream_manager.list_streams(),
+                    'scheduler': stream_manager.scheduler.get_stats()})
+
+@app.route('/api/streams/<stream_id>/start', methods=['POST'])
+def start_stream(stream_id):
+    """API bắt đầu nhận diện cho 1 stream"""
+    data = request.get_json() or {}
+    video_path = data.get('video_path')
+    if not video_path:
+        return jsonify({'status': 'error', 'message': 'Thiếu video_path'})
+    try:
+        stream_manager.start_stream(
+            stream_id,
+            video_path,
+            data.get('line_start', [337, 391]),
+            data.get('line_end', [917, 387]),
+            batch_size=max(1, int(data.get('batch_size', 1))),
+            live_rate=bool(data.get('live_rate', False)),
+            detect_interval=max(1, int(data.get('detect_interval', 1))),
+            adaptive_detection=bool(data.get('adaptive_detection', False)),
+            roi=parse_roi(data),
+            **parse_counting(data),
+            **parse_source(data),
+            qos_target=parse_qos(data),
+        )
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+    return jsonify({'status': 'success', 'message': f'Bắt đầu nhận diện stream {stream_id}'})
+
+@app.route('/api/streams/<stream_id>/stop', methods=['POST'])
+def stop_stream(stream_id):
+    """API dừng 1 stream"""
+    if not stream_manager.stop_stream(stream_id):
+        return jsonify({'status': 'error', 'message': f'Không có stream {stream_id}'})
+    return jsonify({'status': 'success', 'message': f'Đã dừng stream {stream_id}'})
+
+@app.route('/api/streams/<stream_id>/video_feed')
+def stream_video_feed(stream_id):
+    """Luồng MJPEG các frame đã vẽ của 1 stream"""
+    stream = stream_manager.get_stream(stream_id)
+    if stream is None:
+        return jsonify({'status': 'error', 'message': f'Không có stream {stream_id}'}), 404
+    return mjpeg_response(stream.broadcaster)
+
+@app.route('/api/streams/<stream_id>/events')
+def stream_events(stream_id):
+    """SSE số đếm của 1 stream"""
+    stream = stream_manager.get_stream(stream_id)
+    if stream is None:
+        return jsonify({'status': 'error', 'message': f'Không có stream {stream_id}'}), 404
+    return sse_response(stream.channel.events(stream.detector.get_current_counts()))
+
+@app.route('/api/streams/<stream_id>/statistics')
+def get_stream_statistics(stream_id):
+    """API lấy thống kê + trạng thái pipeline của 1 stream"""
+    stats = stream_manager.get_stats(stream_id)
+    if stats is None:
+        return jsonify({'status': 'error', 'message': f'Không có stream {stream_id}'})
+    return jsonify(stats)
+
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/statistics_stream')
+def statistics_stream():
+    """SSE: đẩy số đếm (và phần thay đổi) mỗi khi có xe qua line"""
+    return sse_response(statistics_channel.events(vehicle_detector.get_current_counts()))
+
 @app.route('/api/save_statistics', methods=['POST'])
 def save_statistics():
-    """API lưu thống kê"""
+    """
+    API lưu thống kê ra file. Database không cần lưu tay nữa: mỗi lần xe qua line đã được
+    CrossingEventLog ghi vào bảng gộp mà trang thống kê đọc (bảng cũ vehicle_statistics chỉ còn được đọc).
+    """
     try:
-        # Lưu vào file
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"vehicle_statistics_{timestamp}.txt"
         vehicle_detector.save_counts_to_file(filename)
         
-        # Lưu vào database
-        save_to_database()
-        
-        return jsonify({'status': 'success', 'message': f'Đã lưu thống kê vào {filename}'})
+        return jsonify({'status': 'success', 'message': f'Đã lưu thống kê vào {filename} '
+                                                        f'(database được cập nhật tự động)'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
-def save_to_database():
-    """Lưu thống kê vào database"""
-    try:
-        cur = mysql.connection.cursor()
-        current_time = datetime.datetime.now()
-        
-        # Lưu thống kê theo ngày
-        cur.execute("""
-            INSERT INTO vehicle_statistics 
-            (date_recorded, car_count, truck_count, bus_count, motorcycle_count, bicycle_count, total_count)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            current_time.date(),
-            vehicle_statistics['car'],
-            vehicle_statistics['truck'],
-            vehicle_statistics['bus'],
-            vehicle_statistics['motorcycle'],
-            vehicle_statistics['bicycle'],
-            vehicle_statistics['total']
-        ))
-        
-        mysql.connection.commit()
-        cur.close()
-        
-    except Exception as e:
-        print(f"Lỗi khi lưu vào database: {e}")
-
 @app.route('/api/get_daily_statistics')
 def get_daily_statistics():
-    """API lấy thống kê theo ngày"""
+    """
+    API lấy thống kê theo khoảng thời gian:
+    start_date, end_date (YYYY-MM-DD, tính trọn ngày), group_by = hour | day | week,
+    stream_id (tuỳ chọn, mặc định cộng mọi stream). Tổng hợp bằng SQL trên bảng gộp theo giờ
+    (kèm số liệu cũ trong vehicle_statistics).
+    """
     try:
-        cur = mysql.connection.cursor()
-        cur.execute("""
-            SELECT date_recorded, car_count, truck_count, bus_count, motorcycle_count, bicycle_count, total_count
-            FROM vehicle_statistics
-            ORDER BY date_recorded DESC
-            LIMIT 30
-        """)
-        
-        results = cur.fetchall()
-        cur.close()
-        
-        statistics = []
-        for row in results:
-            statistics.append({
-                'date': row[0].strftime('%Y-%m-%d'),
-                'car': row[1],
-                'truck': row[2],
-                'bus': row[3],
-                'motorcycle': row[4],
-                'bicycle': row[5],
-                'total': row[6]
-            })
-            
+        start, end = parse_date_range(request.args.get('start_date'), request.args.get('end_date'))
+        group_by = request.args.get('group_by', 'day')
+        stream_id = request.args.get('stream_id') or None
+
+        key = (start, end, group_by, stream_id)
+        statistics = statistics_cache.get(key)
+        if statistics is None:
+            cur = mysql.connection.cursor()
+            statistics = query_statistics(cur, start, end, group_by, stream_id)
+            cur.close()
+            statistics_cache.put(key, statistics)
+
         return jsonify(statistics)
-        
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify({'error': str(e)})
+        print(f"Lỗi khi truy vấn thống kê: {e}")
+        return jsonify({'error': str(e)}), 500
 
-def process_video_thread(video_path, line_start, line_end):
-    """Xử lý video trong thread riêng"""
-    global is_processing, vehicle_statistics
+def process_video_thread(video_path, line_start, line_end, batch_size=1, live_rate=False, decode_options=None,
+                         qos_target=None):
+    """Xử lý video trong thread riêng bằng pipeline decode -> infer -> track"""
+    global is_processing, vehicle_statistics, current_pipeline
     
     try:
-        cap = cv2.VideoCapture(video_path)
+        pipeline = VideoPipeline(
+            vehicle_detector,
+            video_path,
+            batch_size=batch_size,
+            live_rate=live_rate,
+            on_counts=vehicle_statistics.update,
+            on_frame=frame_broadcaster.publish,
+            wants_frame=frame_broadcaster.wants_frame,
+            # Model không an toàn khi gọi từ nhiều thread: đi chung scheduler với các stream camera
+            infer=stream_manager.scheduler.detect_batch,
+            **(decode_options or {}),
+        )
+        current_pipeline = pipeline
+        stream_manager.scheduler.start()
+        if qos_target:
+            qos_controller.attach(vehicle_detector.stream_id, vehicle_detector, pipeline, qos_target)
+        pipeline.start()
         
-        if not cap.isOpened():
-            print(f"Không thể mở video: {video_path}")
-            is_processing = False
-            return
-            
-        while is_processing:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            # Xử lý frame
-            processed_frame = vehicle_detector.process_frame(frame)
-            
-            # Cập nhật thống kê
-            current_counts = vehicle_detector.get_current_counts()
-            vehicle_statistics.update(current_counts)
-            
-            # Delay để giảm tải CPU
-            time.sleep(0.03)  # ~30 FPS
+        # Chờ pipeline chạy xong hoặc người dùng bấm dừng
+        while is_processing and pipeline.is_running():
+            time.sleep(0.1)
             
-        cap.release()
+        pipeline.stop()
+        pipeline.join()
         
     except Exception as e:
         print(f"Lỗi khi xử lý video: {e}")
     finally:
+        # Trả detector về cấu hình ban đầu nếu QoS đã hạ chất lượng
+        qos_controller.detach(vehicle_detector.stream_id)
         is_processing = False
 
 @app.route('/api/upload_video', methods=['POST'])
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Xử lý hàng loạt video (không cần Flask) bằng VehicleDetectionSystem, chia đều cho nhiều process.
+
+- Mỗi worker load 1 model riêng và bị giới hạn số thread (torch/OpenCV/BLAS) để tổng số
+  thread không vượt quá số core (tránh oversubscription).
+- Kết quả từng video được ghi ngay khi xong: counts.csv (số xe theo class mỗi video) và
+  events.csv (mỗi lần xe qua line: frame, thời điểm trong video, track, class, hướng).
+  --format parquet ghi thêm counts.parquet / events.parquet khi chạy xong (cần pandas + pyarrow).
+
+Ví dụ:
+    python batch_process.py Videos/ --line 337 391 917 387 --workers 4 --threads-per-worker 2
+    python batch_process.py a.mp4 b.mp4 --output Data/backfill --format parquet
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from typing import Dict, List, Optional
+
+from detector_backends import BACKENDS
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+VEHICLE_CLASSES = ("car", "truck", "bus", "motorcycle", "bicycle")
+COUNT_FIELDS = ["video", "frames", "fps", "seconds", "processing_fps"] + list(VEHICLE_CLASSES) + ["total", "error"]
+EVENT_FIELDS = ["video", "frame", "video_time", "track_id", "class", "direction", "line"]
+
+# Detector của từng worker process (load 1 lần trong _init_worker)
+_worker_detector = None
+
+
+def collect_videos(inputs: List[str]) -> List[str]:
+    """Mở rộng các thư mục thành danh sách file video (sắp xếp theo tên)."""
+    videos = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            videos.append(path)
+        else:
+            print(f"Bỏ qua (không tồn tại): {path}")
+    return videos
+
+
+def _init_worker(weights: str, conf_thres: float, threads: int, detect_interval: int, backend: str = "torch",
+                 roi_margin: Optional[int] = None):
+    """Chạy 1 lần khi worker khởi động: giới hạn thread rồi mới import/load model."""
+    global _worker_detector
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+
+    import cv2
+
+    cv2.setNumThreads(threads)
+    # onnx / openvino chạy không cần torch (thread đã giới hạn qua biến môi trường ở trên)
+    if backend == "torch":
+        import torch
+
+        torch.set_num_threads(threads)
+
+    from vehicle_detections_system import VehicleDetectionSystem
+
+    _worker_detector = VehicleDetectionSystem(yolo_weights=weights, conf_thres=conf_thres,
+                                              detect_interval=detect_interval, backend=backend, draw=False)
+    _worker_detector.set_roi(margin=roi_margin)
+    _worker_detector.load_model()  # load + warm-up ngay khi worker khởi động
+
+
+def reset_detector(detector, line_start, line_end) -> List[Dict]:
+    """Chuẩn bị detector cho 1 video/đoạn mới: tracker mới, reset đếm, trả về list nhận sự kiện qua line."""
+    from sort import Sort
+
+    detector.tracker = Sort(batched=True)
+    detector.reset_counts()
+    detector.setup_counting_line(line_start, line_end)
+    events = []
+    detector.crossing_listeners = [events.append]
+    return events
+
+
+def _process_video(task) -> Dict:
+    """Đếm xe cho 1 video trong worker, trả về counts + danh sách sự kiện qua line."""
+    import cv2
+
+    video_path, line_start, line_end, batch_size = task
+    detector = _worker_detector
+    events = reset_detector(detector, line_start, line_end)
+
+    result = {"video": video_path, "frames": 0, "fps": 0.0, "seconds": 0.0, "processing_fps": 0.0,
+              "error": "", "events": events}
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        result["error"] = "không mở được video"
+        return result
+
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    start = time.perf_counter()
+    try:
+        while True:
+            frames = []
+            while len(frames) < batch_size:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frames.append(frame)
+            if not frames:
+                break
+            detector.process_frames(frames)
+            result["frames"] += len(frames)
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        cap.release()
+
+    elapsed = time.perf_counter() - start
+    result.update(detector.get_current_counts())
+    result["fps"] = fps
+    result["seconds"] = result["frames"] / fps
+    result["processing_fps"] = result["frames"] / elapsed if elapsed > 0 else 0.0
+    for e in events:
+        e["video_time"] = e["frame"] / fps
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Đếm phương tiện hàng loạt cho video lưu trữ")
+    parser.add_argument("inputs", nargs="+", help="File video hoặc thư mục chứa video")
+    parser.add_argument("--line", type=int, nargs=4, default=[337, 391, 917, 387], metavar=("X1", "Y1", "X2", "Y2"),
+                        help="Đường đếm (x1 y1 x2 y2)")
+    parser.add_argument("--weights", default="YoloWeights/yolov8s.pt")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS, help="Backend chạy model")
+    parser.add_argument("--conf", type=float, default=0.3)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads-per-worker", type=int, default=0,
+                        help="Số thread mỗi worker (mặc định: số core / số worker)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Số frame mỗi lần gọi YOLO")
+    parser.add_argument("--detect-interval", type=int, default=1, help="Chỉ detect mỗi K frame")
+    parser.add_argument("--roi-margin", type=int, default=None,
+                        help="Chỉ detect trong khung bao line đếm nới thêm N pixel (mặc định: cả frame)")
+    parser.add_argument("--output", default="Data/batch_results")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    videos = collect_videos(args.inputs)
+    if not videos:
+        print("Không có video nào để xử lý")
+        return
+
+    workers = max(1, min(args.workers, len(videos)))
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    line_start, line_end = (args.line[0], args.line[1]), (args.line[2], args.line[3])
+    tasks = [(v, line_start, line_end, max(1, args.batch_size)) for v in videos]
+
+    os.makedirs(args.output, exist_ok=True)
+    counts_path = os.path.join(args.output, "counts.csv")
+    events_path = os.path.join(args.output, "events.csv")
+    print(f"Xử lý {len(videos)} video với {workers} worker x {threads} thread -> {args.output}")
+
+    all_counts, all_events = [], []
+    start = time.perf_counter()
+    # spawn: worker không thừa hưởng thread pool của torch từ process cha
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_worker,
+                  initargs=(args.weights, args.conf, threads, args.detect_interval, args.backend,
+                            args.roi_margin)) as pool, \
+            open(counts_path, "w", newline="", encoding="utf-8") as counts_file, \
+            open(events_path, "w", newline="", encoding="utf-8") as events_file:
+        counts_writer = csv.DictWriter(counts_file, fieldnames=COUNT_FIELDS, extrasaction="ignore")
+        events_writer = csv.DictWriter(events_file, fieldnames=EVENT_FIELDS, extrasaction="ignore")
+        counts_writer.writeheader()
+        events_writer.writeheader()
+
+        for i, result in enumerate(pool.imap_unordered(_process_video, tasks), start=1):
+            events = result.pop("events")
+            for e in events:
+                e["video"] = result["video"]
+            counts_writer.writerow(result)
+            events_writer.writerows(events)
+            counts_file.flush()
+            events_file.flush()
+            all_counts.append(result)
+            all_events.extend(events)
+
+            status = f"lỗi: {result['error']}" if result["error"] else f"{result.get('total', 0)} xe"
+            print(f"[{i}/{len(videos)}] {result['video']}: {status} "
+                  f"({result['frames']} frame, {result['processing_fps']:.1f} FPS)")
+
+    if args.format == "parquet":
+        try:
+            import pandas as pd
+
+            pd.DataFrame(all_counts, columns=COUNT_FIELDS).to_parquet(os.path.join(args.output, "counts.parquet"))
+            pd.DataFrame(all_events, columns=EVENT_FIELDS).to_parquet(os.path.join(args.output, "events.parquet"))
+        except ImportError as e:
+            print(f"Không ghi được Parquet (cần pandas + pyarrow): {e}. Kết quả CSV vẫn có trong {args.output}")
+
+    print(f"Hoàn tất sau {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
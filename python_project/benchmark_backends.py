@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+So sánh tốc độ các backend detect (torch / onnx / openvino / openvino-int8) trên cùng 1 clip:
+FPS, latency mỗi frame (trung bình / p50 / p95) và độ khớp kết quả so với backend đầu tiên
+(số box và IoU trung bình của các box ghép được).
+--roi-margin chạy thêm mỗi backend trên vùng cắt quanh đường đếm (--line) để so chi phí với cả frame.
+
+Ví dụ:
+    python benchmark_backends.py --video Videos/test4.mp4 --weights YoloWeights/yolov8s.pt
+    python benchmark_backends.py --video Videos/test4.mp4 --backends torch onnx --batch-size 4 --threads 4
+    python benchmark_backends.py --video Videos/cam1080p.mp4 --backends onnx --roi-margin 150
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from detector_backends import BACKENDS, create_backend
+from sort import iou_batch, linear_assignment
+from vehicle_detections_system import VehicleDetectionSystem
+
+
+def load_frames(video_path: str, max_frames: int):
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def run_backend(detector: VehicleDetectionSystem, frames, batch_size: int, warmup: int = 3):
+    """
+    Detect toàn bộ frame qua detector.detect_frames (cắt ROI nếu có), trả về
+    (detections mỗi frame, latency mỗi frame tính bằng ms).
+    """
+    for _ in range(warmup):
+        detector.detect_frames(frames[:batch_size])
+
+    outputs, latencies = [], []
+    for i in range(0, len(frames), batch_size):
+        batch = frames[i:i + batch_size]
+        start = time.perf_counter()
+        outputs.extend(detector.detect_frames(batch))
+        latencies.extend([(time.perf_counter() - start) * 1000 / len(batch)] * len(batch))
+    return outputs, np.array(latencies)
+
+
+def agreement(reference, outputs):
+    """Tổng số box (tham chiếu, backend) và IoU trung bình của các box cùng class ghép được."""
+    ious = []
+    for ref, out in zip(reference, outputs):
+        if len(ref) == 0 or len(out) == 0:
+            continue
+        iou = iou_batch(out[:, :4], ref[:, :4]) * (out[:, 5:6] == ref[:, 5][None, :])
+        for r, c in linear_assignment(-iou):
+            if iou[r, c] > 0:
+                ious.append(iou[r, c])
+    return sum(len(r) for r in reference), sum(len(o) for o in outputs), float(np.mean(ious)) if ious else 0.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="So sánh backend detect trên CPU")
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--weights", default="YoloWeights/yolov8s.pt")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"], choices=BACKENDS)
+    parser.add_argument("--frames", type=int, default=300, help="Số frame tối đa lấy từ clip")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--conf", type=float, default=0.3)
+    parser.add_argument("--threads", type=int, default=None, help="Số thread cho onnx/openvino")
+    parser.add_argument("--data", default=None, help="Dataset yaml để hiệu chỉnh khi export openvino-int8")
+    parser.add_argument("--roi-margin", type=int, default=None, help="So sánh thêm với ROI quanh đường đếm")
+    parser.add_argument("--line", type=int, nargs=4, default=[337, 391, 917, 387], metavar=("X1", "Y1", "X2", "Y2"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    frames = load_frames(args.video, args.frames)
+    if not frames:
+        print(f"Không đọc được frame nào từ {args.video}")
+        return
+    print(f"{len(frames)} frame {frames[0].shape[1]}x{frames[0].shape[0]}, batch {args.batch_size}, imgsz {args.imgsz}")
+
+    variants = [""] if args.roi_margin is None else ["", "+roi"]
+
+    print("%-14s %8s %9s %9s %9s %8s %8s" % ("backend", "FPS", "mean ms", "p50 ms", "p95 ms", "boxes", "IoU"))
+    reference = None
+    for name in args.backends:
+        try:
+            backend = create_backend(name, args.weights, imgsz=args.imgsz, threads=args.threads, data=args.data)
+        except ImportError as e:
+            print(f"{name:<14} bỏ qua (thiếu thư viện: {e})")
+            continue
+        detector = VehicleDetectionSystem(model=backend, conf_thres=args.conf)
+        detector.setup_counting_line((args.line[0], args.line[1]), (args.line[2], args.line[3]))
+        for suffix in variants:
+            detector.set_roi(margin=args.roi_margin if suffix else None)
+            if suffix and name == args.backends[0]:
+                crop = detector.crop_to_roi(frames[0])
+                print(f"ROI {crop.shape[1]}x{crop.shape[0]} "
+                      f"({100.0 * crop.shape[0] * crop.shape[1] / (frames[0].shape[0] * frames[0].shape[1]):.0f}% diện tích)")
+            outputs, latencies = run_backend(detector, frames, args.batch_size)
+            if suffix:
+                # độ khớp không so được giữa vùng cắt và cả frame (khác toạ độ, xe ngoài ROI)
+                boxes, iou = sum(len(o) for o in outputs), float("nan")
+            else:
+                if reference is None:
+                    reference = outputs
+                _, boxes, iou = agreement(reference, outputs)
+            print("%-14s %8.1f %9.1f %9.1f %9.1f %8d %8.3f" % (
+                name + suffix, 1000.0 / latencies.mean(), latencies.mean(), np.percentile(latencies, 50),
+                np.percentile(latencies, 95), boxes, iou))
+
+
+if __name__ == "__main__":
+    main()
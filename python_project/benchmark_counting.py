@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmark độ chính xác đếm theo detect_interval (K).
+
+- Mặc định: cảnh giả lập (xe chạy qua line với tốc độ khác nhau, detector giả có nhiễu
+  và bỏ sót), biết trước số xe thực tế nên tính được sai số tuyệt đối. Chạy offline,
+  không cần model/video.
+- --video: chạy video thật với model YOLO, lấy K=1 làm chuẩn để so sánh.
+
+Ví dụ:
+    python benchmark_counting.py --intervals 1 2 3 5 8 --adaptive
+    python benchmark_counting.py --video Videos/test4.mp4 --weights YoloWeights/yolov8s.pt
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from vehicle_detections_system import VehicleDetectionSystem
+
+
+class _SyntheticBoxes:
+    """Giả lập ultralytics Boxes (chỉ các thuộc tính VehicleDetectionSystem dùng)."""
+
+    def __init__(self, data: np.ndarray):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self
+
+    @property
+    def xyxy(self):
+        return self.data[:, :4]
+
+    @property
+    def conf(self):
+        return self.data[:, 4]
+
+    @property
+    def cls(self):
+        return self.data[:, 5]
+
+
+class _SyntheticResults:
+    def __init__(self, data: np.ndarray):
+        self.boxes = _SyntheticBoxes(data)
+
+
+class SyntheticScene:
+    """
+    Xe xuất hiện ngẫu nhiên, chạy thẳng đứng qua line ngang ở giữa khung hình.
+    Số frame được mã hoá vào pixel (0, 0) để model giả biết đang ở frame nào.
+    """
+
+    CLASS_IDS = (1, 2, 3, 5, 7)
+
+    def __init__(self, n_frames=1500, width=960, height=540, spawn_rate=0.15,
+                 miss_rate=0.05, jitter=2.0, seed=0):
+        self.n_frames = n_frames
+        self.width = width
+        self.height = height
+        self.line = ((0, height // 2), (width, height // 2))
+        rng = np.random.default_rng(seed)
+
+        # Mỗi xe: frame bắt đầu, x, y0, vy, w, h, class
+        vehicles = []
+        for f in range(n_frames):
+            if rng.random() < spawn_rate:
+                down = rng.random() < 0.5
+                vy = rng.uniform(2, 12) * (1 if down else -1)
+                w, h = rng.uniform(30, 120), rng.uniform(30, 90)
+                x = rng.uniform(0, width - w)
+                y0 = -h if down else height
+                vehicles.append((f, x, y0, vy, w, h, rng.choice(self.CLASS_IDS)))
+        self.vehicles = vehicles
+
+        # Detection của mỗi frame (có bỏ sót và nhiễu toạ độ)
+        self.detections = [[] for _ in range(n_frames)]
+        self.ground_truth = 0
+        line_y = height // 2
+        for start, x, y0, vy, w, h, clsid in vehicles:
+            crossed = False
+            for f in range(start, n_frames):
+                y = y0 + vy * (f - start)
+                if y > height or y + h < 0:
+                    if f > start:
+                        break
+                    continue
+                cy = y + h / 2
+                if (vy > 0 and cy > line_y) or (vy < 0 and cy < line_y):
+                    crossed = True
+                if rng.random() < miss_rate:
+                    continue
+                dx, dy = rng.normal(0, jitter, 2)
+                self.detections[f].append([x + dx, y + dy, x + w + dx, y + h + dy, rng.uniform(0.4, 0.95), clsid])
+            self.ground_truth += crossed
+        self.detections = [np.array(d, dtype=np.float32).reshape(-1, 6) for d in self.detections]
+
+    def frames(self):
+        for f in range(self.n_frames):
+            frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+            frame[0, 0, 0], frame[0, 0, 1] = divmod(f, 256)
+            yield frame
+
+    def model(self, frames, **kwargs):
+        """Thay cho YOLO: trả về detection của đúng frame đã mã hoá trong pixel (0, 0)."""
+        return [_SyntheticResults(self.detections[int(fr[0, 0, 0]) * 256 + int(fr[0, 0, 1])]) for fr in frames]
+
+
+def run_counting(model, frames, line, detect_interval=1, adaptive=False):
+    """Chạy 1 lượt đếm, trả về (counts, số lần gọi detector, thời gian xử lý)."""
+    calls = [0]
+
+    def counting_model(batch, **kwargs):
+        calls[0] += len(batch)
+        return model(batch, **kwargs)
+
+    system = VehicleDetectionSystem(model=counting_model, detect_interval=detect_interval,
+                                    adaptive_detection=adaptive, draw=False)
+    system.setup_counting_line(*line)
+    start = time.perf_counter()
+    for frame in frames:
+        system.process_frame(frame)
+    return system.get_current_counts(), calls[0], time.perf_counter() - start
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Counting accuracy vs detect_interval")
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 3, 4, 6, 8])
+    parser.add_argument("--adaptive", action="store_true", help="Chạy thêm chế độ adaptive cho mỗi K > 1")
+    parser.add_argument("--frames", type=int, default=1500, help="Số frame của cảnh giả lập")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--video", type=str, default=None, help="Video thật (K=1 làm chuẩn)")
+    parser.add_argument("--weights", type=str, default="YoloWeights/yolov8s.pt")
+    parser.add_argument("--line", type=int, nargs=4, default=[337, 391, 917, 387], metavar=("X1", "Y1", "X2", "Y2"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.video:
+        from ultralytics import YOLO
+
+        model = YOLO(args.weights)
+        cap = cv2.VideoCapture(args.video)
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+        line = ((args.line[0], args.line[1]), (args.line[2], args.line[3]))
+        reference = None
+        load_frames = lambda: (f.copy() for f in frames)
+    else:
+        scene = SyntheticScene(n_frames=args.frames, seed=args.seed)
+        model = scene.model
+        line = scene.line
+        reference = scene.ground_truth
+        load_frames = scene.frames
+
+    modes = []
+    for k in args.intervals:
+        modes.append((k, False))
+        if args.adaptive and k > 1:
+            modes.append((k, True))
+
+    print("%-4s %-9s %8s %8s %8s %10s %8s" % ("K", "adaptive", "counted", "truth", "error%", "det_calls", "sec"))
+    for k, adaptive in modes:
+        counts, calls, seconds = run_counting(model, load_frames(), line, k, adaptive)
+        if reference is None:
+            reference = counts["total"]  # K nhỏ nhất (thường K=1) làm chuẩn cho video thật
+        error = 100.0 * abs(counts["total"] - reference) / reference if reference else 0.0
+        print("%-4d %-9s %8d %8d %8.1f %10d %8.2f" % (k, adaptive, counts["total"], reference, error, calls, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark decode video: thông lượng (frame/giây) và số mảng frame cấp phát mỗi frame.
+
+So sánh vòng lặp cap.read() thông thường (mỗi frame 1 mảng mới, resize sau khi decode đủ độ
+phân giải) với VideoSource (thread đọc trước vào ring buffer dùng lại, thu nhỏ / giảm FPS lúc decode).
+Không truyền --video thì tạo video giả lập (1280x720) trong thư mục tạm.
+
+Ví dụ:
+    python benchmark_decode.py
+    python benchmark_decode.py --video Videos/test4.mp4 --width 640 --fps 10
+    python benchmark_decode.py --decoders opencv ffmpeg --hwaccel
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from video_source import DECODERS, VideoSource, output_size
+
+
+def make_video(path, frames, width, height, fps=30):
+    """Video giả lập: nền nhiễu cố định + các khối chuyển động (đủ chi tiết để codec phải làm việc)."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Không thể tạo video: {path}")
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for i in range(frames):
+        frame = background.copy()
+        for k in range(8):
+            x = (i * (4 + k) + k * 150) % width
+            y = (k * height) // 8
+            cv2.rectangle(frame, (x, y), (x + 120, y + 60), (40 * k, 255 - 30 * k, 128), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def bench_plain(path, width, fps):
+    """cap.read() + cv2.resize như trước: mỗi frame 1 mảng decode + 1 mảng resize."""
+    cap = cv2.VideoCapture(path)
+    src_w, src_h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = src_fps / fps if fps and fps < src_fps else 1.0
+    size = output_size(src_w, src_h, width)
+    frames = allocations = 0
+    index, next_keep = 0, 0.0
+    start = time.perf_counter()
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        allocations += 1
+        index += 1
+        if index - 1 < next_keep - 1e-6:
+            continue  # frame bị bỏ khi giảm FPS (đã decode + cấp phát)
+        next_keep += step
+        if size != (src_w, src_h):
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            allocations += 1
+        frames += 1
+    elapsed = time.perf_counter() - start
+    cap.release()
+    return {"frames": frames, "fps": frames / elapsed, "allocations": allocations,
+            "allocations_per_frame": allocations / max(1, frames)}
+
+
+def bench_source(path, width, fps, decoder, hwaccel, ring_size):
+    """VideoSource: đo thông lượng phía người đọc (read + release ngay)."""
+    start = time.perf_counter()
+    source = VideoSource(path, width=width, fps=fps, decoder=decoder, hwaccel=hwaccel, ring_size=ring_size)
+    frames = 0
+    while True:
+        frame = source.read()
+        if frame is None:
+            break
+        frames += 1
+        source.release(frame)
+    elapsed = time.perf_counter() - start
+    source.close()
+    stats = source.get_stats()
+    return {"frames": frames, "fps": frames / elapsed, "decoder": stats["decoder"],
+            "decode_fps": stats["decode_fps"], "allocations": stats["allocations"],
+            "allocations_per_frame": stats["allocations_per_frame"]}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark decode video (thông lượng + cấp phát)")
+    parser.add_argument("--video", type=str, default=None, help="Mặc định: video giả lập 1280x720")
+    parser.add_argument("--frames", type=int, default=600, help="Số frame của video giả lập")
+    parser.add_argument("--width", type=int, default=640, help="Rộng sau khi thu nhỏ (0: giữ nguyên)")
+    parser.add_argument("--fps", type=float, default=None, help="Giảm FPS khi decode")
+    parser.add_argument("--decoders", nargs="+", default=["auto"], choices=DECODERS)
+    parser.add_argument("--hwaccel", action="store_true")
+    parser.add_argument("--ring-size", type=int, default=16)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    path = args.video
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "synthetic.avi")
+        make_video(path, args.frames, 1280, 720)
+    width = args.width or None
+
+    rows = [("cap.read", bench_plain(path, width, args.fps))]
+    for decoder in args.decoders:
+        try:
+            rows.append((f"VideoSource[{decoder}]",
+                         bench_source(path, width, args.fps, decoder, args.hwaccel, args.ring_size)))
+        except (IOError, ValueError) as e:
+            print(f"Lỗi khi chạy decoder {decoder}: {e}")
+
+    print(f"{'Cách đọc':<32}{'Frame':>8}{'FPS':>10}{'Cấp phát':>10}{'/frame':>9}")
+    for name, r in rows:
+        if "decoder" in r:
+            name = f"{name} -> {r['decoder']}" if r["decoder"] not in name else name
+        print(f"{name:<32}{r['frames']:>8}{r['fps']:>10.1f}{r['allocations']:>10}{r['allocations_per_frame']:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+Bộ benchmark tái lập được cho phần tracking + đếm (không cần model, video hay GPU):
+- sort_update: Sort.update trên cảnh giả lập 10 / 100 / 1000 xe (chế độ batched và từng object)
+- iou_batch, associate: iou_batch và associate_detections_to_trackers với N detection x N track
+  (tự chọn, ép ma trận đầy đủ, ép gated theo lưới)
+- process_frame: VehicleDetectionSystem.process_frame với detector giả (chỉ tốn chi phí
+  track + gán class + đếm + vẽ, không có YOLO); process_frame/headless: như trên nhưng không vẽ
+- memory: chạy process_frame rất nhiều frame (xe liên tục vào / ra khỏi hình) và đo
+  bộ nhớ tăng thêm (tracemalloc + RSS) cùng số record trạng thái theo track
+--soak: chạy memory rất lâu (mặc định 200000 frame, vài chục nghìn track, tương đương lượng xe
+nhiều ngày của 1 camera) không bật tracemalloc, trả exit code 1 nếu bộ nhớ tăng theo số track.
+
+Cảnh sinh từ seed cố định nên mỗi lần chạy có cùng dữ liệu. Kết quả ghi ra JSON (kèm commit,
+phiên bản python/numpy/opencv, CPU) để so sánh giữa các commit bằng --compare.
+
+Ví dụ:
+    python benchmark_suite.py --output bench/base.json
+    python benchmark_suite.py --output bench/new.json --compare bench/base.json
+    python benchmark_suite.py --quick --only sort_update iou_batch
+    python benchmark_suite.py --soak
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from sort import Sort, associate_detections_to_trackers, iou_batch
+from vehicle_detections_system import VehicleDetectionSystem
+
+CASES = ("sort_update", "iou_batch", "associate", "process_frame", "memory")
+
+
+class TrafficScene:
+    """
+    n_objects xe chạy (chủ yếu theo chiều dọc) qua line ngang giữa khung hình. Xe ra khỏi
+    hình thì xuất hiện lại ở mép đối diện với kích thước / class mới, nên số xe trong hình
+    luôn là n_objects còn track ID thì liên tục thay mới như camera thật.
+    Kích thước box giảm theo số xe để mật độ vừa phải ở mọi n_objects.
+    """
+
+    CLASS_IDS = (1, 2, 3, 5, 7)
+
+    def __init__(self, n_objects, width=1920, height=1080, jitter=1.5, seed=0):
+        self.n = n_objects
+        self.width = width
+        self.height = height
+        self.line = ((0, height // 2), (width, height // 2))
+        self.rng = np.random.default_rng(seed)
+        self.size = float(np.clip(np.sqrt(width * height / n_objects) * 0.4, 12, 120))
+        self.jitter = min(jitter, 0.05 * self.size)  # box nhỏ không bị nhiễu làm suy biến (h <= 0)
+
+        self.wh = np.empty((n_objects, 2))
+        self.pos = np.empty((n_objects, 2))   # góc trên trái
+        self.vel = np.empty((n_objects, 2))
+        self.cls = np.empty(n_objects)
+        self._spawn(np.arange(n_objects), anywhere=True)
+
+    def _spawn(self, idx, anywhere=False):
+        rng, k = self.rng, len(idx)
+        self.wh[idx] = rng.uniform(0.6, 1.0, (k, 2)) * self.size
+        down = rng.random(k) < 0.5
+        self.vel[idx, 0] = rng.uniform(-1, 1, k)
+        # tốc độ tỉ lệ với kích thước box (xe nhỏ = ở xa, đi chậm trên ảnh) để IoU giữa 2 frame vẫn đủ ghép
+        self.vel[idx, 1] = np.minimum(rng.uniform(0.05, 0.2, k) * self.size, 10) * np.where(down, 1, -1)
+        self.pos[idx, 0] = rng.uniform(0, self.width - self.wh[idx, 0])
+        if anywhere:
+            self.pos[idx, 1] = rng.uniform(0, self.height - self.wh[idx, 1])
+        else:
+            self.pos[idx, 1] = np.where(down, -self.wh[idx, 1], self.height)
+        self.cls[idx] = rng.choice(self.CLASS_IDS, k)
+
+    def step(self) -> np.ndarray:
+        """Sang frame tiếp theo, trả về detection (N,6) [x1,y1,x2,y2,conf,cls] như DetectorBackend."""
+        self.pos += self.vel
+        out = (self.pos[:, 1] > self.height) | (self.pos[:, 1] + self.wh[:, 1] < 0) | \
+              (self.pos[:, 0] < -self.wh[:, 0]) | (self.pos[:, 0] > self.width)
+        if out.any():
+            self._spawn(np.flatnonzero(out))
+        noise = self.rng.normal(0, self.jitter, (self.n, 4))
+        dets = np.empty((self.n, 6), dtype=np.float32)
+        dets[:, :2] = self.pos + noise[:, :2]
+        dets[:, 2:4] = self.pos + self.wh + noise[:, 2:]
+        dets[:, 4] = self.rng.uniform(0.4, 0.95, self.n)
+        dets[:, 5] = self.cls
+        return dets
+
+    def detections(self, n_frames):
+        return [self.step() for _ in range(n_frames)]
+
+
+class StubDetector:
+    """Thay cho model YOLO: trả về detection đã sinh sẵn cho frame hiện tại (chi phí ~0)."""
+
+    def __init__(self):
+        self.current = np.empty((0, 6), dtype=np.float32)
+
+    def __call__(self, frames, **kwargs):
+        return [self.current for _ in frames]
+
+
+def summarize(times, frames=None):
+    """Thống kê thời gian mỗi lần gọi (giây) -> dict ms."""
+    t = np.asarray(times) * 1000.0
+    result = {
+        "calls": int(t.size),
+        "mean_ms": float(t.mean()),
+        "median_ms": float(np.median(t)),
+        "p95_ms": float(np.percentile(t, 95)),
+        "min_ms": float(t.min()),
+        "per_second": float(1000.0 / t.mean()) if t.mean() > 0 else 0.0,
+    }
+    if frames is not None:
+        result["frames"] = frames
+    return result
+
+
+def bench_sort_update(n, batched, n_frames, repeats, seed):
+    """Thời gian 1 lần Sort.update; mỗi lần lặp tạo Sort mới và chạy lại cùng chuỗi frame."""
+    frames = [d[:, :5].astype(np.float64) for d in TrafficScene(n, seed=seed).detections(n_frames)]
+    times = []
+    for _ in range(repeats):
+        tracker = Sort(max_age=1, min_hits=3, iou_threshold=0.3, batched=batched)
+        for dets in frames:
+            start = time.perf_counter()
+            tracker.update(dets)
+            times.append(time.perf_counter() - start)
+    return summarize(times, n_frames)
+
+
+def _boxes_and_tracks(n, seed):
+    """Detection của 1 frame và vị trí track (detection frame trước) cho cùng n xe."""
+    scene = TrafficScene(n, seed=seed)
+    trks = scene.step()[:, :5].astype(np.float64)
+    dets = scene.step()[:, :5].astype(np.float64)
+    return dets, trks
+
+
+def bench_iou_batch(n, iterations, repeats, seed):
+    dets, trks = _boxes_and_tracks(n, seed)
+    times = []
+    for _ in range(repeats * iterations):
+        start = time.perf_counter()
+        iou_batch(dets, trks)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def bench_associate(n, iterations, repeats, seed, gated=None):
+    """gated=None: tự chọn như khi chạy thật; True/False: ép dùng gated / ma trận IoU đầy đủ."""
+    dets, trks = _boxes_and_tracks(n, seed)
+    times = []
+    for _ in range(repeats * iterations):
+        start = time.perf_counter()
+        associate_detections_to_trackers(dets, trks, 0.3, gated=gated)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def _make_system(scene, stub, detect_interval=1, draw=True):
+    system = VehicleDetectionSystem(model=stub, detect_interval=detect_interval, stream_id="benchmark", draw=draw)
+    system.setup_counting_line(*scene.line)
+    return system
+
+
+def bench_process_frame(n, n_frames, repeats, seed, width, height, draw=True):
+    """process_frame đầy đủ (detect giả + SORT + gán class + đếm + vẽ lên frame); draw=False: headless."""
+    dets = TrafficScene(n, width, height, seed=seed).detections(n_frames)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    times, counted = [], 0
+    for _ in range(repeats):
+        scene = TrafficScene(n, width, height, seed=seed)
+        stub = StubDetector()
+        system = _make_system(scene, stub, draw=draw)
+        for d in dets:
+            stub.current = d
+            start = time.perf_counter()
+            system.process_frame(frame)
+            times.append(time.perf_counter() - start)
+        counted = system.counts["total"]
+    result = summarize(times, n_frames)
+    result["counted"] = counted
+    return result
+
+
+def _rss_bytes():
+    """RSS hiện tại của process (Linux: /proc/self/statm), None nếu không đọc được."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _track_state_sizes(system):
+    return {
+        "track_records": len(system.tracks),
+        "live_tracks": len(system.tracker.trackers),
+    }
+
+
+def bench_memory(n, n_frames, sample_every, seed, width, height, traced=True):
+    """
+    Chạy process_frame n_frames frame liên tục, lấy mẫu bộ nhớ mỗi sample_every frame.
+    growth_*_per_1k_frames là độ dốc (hồi quy tuyến tính) trên nửa sau của lần chạy,
+    khi các cache / bộ đệm đã ổn định, nên giá trị > 0 rõ rệt nghĩa là rò rỉ theo thời gian.
+    allocated_blocks (số block Python đang cấp phát) rẻ để đo nên dùng được cho lần chạy dài;
+    tracemalloc (traced=True) cho số byte chính xác nhưng chậm hơn ~5 lần.
+    """
+    scene = TrafficScene(n, width, height, seed=seed)
+    stub = StubDetector()
+    system = _make_system(scene, stub)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+
+    gc.collect()
+    if traced:
+        tracemalloc.start()
+    samples = []
+    try:
+        for i in range(1, n_frames + 1):
+            stub.current = scene.step()
+            system.process_frame(frame)
+            if i % sample_every == 0:
+                gc.collect()
+                current, peak = tracemalloc.get_traced_memory() if traced else (None, None)
+                samples.append({"frame": i, "traced_bytes": current, "traced_peak_bytes": peak,
+                                "allocated_blocks": sys.getallocatedblocks(), "rss_bytes": _rss_bytes(),
+                                "tracks_created": int(system.tracker.next_id), **_track_state_sizes(system)})
+    finally:
+        if traced:
+            tracemalloc.stop()
+
+    def slope(key):
+        tail = [s for s in samples[len(samples) // 2:] if s[key] is not None]
+        if len(tail) < 2:
+            return None
+        x = np.array([s["frame"] for s in tail], dtype=float)
+        y = np.array([s[key] for s in tail], dtype=float)
+        return float(np.polyfit(x, y, 1)[0] * 1000.0)
+
+    return {
+        "frames": n_frames,
+        "objects": n,
+        "counted": system.counts["total"],
+        "growth_traced_bytes_per_1k_frames": slope("traced_bytes"),
+        "growth_allocated_blocks_per_1k_frames": slope("allocated_blocks"),
+        "growth_rss_bytes_per_1k_frames": slope("rss_bytes"),
+        "growth_track_state_per_1k_frames": slope("track_records"),
+        "tracks_per_1k_frames": slope("tracks_created"),
+        "final": samples[-1] if samples else {},
+        "samples": samples,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "threads_env": {k: os.environ[k] for k in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+                        if k in os.environ},
+    }
+
+
+def run_suite(args):
+    results = {}
+
+    def record(key, fn, *fn_args):
+        gc.collect()
+        start = time.perf_counter()
+        results[key] = fn(*fn_args)
+        r = results[key]
+        print("%-34s %10.3f %10.3f %10.3f %10.0f   (%.1fs)" % (
+            key, r["median_ms"], r["p95_ms"], r["mean_ms"], r["per_second"], time.perf_counter() - start))
+
+    print("%-34s %10s %10s %10s %10s" % ("case", "median ms", "p95 ms", "mean ms", "per sec"))
+    for n in args.sizes:
+        if "sort_update" in args.only:
+            record(f"sort_update/batched/n={n}", bench_sort_update, n, True, args.frames, args.repeats, args.seed)
+            if n <= args.per_object_max:
+                record(f"sort_update/per_object/n={n}", bench_sort_update, n, False, args.frames,
+                       args.repeats, args.seed)
+        if "iou_batch" in args.only:
+            record(f"iou_batch/n={n}", bench_iou_batch, n, args.iterations, args.repeats, args.seed)
+        if "associate" in args.only:
+            record(f"associate/n={n}", bench_associate, n, args.iterations, args.repeats, args.seed)
+            record(f"associate/dense/n={n}", bench_associate, n, args.iterations, args.repeats, args.seed, False)
+            record(f"associate/gated/n={n}", bench_associate, n, args.iterations, args.repeats, args.seed, True)
+        if "process_frame" in args.only:
+            record(f"process_frame/n={n}", bench_process_frame, n, args.frames, args.repeats, args.seed,
+                   args.width, args.height)
+            record(f"process_frame/headless/n={n}", bench_process_frame, n, args.frames, args.repeats, args.seed,
+                   args.width, args.height, False)
+
+    memory = None
+    if "memory" in args.only:
+        start = time.perf_counter()
+        memory = bench_memory(args.memory_objects, args.memory_frames, max(1, args.memory_frames // 40),
+                              args.seed, args.width, args.height, traced=not args.soak)
+        final = memory["final"]
+        traced = "" if args.soak else \
+            f"tracemalloc +{_kb(memory['growth_traced_bytes_per_1k_frames'])} KB / 1000 frame, "
+        print(f"memory: {memory['frames']} frame, {memory['objects']} xe, {final.get('tracks_created')} track, "
+              f"{traced}RSS +{_kb(memory['growth_rss_bytes_per_1k_frames'])} KB / 1000 frame, "
+              f"+{memory['growth_allocated_blocks_per_1k_frames']:.1f} block / 1000 frame, "
+              f"track records {final.get('track_records')}, live tracks {final.get('live_tracks')} "
+              f"({time.perf_counter() - start:.1f}s)")
+    return results, memory
+
+
+def check_soak(memory, objects):
+    """
+    Bộ nhớ không được tăng theo số track đã tạo: số record theo track không vượt quá vài lần
+    số xe trong hình, và số block Python tăng ít hơn hẳn số track mới (rò rỉ dù chỉ 1 object
+    mỗi track cũng vượt ngưỡng). Trả về danh sách lỗi (rỗng = đạt).
+    """
+    errors = []
+    records = max(s["track_records"] for s in memory["samples"][len(memory["samples"]) // 2:])
+    if records > 4 * objects:
+        errors.append(f"còn giữ {records} record theo track với {objects} xe trong hình")
+    tracks, blocks = memory["tracks_per_1k_frames"], memory["growth_allocated_blocks_per_1k_frames"]
+    if tracks and blocks is not None and blocks > 0.1 * tracks:
+        errors.append(f"số block tăng {blocks:.1f} / 1000 frame với {tracks:.0f} track mới / 1000 frame")
+    return errors
+
+
+def _kb(value):
+    return "n/a" if value is None else f"{value / 1024:.1f}"
+
+
+def compare(results, baseline_path, threshold):
+    """In tỉ lệ median mới / cũ cho các case chung, trả về danh sách case chậm hơn ngưỡng."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old_cases = baseline.get("cases", {})
+    print(f"\nSo với {baseline_path} (commit {baseline.get('meta', {}).get('commit')}):")
+    print("%-34s %10s %10s %8s" % ("case", "old ms", "new ms", "ratio"))
+    regressions = []
+    for key, new in results.items():
+        old = old_cases.get(key)
+        if not old or not old.get("median_ms"):
+            continue
+        ratio = new["median_ms"] / old["median_ms"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  CHẬM HƠN"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = "  nhanh hơn"
+        print("%-34s %10.3f %10.3f %8.2f%s" % (key, old["median_ms"], new["median_ms"], ratio, flag))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark tracking / đếm (offline, CPU)")
+    parser.add_argument("--only", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Số xe trong cảnh")
+    parser.add_argument("--frames", type=int, default=300, help="Số frame mỗi lần lặp (sort_update, process_frame)")
+    parser.add_argument("--iterations", type=int, default=200, help="Số lần gọi mỗi lần lặp (iou_batch, associate)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--per-object-max", type=int, default=100,
+                        help="Chỉ chạy Sort không batched khi số xe <= giá trị này")
+    parser.add_argument("--width", type=int, default=None,
+                        help="Kích thước frame cho process_frame / memory (mặc định 1280x720, --soak: 640x360)")
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--memory-frames", type=int, default=None, help="Mặc định 10000, --soak: 200000")
+    parser.add_argument("--memory-objects", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="Ít frame / lần lặp hơn, để kiểm tra nhanh")
+    parser.add_argument("--soak", action="store_true",
+                        help="Chỉ chạy memory rất lâu (không tracemalloc) và kiểm tra bộ nhớ không tăng")
+    parser.add_argument("--output", default=None, help="File JSON kết quả")
+    parser.add_argument("--compare", default=None, help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="Chậm hơn quá tỉ lệ này so với --compare thì báo và trả exit code 1")
+    args = parser.parse_args()
+    if args.soak:
+        args.only = ["memory"]
+    # Khi soak, kích thước frame chỉ ảnh hưởng chi phí vẽ, không ảnh hưởng bộ nhớ theo track
+    args.width = args.width or (640 if args.soak else 1280)
+    args.height = args.height or (360 if args.soak else 720)
+    if args.memory_frames is None:
+        args.memory_frames = 200000 if args.soak else 10000
+    if args.quick:
+        args.frames, args.iterations, args.repeats = 60, 30, 1
+        args.memory_frames = min(args.memory_frames, 3000)
+    return args
+
+
+def main():
+    args = parse_args()
+    meta = environment()
+    print(f"commit {meta['commit']}, python {meta['python']}, numpy {meta['numpy']}, "
+          f"opencv {meta['opencv']}, {meta['cpu_count']} CPU")
+    results, memory = run_suite(args)
+
+    report = {
+        "meta": meta,
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "cases": results,
+        "memory": memory,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Đã ghi kết quả vào {args.output}")
+
+    if args.soak:
+        errors = check_soak(memory, args.memory_objects)
+        for e in errors:
+            print(f"Soak: {e}")
+        print("Soak: " + ("KHÔNG ĐẠT" if errors else "đạt, bộ nhớ không tăng theo số track"))
+        if errors:
+            sys.exit(1)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case chậm hơn quá {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Đếm xe cho 1 video dài bằng nhiều process: chia video thành các đoạn thời gian, mỗi đoạn
+có 1 SORT riêng, sau đó nối (stitch) ID track giữa các đoạn để mỗi xe chỉ được đếm 1 lần.
+
+- Đoạn i sở hữu frame [start, end) nhưng bắt đầu chạy từ start - overlap (warm-up) để
+  tracker kịp xác nhận track và biết xe đang ở phía nào của line trước khi vào phần của mình.
+- Vùng warm-up của đoạn i cũng là phần cuối của đoạn i-1: track của 2 đoạn trong vùng này
+  được ghép theo IoU trung bình (Hungarian), track ghép được dùng chung 1 ID toàn cục.
+- Xe qua line trong vùng warm-up thuộc về đoạn trước, nên chỉ được tính cho đoạn sau nếu
+  track đã ghép được mà đoạn trước chưa đếm.
+
+Ví dụ:
+    python chunk_processing.py Videos/long.mp4 --chunks 8 --workers 4 --overlap 2 --check
+    python chunk_processing.py --synthetic --chunks 6 --check
+"""
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+import batch_process
+from detector_backends import BACKENDS
+from sort import iou_batch, linear_assignment
+
+VEHICLE_CLASSES = batch_process.VEHICLE_CLASSES
+
+
+class Segment(NamedTuple):
+    index: int
+    warm_start: int   # frame bắt đầu chạy (start - overlap)
+    start: int        # frame đầu tiên thuộc đoạn này
+    end: int          # frame sau frame cuối (không gồm)
+    tail_start: int   # từ frame này trở đi là warm-up của đoạn sau -> ghi lại track để ghép
+
+
+def plan_segments(n_frames: int, chunks: int, overlap: int) -> List[Segment]:
+    """Chia [0, n_frames) thành tối đa `chunks` đoạn bằng nhau, mỗi đoạn warm-up `overlap` frame."""
+    chunks = max(1, min(chunks, n_frames))
+    length = math.ceil(n_frames / chunks)
+    segments = []
+    for i, start in enumerate(range(0, n_frames, length)):
+        end = min(start + length, n_frames)
+        tail_start = end - overlap if end < n_frames else end
+        segments.append(Segment(i, max(0, start - overlap), start, end, max(start, tail_start)))
+    return segments
+
+
+def run_segment(detector, frames: Iterable[np.ndarray], segment: Segment, line_start, line_end,
+                batch_size: int = 8) -> Dict:
+    """
+    Chạy detector trên các frame của 1 đoạn (bắt đầu từ segment.warm_start).
+    Trả về sự kiện qua line (frame tính theo cả video) và track trong vùng warm-up (head)
+    / vùng chồng với đoạn sau (tail) để ghép ID.
+    """
+    events = batch_process.reset_detector(detector, line_start, line_end)
+    head: Dict[int, np.ndarray] = {}
+    tail: Dict[int, np.ndarray] = {}
+    result = {"segment": segment, "frames": 0, "error": "", "events": events, "head": head, "tail": tail}
+
+    frames = iter(frames)
+    frame_no = segment.warm_start
+    try:
+        while frame_no < segment.end:
+            batch = list(itertools.islice(frames, min(batch_size, segment.end - frame_no)))
+            if not batch:
+                break
+            _process_batch_recording(detector, batch, frame_no, segment, head, tail)
+            frame_no += len(batch)
+    except Exception as e:
+        result["error"] = str(e)
+
+    result["frames"] = frame_no - segment.warm_start
+    for e in events:
+        e["frame"] += segment.warm_start
+    return result
+
+
+def _process_batch_recording(detector, batch, first_frame, segment, head, tail):
+    """process_frames cho cả batch (YOLO 1 lần) nhưng vẫn ghi lại track của từng frame."""
+    keyframes = [i for i, key in enumerate(detector.plan_keyframes(len(batch))) if key]
+    results = dict(zip(keyframes, detector.detect_frames([batch[i] for i in keyframes]))) if keyframes else {}
+    for i, frame in enumerate(batch):
+        detector.track_and_count(frame, results.get(i))
+        _record_tracks(detector, first_frame + i, segment, head, tail)
+
+
+def _record_tracks(detector, frame_no, segment, head, tail):
+    if frame_no < segment.start:
+        head[frame_no] = np.array(detector.last_tracks, copy=True)
+    elif frame_no >= segment.tail_start:
+        tail[frame_no] = np.array(detector.last_tracks, copy=True)
+
+
+def match_overlap_tracks(prev_tail: Dict[int, np.ndarray], cur_head: Dict[int, np.ndarray],
+                         iou_threshold: float = 0.3, min_frames: int = 3) -> Dict[int, int]:
+    """
+    Ghép track đoạn sau (cur) với track đoạn trước (prev) trên các frame chồng nhau:
+    IoU trung bình trên những frame cả 2 track cùng xuất hiện (ít nhất min_frames frame),
+    gán 1-1 bằng Hungarian. Trả về {track_id đoạn sau: track_id đoạn trước}.
+    """
+    frames = [f for f in cur_head if f in prev_tail and len(cur_head[f]) and len(prev_tail[f])]
+    if not frames:
+        return {}
+    prev_ids = sorted({int(t) for f in frames for t in prev_tail[f][:, 4]})
+    cur_ids = sorted({int(t) for f in frames for t in cur_head[f][:, 4]})
+    prev_pos = {t: k for k, t in enumerate(prev_ids)}
+    cur_pos = {t: k for k, t in enumerate(cur_ids)}
+
+    iou_sum = np.zeros((len(cur_ids), len(prev_ids)))
+    together = np.zeros_like(iou_sum)
+    for f in frames:
+        a, b = prev_tail[f], cur_head[f]
+        cells = np.ix_([cur_pos[int(t)] for t in b[:, 4]], [prev_pos[int(t)] for t in a[:, 4]])
+        iou_sum[cells] += iou_batch(b[:, :4], a[:, :4])
+        together[cells] += 1
+
+    mean_iou = np.where(together >= min_frames, iou_sum / np.maximum(together, 1), 0.0)
+    matched = linear_assignment(-mean_iou)
+    return {cur_ids[r]: prev_ids[c] for r, c in matched if mean_iou[r, c] >= iou_threshold}
+
+
+def stitch_segments(results: List[Dict], iou_threshold: float = 0.3, min_frames: int = 3) -> Dict:
+    """Gộp kết quả các đoạn: ID toàn cục cho track, mỗi ID chỉ đếm 1 lần."""
+    results = sorted(results, key=lambda r: r["segment"].index)
+    global_ids: Dict[tuple, int] = {}
+    counted = set()
+    counts = {c: 0 for c in VEHICLE_CLASSES}
+    counts["total"] = 0
+    events = []
+    matched_total = 0
+
+    def global_id(key):
+        if key not in global_ids:
+            global_ids[key] = len(global_ids)
+        return global_ids[key]
+
+    prev = None
+    for res in results:
+        seg = res["segment"]
+        matched = set()
+        if prev is not None:
+            pairs = match_overlap_tracks(prev["tail"], res["head"], iou_threshold, min_frames)
+            for cur_tid, prev_tid in pairs.items():
+                global_ids[(seg.index, cur_tid)] = global_id((prev["segment"].index, prev_tid))
+                matched.add(cur_tid)
+            matched_total += len(pairs)
+
+        for e in sorted(res["events"], key=lambda ev: ev["frame"]):
+            # Qua line trong warm-up mà không ghép được track -> đoạn trước đã xử lý vùng này
+            if e["frame"] < seg.start and e["track_id"] not in matched:
+                continue
+            gid = global_id((seg.index, e["track_id"]))
+            if gid in counted:
+                continue
+            counted.add(gid)
+            counts[e["class"]] += 1
+            counts["total"] += 1
+            events.append(dict(e, track_id=gid, segment=seg.index))
+        prev = res
+
+    return {"counts": counts, "events": events, "matched_tracks": matched_total,
+            "errors": [r["error"] for r in results if r["error"]]}
+
+
+# ---------- Chạy song song trên video thật ----------
+
+def _seek_exact(cap, frame_index: int) -> bool:
+    """
+    Đưa cap tới đúng frame_index. Seek của OpenCV nhảy theo keyframe nên có thể dừng trước
+    (hoặc sau) frame cần: đọc lại vị trí, thiếu thì grab() bỏ qua cho đủ, vượt quá thì đọc lại
+    từ đầu. Sai lệch làm lệch số frame của sự kiện và phần chồng lấn giữa 2 đoạn.
+    """
+    import cv2
+
+    if frame_index <= 0:
+        return True
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    if pos < 0 or pos > frame_index:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if pos != 0:
+            return False
+    for _ in range(frame_index - pos):
+        if not cap.grab():
+            return False
+    return True
+
+
+def _process_segment(task) -> Dict:
+    """Chạy trong worker (detector đã load bởi batch_process._init_worker)."""
+    import cv2
+
+    video_path, segment, line_start, line_end, batch_size = task
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return {"segment": segment, "frames": 0, "error": "không mở được video",
+                "events": [], "head": {}, "tail": {}}
+    if not _seek_exact(cap, segment.warm_start):
+        cap.release()
+        return {"segment": segment, "frames": 0, "error": f"không seek được tới frame {segment.warm_start}",
+                "events": [], "head": {}, "tail": {}}
+
+    def frames():
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                return
+            yield frame
+
+    try:
+        return run_segment(batch_process._worker_detector, frames(), segment, line_start, line_end, batch_size)
+    finally:
+        cap.release()
+
+
+def process_video_chunked(video_path: str, line_start, line_end, chunks: int = 4, workers: int = 4,
+                          overlap_seconds: float = 2.0, weights: str = "YoloWeights/yolov8s.pt",
+                          conf_thres: float = 0.3, threads: Optional[int] = None, batch_size: int = 8,
+                          detect_interval: int = 1, backend: str = "torch",
+                          roi_margin: Optional[int] = None) -> Dict:
+    """Chia video thành `chunks` đoạn, xử lý song song bằng `workers` process rồi ghép kết quả."""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Không mở được video: {video_path}")
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    cap.release()
+
+    segments = plan_segments(n_frames, chunks, int(round(overlap_seconds * fps)))
+    workers = max(1, min(workers, len(segments)))
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    tasks = [(video_path, s, line_start, line_end, batch_size) for s in segments]
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=batch_process._init_worker,
+                  initargs=(weights, conf_thres, threads, detect_interval, backend, roi_margin)) as pool:
+        results = list(pool.imap_unordered(_process_segment, tasks))
+
+    stitched = stitch_segments(results)
+    stitched["frames"] = sum(r["frames"] for r in results) - sum(s.start - s.warm_start for s in segments)
+    stitched["fps"] = fps
+    for e in stitched["events"]:
+        e["video_time"] = e["frame"] / fps
+    return stitched
+
+
+# ---------- Kiểm tra trên cảnh giả lập (không cần model/video) ----------
+
+def run_synthetic(chunks: int, overlap: int, n_frames: int, seed: int, batch_size: int):
+    """Trả về (counts 1 lượt, counts chia đoạn, số xe thực tế) trên cảnh của benchmark_counting."""
+    from benchmark_counting import SyntheticScene
+    from vehicle_detections_system import VehicleDetectionSystem
+
+    scene = SyntheticScene(n_frames=n_frames, seed=seed)
+
+    def run(segment):
+        detector = VehicleDetectionSystem(model=scene.model, draw=False)
+        frames = itertools.islice(scene.frames(), segment.warm_start, segment.end)
+        return run_segment(detector, frames, segment, *scene.line, batch_size=batch_size)
+
+    single = stitch_segments([run(s) for s in plan_segments(n_frames, 1, overlap)])
+    chunked = stitch_segments([run(s) for s in plan_segments(n_frames, chunks, overlap)])
+    return single, chunked, scene.ground_truth
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Đếm xe cho 1 video dài bằng nhiều process")
+    parser.add_argument("video", nargs="?", help="Video cần xử lý")
+    parser.add_argument("--line", type=int, nargs=4, default=[337, 391, 917, 387], metavar=("X1", "Y1", "X2", "Y2"))
+    parser.add_argument("--chunks", type=int, default=0, help="Số đoạn (mặc định = số worker)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads-per-worker", type=int, default=0)
+    parser.add_argument("--overlap", type=float, default=2.0, help="Thời gian chồng giữa 2 đoạn (giây)")
+    parser.add_argument("--weights", default="YoloWeights/yolov8s.pt")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS)
+    parser.add_argument("--conf", type=float, default=0.3)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--detect-interval", type=int, default=1)
+    parser.add_argument("--roi-margin", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="Chạy thêm 1 lượt không chia đoạn để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="Sai lệch tổng số xe cho phép so với 1 lượt (tỉ lệ, mặc định 2%%)")
+    parser.add_argument("--synthetic", action="store_true", help="Dùng cảnh giả lập của benchmark_counting")
+    parser.add_argument("--frames", type=int, default=3000, help="Số frame cảnh giả lập")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    chunks = args.chunks or args.workers
+    line_start, line_end = (args.line[0], args.line[1]), (args.line[2], args.line[3])
+    start = time.perf_counter()
+
+    single = None
+    if args.synthetic:
+        overlap = int(round(args.overlap * 30))
+        single, result, truth = run_synthetic(chunks, overlap, args.frames, args.seed, args.batch_size)
+        print(f"Cảnh giả lập: {args.frames} frame, {chunks} đoạn, overlap {overlap} frame, thực tế {truth} xe")
+    elif args.video:
+        options = dict(workers=args.workers, overlap_seconds=args.overlap, weights=args.weights,
+                       conf_thres=args.conf, threads=args.threads_per_worker or None,
+                       batch_size=args.batch_size, detect_interval=args.detect_interval, backend=args.backend,
+                       roi_margin=args.roi_margin)
+        result = process_video_chunked(args.video, line_start, line_end, chunks=chunks, **options)
+        if args.check:
+            single = process_video_chunked(args.video, line_start, line_end, chunks=1,
+                                           **dict(options, workers=1, threads=os.cpu_count()))
+    else:
+        print("Cần truyền video hoặc --synthetic")
+        sys.exit(2)
+
+    for error in result["errors"]:
+        print(f"Lỗi khi xử lý đoạn: {error}")
+    print(f"Chia đoạn: {result['counts']} (ghép {result['matched_tracks']} track qua ranh giới) "
+          f"sau {time.perf_counter() - start:.1f}s")
+
+    if single is not None:
+        diff = abs(result["counts"]["total"] - single["counts"]["total"])
+        allowed = args.tolerance * max(1, single["counts"]["total"])
+        print(f"1 lượt:    {single['counts']}")
+        print(f"Sai lệch tổng: {diff} xe (cho phép {allowed:.1f}) -> {'OK' if diff <= allowed else 'VƯỢT NGƯỠNG'}")
+        if diff > allowed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
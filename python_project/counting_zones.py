@@ -0,0 +1,212 @@
+from typing import List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+# Hướng qua line: phía của line mà xe sang sau khi qua.
+# "positive" = bên phải line khi nhìn từ start tới end (toạ độ ảnh, trục y hướng xuống)
+DIRECTIONS = {1: "positive", -1: "negative"}
+
+
+class CountingLine(NamedTuple):
+    """Đoạn thẳng đếm xe (chỉ xe đi qua chính đoạn start-end mới được đếm)."""
+    name: str
+    start: Tuple[int, int]
+    end: Tuple[int, int]
+
+
+class Zone(NamedTuple):
+    """Vùng đa giác để đo số xe đang ở trong vùng và số lượt xe đi vào."""
+    name: str
+    polygon: np.ndarray  # (V, 2) int32
+
+
+def side_of_lines(points: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Phía của N điểm so với L line trong 1 lần tính: (N, L) int8,
+    1 / -1 theo dấu tích có hướng, 0 nếu nằm trên đường thẳng chứa line.
+    """
+    d = ends - starts
+    rel = points[:, None, :] - starts[None, :, :]
+    return np.sign(d[:, 0] * rel[..., 1] - d[:, 1] * rel[..., 0]).astype(np.int8)
+
+
+def movement_reaches_lines(prev: np.ndarray, curr: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    (N, L) bool: đường di chuyển prev -> curr của từng track có đi ngang qua đoạn line không
+    (2 đầu mút của line nằm khác phía, hoặc trên, đường thẳng chứa bước di chuyển).
+    Kết hợp với đổi phía so với line, đây là phép giao 2 đoạn thẳng: xe nhảy qua line giữa
+    2 frame vẫn được đếm, xe đi qua đường thẳng chứa line nhưng ngoài đoạn line thì không.
+    """
+    m = curr - prev
+    rs = starts[None, :, :] - prev[:, None, :]
+    re = ends[None, :, :] - prev[:, None, :]
+    o_start = m[:, None, 0] * rs[..., 1] - m[:, None, 1] * rs[..., 0]
+    o_end = m[:, None, 0] * re[..., 1] - m[:, None, 1] * re[..., 0]
+    return o_start * o_end <= 0
+
+
+def distance_to_lines(points: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """(N, L) khoảng cách (pixel) từ điểm tới đường thẳng chứa từng line."""
+    d = ends - starts
+    rel = points[:, None, :] - starts[None, :, :]
+    length = np.hypot(d[:, 0], d[:, 1])
+    cross = np.abs(d[:, 0] * rel[..., 1] - d[:, 1] * rel[..., 0])
+    # Line suy biến (start == end): khoảng cách tới điểm start
+    return np.where(length > 0, cross / np.where(length > 0, length, 1), np.hypot(rel[..., 0], rel[..., 1]))
+
+
+def pack_polygons(polygons: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    Gộp các đa giác (số đỉnh khác nhau) thành mảng (Z, V, 2): đa giác ít đỉnh được lặp lại đỉnh
+    cuối, tạo cạnh độ dài 0 không ảnh hưởng phép đếm tia của points_in_polygons.
+    """
+    n_vertices = max(len(p) for p in polygons)
+    packed = np.empty((len(polygons), n_vertices, 2))
+    for z, p in enumerate(polygons):
+        packed[z, :len(p)] = p
+        packed[z, len(p):] = p[-1]
+    return packed
+
+
+def points_in_polygons(points: np.ndarray, packed: np.ndarray) -> np.ndarray:
+    """(N, Z) bool: điểm có nằm trong đa giác không (ray casting cho mọi điểm × mọi cạnh cùng lúc)."""
+    xi, yi = packed[..., 0], packed[..., 1]
+    nxt = np.roll(packed, -1, axis=1)
+    xj, yj = nxt[..., 0], nxt[..., 1]
+    px = points[:, 0, None, None]
+    py = points[:, 1, None, None]
+    straddle = (yi > py) != (yj > py)
+    dy = yj - yi
+    x_cross = xi + (py - yi) * (xj - xi) / np.where(dy == 0, 1, dy)
+    return np.count_nonzero(straddle & (px < x_cross), axis=-1) % 2 == 1
+
+
+class CountingZones:
+    """
+    Các line đếm + vùng của 1 stream và trạng thái của từng track với chúng, lưu dạng mảng
+    (mỗi track giữ 1 slot, như KalmanBoxTrackerBank) để update() kiểm tra mọi track × mọi line
+    và mọi track × mọi vùng trong 1 lần tính vector hoá mỗi frame:
+    - side[slot, l]: phía khác 0 gần nhất của track so với line l (0 = chưa biết)
+    - counted[slot, l]: track đã được đếm ở line l chưa (mỗi track đếm tối đa 1 lần mỗi line)
+    - center[slot]: tâm track ở lần update trước, để kiểm tra giao giữa bước di chuyển và line
+    - inside[slot, z]: track đang ở trong vùng z
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.lines: List[CountingLine] = []
+        self.zones: List[Zone] = []
+        self._starts = np.empty((0, 2))
+        self._ends = np.empty((0, 2))
+        self._packed = np.empty((0, 1, 2))
+        self._free: List[int] = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self.side = np.zeros((capacity, len(self.lines)), dtype=np.int8)
+        self.counted = np.zeros((capacity, len(self.lines)), dtype=bool)
+        self.center = np.zeros((capacity, 2))
+        self.has_center = np.zeros(capacity, dtype=bool)
+        self.inside = np.zeros((capacity, len(self.zones)), dtype=bool)
+        self._free = list(range(capacity - 1, -1, -1))
+
+    @property
+    def capacity(self) -> int:
+        return len(self.center)
+
+    def set_lines(self, lines: Sequence[CountingLine]):
+        """Thay toàn bộ line; line giữ nguyên (cùng tên, cùng toạ độ) giữ trạng thái của các track."""
+        keep = _same_columns(self.lines, lines)
+        self.lines = list(lines)
+        self._starts = np.array([l.start for l in self.lines], dtype=float).reshape(-1, 2)
+        self._ends = np.array([l.end for l in self.lines], dtype=float).reshape(-1, 2)
+        self.side = _remap_columns(self.side, keep)
+        self.counted = _remap_columns(self.counted, keep)
+
+    def set_zones(self, zones: Sequence[Zone]):
+        """Thay toàn bộ vùng; vùng giữ nguyên giữ trạng thái trong/ngoài vùng của các track."""
+        keep = _same_columns([(z.name, z.polygon.tolist()) for z in self.zones],
+                             [(z.name, z.polygon.tolist()) for z in zones])
+        self.zones = list(zones)
+        self._packed = pack_polygons([z.polygon for z in self.zones]) if self.zones else np.empty((0, 1, 2))
+        self.inside = _remap_columns(self.inside, keep)
+
+    def alloc(self) -> int:
+        """Cấp 1 slot trống (đã xoá trạng thái) cho track mới, nới mảng gấp đôi khi hết."""
+        if not self._free:
+            old = self.capacity
+            self.side = np.concatenate([self.side, np.zeros_like(self.side)])
+            self.counted = np.concatenate([self.counted, np.zeros_like(self.counted)])
+            self.center = np.concatenate([self.center, np.zeros_like(self.center)])
+            self.has_center = np.concatenate([self.has_center, np.zeros_like(self.has_center)])
+            self.inside = np.concatenate([self.inside, np.zeros_like(self.inside)])
+            self._free = list(range(2 * old - 1, old - 1, -1))
+        return self._free.pop()
+
+    def free(self, slot: int):
+        self.side[slot] = 0
+        self.counted[slot] = False
+        self.has_center[slot] = False
+        self.inside[slot] = False
+        self._free.append(slot)
+
+    def reset(self):
+        """Xoá trạng thái của mọi track (giữ line/vùng)."""
+        self._allocate(self.capacity)
+
+    def update(self, slots: np.ndarray, centers: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """
+        Cập nhật vị trí mới (centers (N, 2)) của các track ở `slots` (N,).
+        Trả về (rows, line_idx, direction, inside, entered):
+        - rows/line_idx/direction: các lần qua line mới ở frame này (rows là chỉ số trong slots,
+          direction 1/-1 là phía của line sau khi qua), sắp theo (row, line)
+        - inside: (N, Z) bool, track nào đang ở trong vùng nào
+        - entered: (N, Z) bool, track vừa từ ngoài đi vào vùng (không tính track xuất hiện sẵn trong vùng)
+        Qua line = phía đổi so với phía khác 0 gần nhất, bước di chuyển từ tâm lần trước tới
+        tâm hiện tại đi ngang qua đoạn line, và track chưa được đếm ở line đó.
+        """
+        empty = np.empty(0, dtype=np.intp)
+        if len(slots) == 0:
+            no_zone = np.zeros((0, len(self.zones)), dtype=bool)
+            return empty, empty, np.empty(0, dtype=np.int8), no_zone, no_zone
+        rows = line_idx = empty
+        direction = np.empty(0, dtype=np.int8)
+
+        if self.lines:
+            side = side_of_lines(centers, self._starts, self._ends)
+            last = self.side[slots]
+            crossed = (side != 0) & (last != 0) & (side != last) & ~self.counted[slots]
+            crossed &= self.has_center[slots, None]
+            if crossed.any():
+                crossed &= movement_reaches_lines(self.center[slots], centers, self._starts, self._ends)
+                rows, line_idx = np.nonzero(crossed)
+                direction = side[rows, line_idx]
+                self.counted[slots[rows], line_idx] = True
+            # Chỉ nhớ phía khác 0: xe dừng đúng trên line rồi đi tiếp vẫn được đếm
+            self.side[slots] = np.where(side != 0, side, last)
+
+        inside = points_in_polygons(centers, self._packed) if self.zones else np.zeros((len(slots), 0), dtype=bool)
+        entered = inside & ~self.inside[slots] & self.has_center[slots, None]
+        self.inside[slots] = inside
+        self.center[slots] = centers
+        self.has_center[slots] = True
+        return rows, line_idx, direction, inside, entered
+
+    def near_uncounted(self, slots: np.ndarray, centers: np.ndarray, radius: np.ndarray) -> bool:
+        """Có track nào cách 1 line chưa đếm nó dưới radius (pixel, theo từng track) không."""
+        if not self.lines or len(slots) == 0:
+            return False
+        near = distance_to_lines(centers, self._starts, self._ends) < radius[:, None]
+        return bool((near & ~self.counted[slots]).any())
+
+
+def _same_columns(old: Sequence, new: Sequence) -> List[int]:
+    """Với mỗi phần tử của new: vị trí phần tử bằng nó trong old, -1 nếu là phần tử mới."""
+    return [next((j for j, o in enumerate(old) if o == n), -1) for n in new]
+
+
+def _remap_columns(array: np.ndarray, keep: List[int]) -> np.ndarray:
+    result = np.zeros((len(array), len(keep)), dtype=array.dtype)
+    for i, j in enumerate(keep):
+        if j >= 0:
+            result[:, i] = array[:, j]
+    return result
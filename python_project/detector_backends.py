@@ -0,0 +1,248 @@
+import abc
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "openvino", "openvino-int8")
+
+logger = logging.getLogger(__name__)
+
+
+def letterbox(frame: np.ndarray, size: int, rect: bool = False,
+              stride: int = 32) -> Tuple[np.ndarray, float, Tuple[float, float]]:
+    """
+    Resize giữ tỉ lệ + pad viền xám về size x size (như ultralytics). rect=True chỉ pad tới bội số
+    của stride (ảnh chữ nhật, ít pixel hơn) - dùng được khi model nhận kích thước động.
+    Trả về (ảnh, tỉ lệ, (pad_x, pad_y)).
+    """
+    h, w = frame.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    pad_x, pad_y = (size - new_w) / 2, (size - new_h) / 2
+    if rect:
+        pad_x, pad_y = (-new_w % stride) / 2, (-new_h % stride) / 2
+    if (new_w, new_h) != (w, h):
+        frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    frame = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return frame, ratio, (left, top)
+
+
+class DetectorBackend(abc.ABC):
+    """
+    Giao diện chung cho model detect. Gọi giống model ultralytics:
+        backend(frames, conf=..., classes=[...], imgsz=...) -> list mảng (N, 6) float32
+    mỗi dòng [x1, y1, x2, y2, conf, class_id] theo toạ độ frame gốc, xếp theo conf giảm dần.
+    VehicleDetectionSystem đọc trực tiếp các mảng này (_results_to_dets).
+    """
+
+    name = "base"
+
+    imgsz = 640
+    # False: model chỉ nhận đúng imgsz (export kích thước cố định), tham số imgsz khi gọi bị bỏ qua
+    dynamic_imgsz = True
+
+    @abc.abstractmethod
+    def predict(self, frames: List[np.ndarray], conf: float, classes: Optional[Sequence[int]],
+                imgsz: int) -> List[np.ndarray]:
+        """Detect cho list frame BGR, trả về 1 mảng (N, 6) mỗi frame."""
+
+    def __call__(self, frames, verbose: bool = False, conf: float = 0.25,
+                 classes: Optional[Sequence[int]] = None, imgsz: Optional[int] = None, **kwargs) -> List[np.ndarray]:
+        if isinstance(frames, np.ndarray):
+            frames = [frames]
+        return self.predict(list(frames), conf, classes, imgsz or self.imgsz)
+
+
+class UltralyticsBackend(DetectorBackend):
+    """Model PyTorch (.pt) qua ultralytics YOLO - đường chạy mặc định, cần torch."""
+
+    name = "torch"
+
+    def __init__(self, weights: str, imgsz: int = 640):
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights)
+        self.imgsz = imgsz
+
+    def predict(self, frames, conf, classes, imgsz):
+        results = self.model(frames, verbose=False, conf=conf, classes=classes, imgsz=imgsz)
+        return [r.boxes.data.cpu().numpy().astype(np.float32) for r in results]
+
+
+class _ExportedYoloBackend(DetectorBackend):
+    """
+    Tiền/hậu xử lý chung cho YOLOv8 đã export (ONNX/OpenVINO), không cần torch khi chạy:
+    letterbox -> NCHW float32 -> model -> (B, 4 + số class, số anchor) -> lọc conf/class -> NMS theo class.
+    """
+
+    def __init__(self, imgsz: int = 640, iou_thres: float = 0.7, max_det: int = 300):
+        self.imgsz = imgsz
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.dynamic_batch = False
+        self.dynamic_shape = False
+        self._warned_imgsz = False
+
+    @abc.abstractmethod
+    def _infer(self, blob: np.ndarray) -> np.ndarray:
+        """Chạy model trên blob NCHW float32, trả về output thô (B, 4 + số class, số anchor)."""
+
+    @property
+    def dynamic_imgsz(self) -> bool:
+        return self.dynamic_shape
+
+    def _set_input_shape(self, height, width):
+        """Model kích thước cố định: imgsz thật là kích thước input lúc export, không phải tham số imgsz."""
+        if not self.dynamic_shape:
+            self.imgsz = int(max(height, width))
+
+    def predict(self, frames, conf, classes, imgsz):
+        if not frames:
+            return []
+        # Model kích thước cố định chỉ nhận đúng imgsz lúc export
+        if not self.dynamic_shape and imgsz != self.imgsz and not self._warned_imgsz:
+            self._warned_imgsz = True
+            logger.warning("Model %s có kích thước input cố định %d, bỏ qua imgsz=%d "
+                           "(export lại với dynamic=True để đổi imgsz)", self.name, self.imgsz, imgsz)
+        rect = self.dynamic_shape and len({f.shape for f in frames}) == 1
+        prepared = [letterbox(f, imgsz if self.dynamic_shape else self.imgsz, rect) for f in frames]
+        # BGR HWC uint8 -> RGB NCHW float32 [0, 1]
+        blob = np.stack([p[0] for p in prepared])[..., ::-1].transpose(0, 3, 1, 2)
+        blob = np.ascontiguousarray(blob, dtype=np.float32) / 255.0
+        if self.dynamic_batch:
+            outputs = self._infer(blob)
+        else:
+            outputs = np.concatenate([self._infer(blob[i:i + 1]) for i in range(len(frames))])
+        class_filter = None if classes is None else np.asarray(list(classes))
+        return [self._postprocess(out, frame.shape, ratio, pad, conf, class_filter)
+                for out, frame, (_, ratio, pad) in zip(outputs, frames, prepared)]
+
+    def _postprocess(self, pred: np.ndarray, shape, ratio: float, pad, conf: float,
+                     class_filter: Optional[np.ndarray]) -> np.ndarray:
+        pred = pred.T                                   # (anchors, 4 + nc)
+        scores = pred[:, 4:]
+        cls = scores.argmax(1)
+        best = scores[np.arange(len(scores)), cls]
+        keep = best > conf
+        if class_filter is not None:
+            keep &= np.isin(cls, class_filter)
+        if not keep.any():
+            return np.empty((0, 6), dtype=np.float32)
+        xywh, best, cls = pred[keep, :4], best[keep], cls[keep]
+
+        # NMS theo từng class (giống ultralytics agnostic=False)
+        top_left = xywh[:, :2] - xywh[:, 2:] / 2
+        nms_boxes = np.concatenate([top_left, xywh[:, 2:]], axis=1)
+        idx = cv2.dnn.NMSBoxesBatched(nms_boxes.tolist(), best.tolist(), cls.tolist(), conf, self.iou_thres)
+        idx = np.asarray(idx, dtype=int).reshape(-1)
+        idx = idx[np.argsort(-best[idx])][:self.max_det]
+
+        out = np.empty((len(idx), 6), dtype=np.float32)
+        out[:, :2] = top_left[idx]
+        out[:, 2:4] = top_left[idx] + xywh[idx, 2:]
+        # Bỏ pad + scale về frame gốc
+        out[:, [0, 2]] = ((out[:, [0, 2]] - pad[0]) / ratio).clip(0, shape[1])
+        out[:, [1, 3]] = ((out[:, [1, 3]] - pad[1]) / ratio).clip(0, shape[0])
+        out[:, 4] = best[idx]
+        out[:, 5] = cls[idx]
+        return out
+
+
+class OnnxBackend(_ExportedYoloBackend):
+    """Model .onnx chạy bằng ONNX Runtime trên CPU."""
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, imgsz: int = 640, threads: Optional[int] = None, **kwargs):
+        super().__init__(imgsz, **kwargs)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        self.dynamic_shape = not all(isinstance(d, int) for d in model_input.shape[2:])
+        self._set_input_shape(*model_input.shape[2:])
+
+    def _infer(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+
+class OpenVINOBackend(_ExportedYoloBackend):
+    """Model OpenVINO IR (thư mục *_openvino_model do ultralytics export, có thể là INT8)."""
+
+    name = "openvino"
+
+    def __init__(self, model_path: str, imgsz: int = 640, threads: Optional[int] = None, **kwargs):
+        super().__init__(imgsz, **kwargs)
+        import openvino as ov
+
+        if os.path.isdir(model_path):
+            model_path = next(os.path.join(model_path, f) for f in sorted(os.listdir(model_path)) if f.endswith(".xml"))
+        core = ov.Core()
+        model = core.read_model(model_path)
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if threads:
+            config["INFERENCE_NUM_THREADS"] = threads
+        self.compiled = core.compile_model(model, "CPU", config)
+        self.output = self.compiled.output(0)
+        shape = model.input(0).get_partial_shape()
+        self.dynamic_batch = shape[0].is_dynamic
+        self.dynamic_shape = shape[2].is_dynamic or shape[3].is_dynamic
+        if not self.dynamic_shape:
+            self._set_input_shape(shape[2].get_length(), shape[3].get_length())
+
+    def _infer(self, blob):
+        return self.compiled(blob)[self.output]
+
+
+def export_model(weights: str, backend: str, imgsz: int = 640, data: Optional[str] = None) -> str:
+    """
+    Export file .pt sang định dạng của backend (bỏ qua nếu đã có file export cạnh file .pt).
+    openvino-int8 lượng tử hoá bằng NNCF, cần tập ảnh hiệu chỉnh `data` (yaml dataset ultralytics).
+    """
+    stem = os.path.splitext(weights)[0]
+    target = {
+        "onnx": stem + ".onnx",
+        "openvino": stem + "_openvino_model",
+        "openvino-int8": stem + "_int8_openvino_model",
+    }[backend]
+    if os.path.exists(target):
+        return target
+
+    from ultralytics import YOLO
+
+    options = {"imgsz": imgsz, "dynamic": True}
+    if backend == "onnx":
+        options.update(format="onnx", simplify=True)
+    else:
+        options.update(format="openvino", int8=backend == "openvino-int8")
+        if data:
+            options["data"] = data
+    return YOLO(weights).export(**options)
+
+
+def create_backend(backend: str = "torch", weights: str = "YoloWeights/yolov8s.pt", imgsz: int = 640,
+                   threads: Optional[int] = None, data: Optional[str] = None) -> DetectorBackend:
+    """
+    Tạo backend theo tên (xem BACKENDS). `weights` có thể là file .pt (tự export lần đầu)
+    hoặc trực tiếp file .onnx / thư mục OpenVINO đã export.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend phải là một trong {', '.join(BACKENDS)}")
+    if backend == "torch":
+        return UltralyticsBackend(weights, imgsz=imgsz)
+
+    model_path = export_model(weights, backend, imgsz, data) if weights.endswith(".pt") else weights
+    if backend == "onnx":
+        return OnnxBackend(model_path, imgsz=imgsz, threads=threads)
+    return OpenVINOBackend(model_path, imgsz=imgsz, threads=threads)
@@ -0,0 +1,315 @@
+import collections
+import datetime
+import json
+import os
+import threading
+import uuid
+from typing import Callable, Dict, List, Optional
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_crossing_events (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        stream_id VARCHAR(64) NOT NULL,
+        event_time DATETIME(3) NOT NULL,
+        track_id INT NOT NULL,
+        vehicle_class VARCHAR(16) NOT NULL,
+        direction TINYINT NOT NULL,
+        line_name VARCHAR(64) NOT NULL DEFAULT '',
+        INDEX idx_stream_time (stream_id, event_time)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_counts_minute (
+        stream_id VARCHAR(64) NOT NULL,
+        minute_start DATETIME NOT NULL,
+        vehicle_class VARCHAR(16) NOT NULL,
+        direction TINYINT NOT NULL,
+        count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (stream_id, minute_start, vehicle_class, direction),
+        INDEX idx_minute_start (minute_start)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_counts_hour (
+        stream_id VARCHAR(64) NOT NULL,
+        hour_start DATETIME NOT NULL,
+        vehicle_class VARCHAR(16) NOT NULL,
+        direction TINYINT NOT NULL,
+        count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (stream_id, hour_start, vehicle_class, direction),
+        INDEX idx_hour_start (hour_start)
+    )
+    """,
+    # Bảng thống kê theo ngày của phiên bản cũ: không còn được ghi, chỉ được đọc kèm
+    # vehicle_counts_hour (statistics_queries) để giữ lịch sử
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_statistics (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        date_recorded DATE NOT NULL,
+        car_count INT DEFAULT 0,
+        truck_count INT DEFAULT 0,
+        bus_count INT DEFAULT 0,
+        motorcycle_count INT DEFAULT 0,
+        bicycle_count INT DEFAULT 0,
+        total_count INT DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_event_batches (
+        batch_id CHAR(32) PRIMARY KEY,
+        written_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+)
+
+# Nâng cấp bảng đã tạo từ phiên bản cũ; lỗi 1060 (cột đã có) được bỏ qua
+MIGRATIONS = (
+    "ALTER TABLE vehicle_crossing_events ADD COLUMN line_name VARCHAR(64) NOT NULL DEFAULT '' AFTER direction",
+)
+
+
+class CrossingEventLog:
+    """
+    Ghi mọi lần xe qua line vào MySQL theo lô:
+    - record() chỉ thêm sự kiện vào buffer trong RAM (gọi từ thread xử lý frame, không chặn).
+    - 1 thread riêng flush khi buffer đủ batch_size hoặc sau flush_interval giây:
+      INSERT nhiều dòng vào vehicle_crossing_events (kèm tên line) và cộng dồn các bảng gộp
+      theo phút / theo giờ vehicle_counts_minute, vehicle_counts_hour (stream, kỳ, class, hướng),
+      dùng connection pool. Bảng gộp đếm số xe như counts của detector: chỉ lần qua line đầu
+      tiên của mỗi xe (xe qua 2 line vẫn tính 1); số theo từng line lấy từ
+      vehicle_crossing_events.line_name.
+    - Khi DB lỗi, lô sự kiện được ghi nối vào file spool (JSON lines, mỗi lô 1 batch_id) và được
+      gửi lại ở lần flush đầu tiên kết nối được DB, nên không mất dữ liệu khi DB/app bị gián đoạn;
+      lô đã ghi (vehicle_event_batches) không bị ghi lại nếu app tắt trước khi kịp xoá spool.
+    """
+
+    def __init__(
+        self,
+        db_config: Dict,
+        pool_size: int = 2,
+        batch_size: int = 200,
+        flush_interval: float = 2.0,
+        spool_path: str = "Data/event_spool.jsonl",
+    ):
+        self.db_config = db_config
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+
+        self._buffer: List[Dict] = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Gọi sau mỗi lần ghi DB thành công (vd: xoá cache truy vấn thống kê)
+        self.on_written: List[Callable[[], None]] = []
+
+        self.written = 0
+        self.spooled = 0
+        self.last_error: Optional[str] = None
+
+    # ---------- API ----------
+
+    def record(self, event: Dict, stream_id: str = "default"):
+        """Thêm 1 sự kiện crossing (dict từ VehicleDetectionSystem) vào buffer."""
+        row = {
+            "stream_id": stream_id,
+            "timestamp": event["timestamp"],
+            "track_id": int(event["track_id"]),
+            "class": event["class"],
+            "direction": int(event["direction"]),
+            "line": event.get("line", ""),
+            "first": bool(event.get("first", True)),
+        }
+        with self._cond:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Dừng thread flush và ghi nốt phần còn lại trong buffer."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush()
+
+    def ensure_schema(self) -> bool:
+        """
+        Tạo các bảng (nếu chưa có) ngay, không chờ lần ghi sự kiện đầu tiên, để trang thống kê
+        truy vấn được từ lúc khởi động. False nếu chưa kết nối được DB (sẽ thử lại ở lần ghi).
+        """
+        try:
+            self._get_pool()
+            return True
+        except Exception as e:
+            print(f"Lỗi khi tạo bảng trong database: {e}")
+            return False
+
+    def get_stats(self) -> Dict:
+        with self._cond:
+            pending = len(self._buffer)
+        return {
+            "pending": pending,
+            "written": self.written,
+            "spooled": self.spooled,
+            "last_error": self.last_error,
+        }
+
+    # ---------- Flush ----------
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            with self._cond:
+                if len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            self._flush()
+
+    def _flush(self):
+        with self._cond:
+            events, self._buffer = self._buffer, []
+        has_spool = os.path.exists(self.spool_path)
+        if not events and not has_spool:
+            return
+        written = 0
+        try:
+            # Chỉ đọc lại spool khi đã lấy được connection (DB mất lâu thì không đọc file mỗi lần flush)
+            conn = self._get_pool().get_connection()
+            try:
+                if has_spool:
+                    for batch_id, batch in self._read_spool().items():
+                        if self._write(conn, batch, batch_id):
+                            written += len(batch)
+                    os.remove(self.spool_path)
+                if events:
+                    self._write(conn, events)
+                    written += len(events)
+            finally:
+                conn.close()  # trả connection về pool
+        except Exception as e:
+            if str(e) != self.last_error:  # chỉ in 1 lần cho mỗi loại lỗi khi DB mất kết nối lâu
+                print(f"Lỗi khi ghi sự kiện vào database, lưu tạm vào {self.spool_path}: {e}")
+            self.last_error = str(e)
+            self._append_spool(events)
+        else:
+            self.last_error = None
+        self.written += written
+        if written:
+            for callback in self.on_written:
+                callback()
+
+    def _write(self, conn, events: List[Dict], batch_id: Optional[str] = None) -> bool:
+        """
+        Ghi 1 lô sự kiện + cộng dồn bảng gộp trong 1 transaction. Lô đọc lại từ spool có batch_id:
+        batch_id được ghi vào vehicle_event_batches cùng transaction, lô đã có (app tắt sau commit
+        nhưng trước khi xoá spool) thì bỏ qua (trả về False), nên ghi lại spool không bị cộng 2 lần.
+        """
+        rows = []
+        minutes = collections.Counter()
+        hours = collections.Counter()
+        for e in events:
+            t = datetime.datetime.fromtimestamp(e["timestamp"])
+            rows.append((e["stream_id"], t, e["track_id"], e["class"], e["direction"], e.get("line", "")))
+            if not e.get("first", True):
+                continue  # xe đã được tính ở line khác
+            minute = t.replace(second=0, microsecond=0)
+            minutes[(e["stream_id"], minute, e["class"], e["direction"])] += 1
+            hours[(e["stream_id"], minute.replace(minute=0), e["class"], e["direction"])] += 1
+
+        try:
+            cur = conn.cursor()
+            if batch_id is not None:
+                cur.execute("INSERT IGNORE INTO vehicle_event_batches (batch_id) VALUES (%s)", (batch_id,))
+                if cur.rowcount == 0:
+                    conn.rollback()
+                    cur.close()
+                    return False
+            cur.executemany("""
+                INSERT INTO vehicle_crossing_events
+                (stream_id, event_time, track_id, vehicle_class, direction, line_name)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, rows)
+            cur.executemany("""
+                INSERT INTO vehicle_counts_minute
+                (stream_id, minute_start, vehicle_class, direction, count)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+            """, [key + (n,) for key, n in minutes.items()])
+            cur.executemany("""
+                INSERT INTO vehicle_counts_hour
+                (stream_id, hour_start, vehicle_class, direction, count)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+            """, [key + (n,) for key, n in hours.items()])
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.rollback()
+            raise
+        return True
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                from mysql.connector import pooling
+
+                pool = pooling.MySQLConnectionPool(
+                    pool_name="crossing_events", pool_size=self.pool_size, **self.db_config)
+                conn = pool.get_connection()
+                try:
+                    cur = conn.cursor()
+                    for statement in SCHEMA:
+                        cur.execute(statement)
+                    for statement in MIGRATIONS:
+                        try:
+                            cur.execute(statement)
+                        except Exception as e:
+                            if getattr(e, "errno", None) != 1060:
+                                raise
+                    conn.commit()
+                    cur.close()
+                finally:
+                    conn.close()
+                self._pool = pool
+            return self._pool
+
+    # ---------- Spool ----------
+
+    def _append_spool(self, events: List[Dict]):
+        """Ghi nối 1 lô vào spool; mọi dòng của lô mang cùng batch_id (xem _write)."""
+        if not events:
+            return
+        batch_id = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for e in events:
+                f.write(json.dumps(dict(e, batch=batch_id)) + "\n")
+        self.spooled += len(events)
+
+    def _read_spool(self) -> Dict[Optional[str], List[Dict]]:
+        """Các lô trong spool theo thứ tự ghi: {batch_id: [sự kiện]} (spool của phiên bản cũ: batch_id None)."""
+        batches: Dict[Optional[str], List[Dict]] = {}
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # dòng ghi dở khi app bị tắt đột ngột
+                    batches.setdefault(event.pop("batch", None), []).append(event)
+        return batches
@@ -0,0 +1,126 @@
+import collections
+import threading
+from typing import Iterator, Optional
+
+import cv2
+
+from metrics import metrics
+
+MJPEG_BOUNDARY = "frame"
+
+
+class FrameBroadcaster:
+    """
+    Phát frame đã vẽ (annotated) cho nhiều người xem:
+    - publish(frame) không bao giờ chặn pipeline: chỉ ghi đè "frame mới nhất".
+    - 1 thread riêng encode JPEG đúng 1 lần cho mỗi frame rồi đưa vào ring buffer dùng chung,
+      nên chi phí encode không tăng theo số người xem. Không có ai xem thì không encode.
+    - Mỗi viewer đọc ring buffer theo số thứ tự riêng; viewer chậm bị bỏ các frame cũ nhất
+      (nhảy tới frame cũ nhất còn trong ring) thay vì làm chậm người khác.
+    """
+
+    def __init__(self, quality: int = 80, ring_size: int = 8, stream_id: str = "default"):
+        self.quality = int(quality)
+        self._ring = collections.deque(maxlen=max(1, int(ring_size)))  # (seq, jpeg bytes)
+        self._seq = 0
+        self._pending = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._viewers = 0
+        self.encoded = 0
+        self.skipped = 0      # frame publish bị ghi đè trước khi kịp encode
+        self.dropped = 0      # frame viewer chậm bị bỏ qua
+        for reason, fn in (("encode_skipped", lambda: self.skipped), ("slow_viewer", lambda: self.dropped)):
+            metrics.counter("vehicle_dropped_frames_total", "Số frame bị bỏ (theo lý do)",
+                            fn=fn, stream=stream_id, reason=reason)
+        metrics.gauge("vehicle_mjpeg_viewers", "Số người đang xem luồng MJPEG", fn=lambda: self._viewers,
+                      stream=stream_id)
+        self._thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def viewers(self) -> int:
+        return self._viewers
+
+    def wants_frame(self) -> bool:
+        """
+        Có cần frame mới không: có người xem và frame trước đã được encode. Pipeline chỉ vẽ khi
+        True, nên tốc độ vẽ theo tốc độ encode/xem thực tế, không theo FPS của video.
+        """
+        return self._viewers > 0 and self._pending is None
+
+    def publish(self, frame):
+        """Gửi frame mới nhất (không chặn, không copy). Bỏ qua nếu không có ai xem."""
+        if self._viewers == 0 or frame is None:
+            return
+        with self._cond:
+            if self._pending is not None:
+                self.skipped += 1
+            self._pending = frame
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        return {
+            "viewers": self._viewers,
+            "encoded": self.encoded,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+        }
+
+    def _encode_loop(self):
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                frame, self._pending = self._pending, None
+
+            ok, buf = cv2.imencode(".jpg", frame, params)
+            if not ok:
+                continue
+            with self._cond:
+                self._seq += 1
+                self._ring.append((self._seq, buf.tobytes()))
+                self.encoded += 1
+                self._cond.notify_all()
+
+    def frames(self, timeout: Optional[float] = 5.0) -> Iterator[bytes]:
+        """Generator JPEG cho 1 viewer, bắt đầu từ frame mới nhất."""
+        with self._cond:
+            self._viewers += 1
+            next_seq = self._seq + 1 if self._ring else 1
+        try:
+            while True:
+                with self._cond:
+                    while not self._closed and (not self._ring or self._ring[-1][0] < next_seq):
+                        if not self._cond.wait(timeout):
+                            break
+                    if self._closed:
+                        return
+                    if not self._ring or self._ring[-1][0] < next_seq:
+                        continue
+                    oldest = self._ring[0][0]
+                    if next_seq < oldest:
+                        # Viewer chậm: bỏ các frame đã rơi khỏi ring
+                        self.dropped += oldest - next_seq
+                        next_seq = oldest
+                    jpeg = self._ring[next_seq - oldest][1]
+                next_seq += 1
+                yield jpeg
+        finally:
+            with self._cond:
+                self._viewers -= 1
+
+    def mjpeg(self) -> Iterator[bytes]:
+        """Luồng multipart/x-mixed-replace cho thẻ <img>."""
+        for jpeg in self.frames():
+            yield (b"--" + MJPEG_BOUNDARY.encode() + b"\r\n"
+                   b"Content-Type: image/jpeg\r\n"
+                   b"Content-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
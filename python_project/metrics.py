@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Biên bucket (giây) cho latency: từ 50µs (gán class, đếm) tới 10s, dày ở vùng ms
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.025, 0.04, 0.06,
+                   0.1, 0.15, 0.25, 0.4, 0.6, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Histogram bucket cố định như Prometheus: observe() chỉ là 1 bisect + vài phép cộng,
+    đủ rẻ để bật thường xuyên. Quantile (p50/p95/p99) được ước lượng từ bucket.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # bucket cuối là +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, n: int = 1):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += n
+            self.sum += value * n
+            self.count += n
+
+    def quantile(self, q: float) -> float:
+        """Nội suy tuyến tính trong bucket chứa quantile q (0..1)."""
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c > 0:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return self.bounds[-1]
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Counter:
+    """Bộ đếm tăng dần; hoặc đọc giá trị từ fn (vd: counter có sẵn trong object khác)."""
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.fn = fn
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, n: float = 1):
+        with self._lock:
+            self._value += n
+
+    @property
+    def value(self) -> float:
+        return float(self.fn()) if self.fn is not None else self._value
+
+
+class Gauge(Counter):
+    """Giá trị tức thời (số track, độ sâu queue, FPS...)."""
+
+    def set(self, value: float):
+        self._value = value
+
+
+class MetricsRegistry:
+    """
+    Tập metric của process, mỗi metric xác định bởi tên + nhãn (vd: stream, stage).
+    - histogram/counter/gauge: lấy metric (tạo nếu chưa có). Code đo nên giữ object trả về
+      thay vì tra lại mỗi frame.
+    - snapshot(): dict cho Python API; render_prometheus(): text format cho /metrics.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Dict] = {}   # name -> {"type", "help", "series": {labels: metric}}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _get(self, kind: str, name: str, help_text: str, labels: Dict[str, str], factory):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._metrics.setdefault(name, {"type": kind, "help": help_text, "series": {}})
+            metric = family["series"].get(key)
+            if metric is None:
+                metric = family["series"][key] = factory()
+            return metric
+
+    def histogram(self, name: str, help_text: str = "", buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def counter(self, name: str, help_text: str = "", fn: Optional[Callable[[], float]] = None,
+                **labels) -> Counter:
+        metric = self._get("counter", name, help_text, labels, lambda: Counter(fn))
+        if fn is not None:
+            metric.fn = fn  # khởi động lại stream: đọc từ object mới
+        return metric
+
+    def gauge(self, name: str, help_text: str = "", fn: Optional[Callable[[], float]] = None,
+              **labels) -> Gauge:
+        metric = self._get("gauge", name, help_text, labels, lambda: Gauge(fn))
+        if fn is not None:
+            metric.fn = fn
+        return metric
+
+    def remove(self, **labels):
+        """Xoá mọi series có các nhãn này (vd: remove(stream="cam1") khi xoá stream)."""
+        wanted = {(k, str(v)) for k, v in labels.items()}
+        with self._lock:
+            for family in self._metrics.values():
+                for key in [k for k in family["series"] if wanted <= set(k)]:
+                    del family["series"][key]
+
+    def _families(self) -> List[Tuple[str, Dict, List]]:
+        with self._lock:
+            return [(name, family, list(family["series"].items())) for name, family in sorted(self._metrics.items())]
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        result = {}
+        for name, family, series in self._families():
+            rows = []
+            for key, metric in series:
+                row = {"labels": dict(key)}
+                if isinstance(metric, Histogram):
+                    row.update(metric.snapshot())
+                else:
+                    row["value"] = _safe_value(metric)
+                rows.append(row)
+            result[name] = rows
+        return result
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, family, series in self._families():
+            if family["help"]:
+                lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for key, metric in series:
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    with metric._lock:
+                        counts, total, sum_ = list(metric.counts), metric.count, metric.sum
+                    for bound, c in zip(metric.bounds, counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{_labels(key, le=_number(bound))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(key, le='+Inf')} {total}")
+                    lines.append(f"{name}_sum{_labels(key)} {_number(sum_)}")
+                    lines.append(f"{name}_count{_labels(key)} {total}")
+                else:
+                    lines.append(f"{name}{_labels(key)} {_number(_safe_value(metric))}")
+        return "\n".join(lines) + "\n"
+
+
+def _safe_value(metric: Counter) -> float:
+    try:
+        return metric.value
+    except Exception:
+        return float("nan")  # object nguồn đã bị huỷ / lỗi khi đọc, không làm hỏng cả /metrics
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value == value else "NaN"
+
+
+def _labels(key: Tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+# Registry dùng chung cho cả process (GET /metrics)
+metrics = MetricsRegistry()
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from detector_backends import DetectorBackend, create_backend
+
+
+class ModelRegistry:
+    """
+    Nơi duy nhất load model detect trong process:
+    - Load lười (lần đầu get) và giữ lại theo (backend, weights, imgsz), nhiều detector/stream
+      dùng chung 1 instance. Nhiều thread cùng get 1 model thì chỉ 1 thread load, thread khác chờ.
+    - Weights chỉ lấy từ đĩa (đường dẫn truyền vào hoặc cùng tên trong cache_dir), không tải
+      qua mạng, nên khởi động lại service chạy được khi offline.
+    - Chạy warm-up vài lần trên ảnh đen để frame thật đầu tiên không phải chịu chi phí
+      khởi tạo (fuse layer, cấp phát bộ nhớ, tối ưu graph).
+    - Ghi lại thời gian load / warm-up để báo cáo (get_stats).
+    """
+
+    def __init__(self, cache_dir: str = "YoloWeights", warmup_runs: int = 2):
+        self.cache_dir = cache_dir
+        self.warmup_runs = warmup_runs
+        self._models: Dict[Tuple, DetectorBackend] = {}
+        self._stats: Dict[Tuple, Dict] = {}
+        self._locks: Dict[Tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def resolve_weights(self, weights: str) -> str:
+        """Đường dẫn weights trên đĩa; FileNotFoundError nếu không có (không tự tải)."""
+        for path in (weights, os.path.join(self.cache_dir, os.path.basename(weights))):
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(
+            f"Không tìm thấy weights {weights} (đã tìm cả trong {self.cache_dir}/). "
+            f"Hãy đặt file model vào {self.cache_dir}/")
+
+    def get(self, backend: str = "torch", weights: str = "YoloWeights/yolov8s.pt",
+            imgsz: int = 640) -> DetectorBackend:
+        """Model đã load + warm-up; load ở lần gọi đầu tiên."""
+        key = (backend, weights, imgsz)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._models:
+                try:
+                    self._models[key] = self._load(key)
+                except Exception as e:
+                    with self._lock:
+                        self._stats[key] = {"status": "error", "error": str(e)}
+                    raise
+            return self._models[key]
+
+    def preload(self, backend: str = "torch", weights: str = "YoloWeights/yolov8s.pt",
+                imgsz: int = 640) -> threading.Thread:
+        """Load + warm-up ở thread nền (gọi lúc khởi động, không chặn server)."""
+        def run():
+            try:
+                self.get(backend, weights, imgsz)
+            except Exception as e:
+                print(f"Lỗi khi load model {weights} ({backend}): {e}")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def get_stats(self) -> List[Dict]:
+        with self._lock:
+            stats = dict(self._stats)
+        return [dict(backend=k[0], weights=k[1], imgsz=k[2], **v) for k, v in stats.items()]
+
+    def _load(self, key: Tuple) -> DetectorBackend:
+        backend, weights, imgsz = key
+        with self._lock:
+            self._stats[key] = {"status": "loading"}
+        start = time.perf_counter()
+        model = create_backend(backend, self.resolve_weights(weights), imgsz=imgsz)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        for _ in range(self.warmup_runs):
+            model([dummy], conf=0.25)
+        warmup_seconds = time.perf_counter() - start
+
+        print(f"Đã load model {weights} ({backend}) trong {load_seconds:.2f}s, warm-up {warmup_seconds:.2f}s")
+        with self._lock:
+            self._stats[key] = {
+                "status": "ready",
+                "load_seconds": round(load_seconds, 3),
+                "warmup_seconds": round(warmup_seconds, 3),
+                "loaded_at": time.time(),
+            }
+        return model
+
+
+# Registry dùng chung cho cả process
+registry = ModelRegistry()
@@ -0,0 +1,272 @@
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Thứ tự hạ chất lượng (xoay vòng, bỏ qua núm đã chạm giới hạn); nâng lại theo thứ tự ngược
+KNOBS = ("imgsz", "detect_interval", "conf_thres")
+
+
+class QoSBounds(NamedTuple):
+    """Giới hạn mà QoSController được phép hạ tới (cấu hình ban đầu của stream là mức chất lượng cao nhất)."""
+    imgsz_levels: Tuple[int, ...] = (640, 512, 416, 320)
+    max_detect_interval: int = 4
+    max_conf_thres: float = 0.5
+    conf_step: float = 0.05
+
+
+def quality_ladder(imgsz: int, detect_interval: int, conf_thres: float, bounds: QoSBounds) -> List[Dict]:
+    """
+    Các mức chất lượng từ cấu hình ban đầu (mức 0) tới mức thấp nhất trong bounds, mỗi mức chỉ
+    hạ 1 núm 1 bậc so với mức trước (xoay vòng imgsz -> detect_interval -> conf_thres).
+    """
+    steps = {
+        "imgsz": [s for s in sorted(set(bounds.imgsz_levels), reverse=True) if s < imgsz],
+        "detect_interval": list(range(detect_interval + 1, bounds.max_detect_interval + 1)),
+        "conf_thres": [],
+    }
+    conf = conf_thres
+    while conf + bounds.conf_step <= bounds.max_conf_thres + 1e-9:
+        conf = round(conf + bounds.conf_step, 4)
+        steps["conf_thres"].append(conf)
+
+    level = {"imgsz": imgsz, "detect_interval": detect_interval, "conf_thres": conf_thres}
+    ladder = [dict(level)]
+    while any(steps.values()):
+        for knob in KNOBS:
+            if steps[knob]:
+                level[knob] = steps[knob].pop(0)
+                ladder.append(dict(level))
+    return ladder
+
+
+class _QoSStream:
+    """Trạng thái QoS của 1 stream: thang chất lượng, mức hiện tại, số liệu latency lần đo trước."""
+
+    def __init__(self, stream_id: str, detector, pipeline, target_latency: float, bounds: QoSBounds):
+        self.stream_id = stream_id
+        self.detector = detector
+        self.pipeline = pipeline
+        self.target_latency = target_latency
+        # Cấu hình gốc của detector, trả lại nguyên vẹn khi detach (imgsz có thể là None: theo model)
+        self.original = {"imgsz": detector.imgsz, "detect_interval": detector.detect_interval,
+                         "conf_thres": detector.conf_thres}
+        imgsz = detector.imgsz or getattr(detector.model, "imgsz", 640)
+        if not getattr(detector.model, "dynamic_imgsz", True):
+            # Model export kích thước cố định bỏ qua imgsz: chỉ điều chỉnh detect_interval / conf_thres
+            imgsz = detector.model.imgsz
+            bounds = bounds._replace(imgsz_levels=())
+        self.ladder = quality_ladder(imgsz, detector.detect_interval, detector.conf_thres, bounds)
+        self.level = 0
+        self.latency: Optional[float] = None  # latency đầu-cuối lớn nhất của lần đo gần nhất (giây)
+        self.hold = 0  # số lần đo còn phải chờ trước khi được nâng chất lượng
+        self.settle = 0  # số lần đo bỏ qua sau khi đổi mức (frame cũ trong queue còn chạy theo mức cũ)
+
+        labels = {"stream": stream_id}
+        metrics.gauge("vehicle_qos_level", "Mức hạ chất lượng hiện tại (0 = cấu hình ban đầu)",
+                      fn=lambda: self.level, **labels)
+        for knob in KNOBS:
+            metrics.gauge(f"vehicle_qos_{knob}", f"Giá trị {knob} QoSController đang dùng",
+                          fn=lambda knob=knob: self.ladder[self.level][knob], **labels)
+        self.adjustments = {
+            direction: metrics.counter("vehicle_qos_adjustments_total", "Số lần QoSController đổi mức chất lượng",
+                                       direction=direction, **labels)
+            for direction in ("degrade", "upgrade")
+        }
+
+    def measure(self, interval: float) -> Optional[float]:
+        """
+        Latency lớn nhất của các frame xong từ lần đo trước: với detect_interval > 1 trung bình bị
+        các frame chỉ predict (gần như 0 ms) kéo xuống, còn keyframe mới là phần chậm.
+        Không frame nào xong mà vẫn có frame đang chờ: nghẽn, coi latency ít nhất bằng interval.
+        None nếu không có frame nào (chưa chạy, nguồn đang kết nối lại...).
+        """
+        window = self.pipeline.take_latency_window()
+        if window.count:
+            return window.max_time
+        if self.pipeline.frames_in_flight() > 0:
+            return max(interval, self.latency or 0.0)
+        return None
+
+    def apply(self, level: int):
+        settings = self.ladder[level]
+        self.detector.imgsz = settings["imgsz"]
+        self.detector.detect_interval = settings["detect_interval"]
+        self.detector.conf_thres = settings["conf_thres"]
+        self.level = level
+
+    def restore(self):
+        """Trả detector về đúng cấu hình lúc attach."""
+        for knob, value in self.original.items():
+            setattr(self.detector, knob, value)
+        self.level = 0
+
+
+class ProcessCPU:
+    """Tỉ lệ CPU process dùng từ lần gọi trước (0..1, chia cho số core), không cần psutil."""
+
+    def __init__(self):
+        self.cores = os.cpu_count() or 1
+        self._cpu = time.process_time()
+        self._wall = time.monotonic()
+
+    def __call__(self) -> float:
+        cpu, wall = time.process_time(), time.monotonic()
+        used = (cpu - self._cpu) / max(1e-9, (wall - self._wall) * self.cores)
+        self._cpu, self._wall = cpu, wall
+        return min(1.0, used)
+
+
+class QoSController:
+    """
+    Giữ latency đầu-cuối của từng stream quanh target_latency khi tải tăng (thêm camera, đông xe)
+    bằng cách đổi imgsz, detect_interval và conf_thres của detector trong giới hạn bounds, thay vì
+    để pipeline trễ dần:
+    - Mỗi `interval` giây đo latency lớn nhất của các frame vừa xong và CPU của process.
+    - Latency > target * (1 + tolerance), hoặc stream đang đứng (không xong frame nào): hạ chất lượng,
+      càng vượt target càng hạ nhiều mức 1 lần (tối đa max_step). CPU >= cpu_high: hạ 1 mức cho
+      stream có latency / target lớn nhất.
+    - Latency < target * upgrade_ratio và CPU < cpu_low trong hold_checks lần đo liên tiếp: nâng 1 mức.
+    - Mỗi lần đổi mức được ghi qua logging (logger "qos_controller", mức INFO) và lưu vào history
+      (xem get_stats), metric vehicle_qos_*.
+    Dành cho nguồn chạy theo thời gian thực (camera, live_rate); video offline chạy nhanh nhất có thể
+    nên queue luôn đầy và latency không phản ánh tải.
+    """
+
+    def __init__(self, target_latency: float = 0.25, bounds: QoSBounds = QoSBounds(), interval: float = 1.0,
+                 tolerance: float = 0.1, upgrade_ratio: float = 0.6, cpu_high: float = 0.9, cpu_low: float = 0.7,
+                 hold_checks: int = 3, max_step: int = 3, cpu_usage: Optional[Callable[[], float]] = None):
+        self.target_latency = target_latency
+        self.bounds = bounds
+        self.interval = interval
+        self.tolerance = tolerance
+        self.upgrade_ratio = upgrade_ratio
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.hold_checks = max(1, int(hold_checks))
+        self.max_step = max(1, int(max_step))
+        self.cpu_usage = cpu_usage if cpu_usage is not None else ProcessCPU()
+        self.cpu = 0.0
+        self.history: collections.deque = collections.deque(maxlen=100)
+        self._streams: Dict[str, _QoSStream] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def attach(self, stream_id: str, detector, pipeline, target_latency: Optional[float] = None):
+        """Đưa 1 stream vào điều khiển; cấu hình hiện tại của detector là mức chất lượng cao nhất."""
+        self.detach(stream_id)
+        stream = _QoSStream(stream_id, detector, pipeline, target_latency or self.target_latency, self.bounds)
+        with self._lock:
+            self._streams[stream_id] = stream
+        self.start()
+
+    def detach(self, stream_id: str):
+        """Bỏ điều khiển 1 stream và trả detector về cấu hình ban đầu."""
+        with self._lock:
+            stream = self._streams.pop(stream_id, None)
+        if stream is not None:
+            stream.restore()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            streams = list(self._streams.values())
+        return {
+            "cpu": self.cpu,
+            "streams": {
+                s.stream_id: {
+                    "target_ms": 1000.0 * s.target_latency,
+                    "latency_ms": 1000.0 * s.latency if s.latency is not None else None,
+                    "level": s.level,
+                    "max_level": len(s.ladder) - 1,
+                    "settings": dict(s.ladder[s.level]),
+                }
+                for s in streams
+            },
+            "history": list(self.history),
+        }
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                print(f"Lỗi trong QoSController: {e}")
+
+    def step(self) -> List[Dict]:
+        """1 lần đo + điều chỉnh (thread của controller gọi mỗi interval giây); trả về các lần đổi mức."""
+        self.cpu = self.cpu_usage()
+        with self._lock:
+            streams = [s for s in self._streams.values() if s.pipeline.is_running()]
+        changes = []
+        worst, worst_ratio = None, 0.0
+        for s in streams:
+            latency = s.measure(self.interval)
+            if s.settle > 0:
+                s.settle -= 1
+                continue
+            s.latency = latency
+            if latency is None:
+                continue
+            ratio = latency / s.target_latency
+            if ratio > 1 + self.tolerance:
+                step = min(self.max_step, int(ratio))
+                changes += self._change(s, s.level + step, "latency")
+                continue
+            if ratio > worst_ratio:
+                worst, worst_ratio = s, ratio
+            if ratio < self.upgrade_ratio and self.cpu < self.cpu_low:
+                s.hold -= 1
+                if s.hold <= 0:
+                    changes += self._change(s, s.level - 1, "headroom")
+            else:
+                s.hold = self.hold_checks
+        if self.cpu >= self.cpu_high and worst is not None and not changes:
+            changes += self._change(worst, worst.level + 1, "cpu")
+        return changes
+
+    def _change(self, s: _QoSStream, level: int, reason: str) -> List[Dict]:
+        level = min(max(level, 0), len(s.ladder) - 1)
+        s.hold = self.hold_checks
+        if level == s.level:
+            return []
+        s.settle = 1
+        old = s.ladder[s.level]
+        direction = "degrade" if level > s.level else "upgrade"
+        s.apply(level)
+        new = s.ladder[level]
+        change = {
+            "time": time.time(),
+            "stream_id": s.stream_id,
+            "direction": direction,
+            "reason": reason,
+            "level": level,
+            "latency_ms": 1000.0 * s.latency if s.latency is not None else None,
+            "target_ms": 1000.0 * s.target_latency,
+            "cpu": self.cpu,
+            "settings": dict(new),
+        }
+        self.history.append(change)
+        s.adjustments[direction].inc()
+        diff = ", ".join(f"{k} {old[k]} -> {new[k]}" for k in KNOBS if old[k] != new[k])
+        logger.info("QoS [%s] %s chất lượng (mức %d, %s): %s; latency %.0f ms / mục tiêu %.0f ms, CPU %.0f%%",
+                    s.stream_id, "hạ" if direction == "degrade" else "nâng", level, reason, diff,
+                    change["latency_ms"] or 0, change["target_ms"], 100 * self.cpu)
+        return [change]
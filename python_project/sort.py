@@ -30,6 +30,8 @@ import glob
 import time
 import argparse
 from filterpy.kalman import KalmanFilter
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 np.random.seed(0)
 
@@ -98,9 +100,10 @@ class KalmanBoxTracker(object):
     """
     count = 0
 
-    def __init__(self, bbox):
+    def __init__(self, bbox, track_id=None):
         """
         Initialises a tracker using initial bounding box.
+        track_id defaults to the next value of the class-wide KalmanBoxTracker.count.
         """
         # define constant velocity model
         self.kf = KalmanFilter(dim_x=7, dim_z=4)
@@ -118,12 +121,15 @@ class KalmanBoxTracker(object):
 
         self.kf.x[:4] = convert_bbox_to_z(bbox)
         self.time_since_update = 0
-        self.id = KalmanBoxTracker.count
-        KalmanBoxTracker.count += 1
+        if track_id is None:
+            track_id = KalmanBoxTracker.count
+            KalmanBoxTracker.count += 1
+        self.id = track_id
         self.history = []
         self.hits = 0
         self.hit_streak = 0
         self.age = 0
+        self.det_idx = -1  # index of the detection that last updated this tracker in the current frame
 
     def update(self, bbox):
         """
@@ -149,6 +155,16 @@ class KalmanBoxTracker(object):
         self.history.append(convert_x_to_bbox(self.kf.x))
         return self.history[-1]
 
+    def coast(self):
+        """
+        Advances the state vector by one frame without counting it as a missed detection
+        (used on frames between detection keyframes). Returns the predicted bounding box.
+        """
+        if ((self.kf.x[6] + self.kf.x[2]) <= 0):
+            self.kf.x[6] *= 0.0
+        self.kf.predict()
+        return convert_x_to_bbox(self.kf.x)
+
     def get_state(self):
         """
         Returns the current bounding box estimate.
@@ -156,61 +172,375 @@ class KalmanBoxTracker(object):
         return convert_x_to_bbox(self.kf.x)
 
 
-def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3):
+def convert_bboxes_to_z(bboxes):
+    """
+    Vectorised convert_bbox_to_z: takes an (N,4+) array of [x1,y1,x2,y2,...] boxes and
+      returns an (N,4) array of [x,y,s,r] rows
+    """
+    w = bboxes[:, 2] - bboxes[:, 0]
+    h = bboxes[:, 3] - bboxes[:, 1]
+    x = bboxes[:, 0] + w / 2.
+    y = bboxes[:, 1] + h / 2.
+    s = w * h  # scale is just area
+    r = w / h.astype(float)
+    return np.stack((x, y, s, r), axis=1)
+
+
+def convert_xs_to_bboxes(xs):
+    """
+    Vectorised convert_x_to_bbox: takes an (N,4+) array of [x,y,s,r,...] states and
+      returns an (N,4) array of [x1,y1,x2,y2] boxes
+    """
+    w = np.sqrt(xs[:, 2] * xs[:, 3])
+    h = xs[:, 2] / w
+    return np.stack((xs[:, 0] - w / 2., xs[:, 1] - h / 2., xs[:, 0] + w / 2., xs[:, 1] + h / 2.), axis=1)
+
+
+class KalmanBoxTrackerBank(object):
+    """
+    Struct-of-arrays equivalent of a list of KalmanBoxTracker objects.
+
+    All track states (N,7) and covariances (N,7,7) live in stacked arrays so predict/update
+    run once per frame for every track instead of once per track in Python. The filter
+    maths is the same constant velocity model as KalmanBoxTracker (filterpy's predict and
+    Joseph-form update), so results match the per-object trackers.
+    """
+    F = np.array(
+        [[1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1], [0, 0, 0, 1, 0, 0, 0],
+         [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]], dtype=float)
+    H = np.array(
+        [[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]], dtype=float)
+
+    def __init__(self):
+        self.R = np.eye(4)
+        self.R[2:, 2:] *= 10.
+        self.P0 = np.eye(7)
+        self.P0[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
+        self.P0 *= 10.
+        self.Q = np.eye(7)
+        self.Q[-1, -1] *= 0.01
+        self.Q[4:, 4:] *= 0.01
+
+        self.x = np.zeros((0, 7))
+        self.P = np.zeros((0, 7, 7))
+        self.ids = np.zeros(0, dtype=int)
+        self.time_since_update = np.zeros(0, dtype=int)
+        self.hits = np.zeros(0, dtype=int)
+        self.hit_streak = np.zeros(0, dtype=int)
+        self.age = np.zeros(0, dtype=int)
+        self.det_idx = np.zeros(0, dtype=int)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, bboxes, det_idx=None, ids=None):
+        """
+        Initialises one track per row of bboxes, with the given ids or ids drawn from KalmanBoxTracker.count.
+        det_idx optionally records which detection each new track came from.
+        """
+        n = len(bboxes)
+        if n == 0:
+            return
+        x = np.zeros((n, 7))
+        x[:, :4] = convert_bboxes_to_z(bboxes)
+        if ids is None:
+            ids = np.arange(KalmanBoxTracker.count, KalmanBoxTracker.count + n)
+            KalmanBoxTracker.count += n
+        zeros = np.zeros(n, dtype=int)
+        self.x = np.concatenate((self.x, x))
+        self.P = np.concatenate((self.P, np.broadcast_to(self.P0, (n, 7, 7))))
+        self.ids = np.concatenate((self.ids, ids))
+        self.time_since_update = np.concatenate((self.time_since_update, zeros))
+        self.hits = np.concatenate((self.hits, zeros))
+        self.hit_streak = np.concatenate((self.hit_streak, zeros))
+        self.age = np.concatenate((self.age, zeros))
+        self.det_idx = np.concatenate((self.det_idx, zeros - 1 if det_idx is None else det_idx))
+
+    def keep(self, mask):
+        """
+        Drops every track whose entry in the boolean mask is False, preserving order.
+        """
+        self.x = self.x[mask]
+        self.P = self.P[mask]
+        self.ids = self.ids[mask]
+        self.time_since_update = self.time_since_update[mask]
+        self.hits = self.hits[mask]
+        self.hit_streak = self.hit_streak[mask]
+        self.age = self.age[mask]
+        self.det_idx = self.det_idx[mask]
+
+    def predict(self):
+        """
+        Advances every state vector and returns the (N,4) predicted bounding boxes.
+        """
+        self._advance()
+        self.age += 1
+        self.det_idx[:] = -1
+        self.hit_streak[self.time_since_update > 0] = 0
+        self.time_since_update += 1
+        return self.get_state()
+
+    def coast(self):
+        """
+        Advances every state vector by one frame without touching the track counters
+        and returns the (N,4) predicted bounding boxes.
+        """
+        self._advance()
+        return self.get_state()
+
+    def _advance(self):
+        self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] *= 0.0
+        self.x = self.x @ self.F.T
+        self.P = self.F @ self.P @ self.F.T + self.Q
+
+    def update(self, idx, bboxes, det_idx=None):
+        """
+        Updates the tracks at positions idx with their observed bboxes (one row each).
+        det_idx optionally records which detection updated each track.
+        """
+        if len(idx) == 0:
+            return
+        if det_idx is not None:
+            self.det_idx[idx] = det_idx
+        self.time_since_update[idx] = 0
+        self.hits[idx] += 1
+        self.hit_streak[idx] += 1
+
+        x = self.x[idx]
+        P = self.P[idx]
+        y = convert_bboxes_to_z(bboxes) - x[:, :4]
+        PHT = P @ self.H.T
+        S = self.H @ PHT + self.R
+        K = PHT @ np.linalg.inv(S)
+        x = x + (K @ y[:, :, None])[:, :, 0]
+        I_KH = np.eye(7) - K @ self.H
+        self.x[idx] = x
+        self.P[idx] = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ self.R @ K.transpose(0, 2, 1)
+
+    def get_state(self):
+        """
+        Returns the (N,4) current bounding box estimates.
+        """
+        with np.errstate(invalid='ignore'):
+            return convert_xs_to_bboxes(self.x)
+
+
+def iou_pairs(bb_test, bb_gt):
+    """
+    IOU of bb_test[i] with bb_gt[i] for every row i, the element-wise counterpart of iou_batch
+    (same arithmetic, so the values are identical to the matching iou_batch entries).
+    """
+    xx1 = np.maximum(bb_test[:, 0], bb_gt[:, 0])
+    yy1 = np.maximum(bb_test[:, 1], bb_gt[:, 1])
+    xx2 = np.minimum(bb_test[:, 2], bb_gt[:, 2])
+    yy2 = np.minimum(bb_test[:, 3], bb_gt[:, 3])
+    w = np.maximum(0., xx2 - xx1)
+    h = np.maximum(0., yy2 - yy1)
+    wh = w * h
+    o = wh / ((bb_test[:, 2] - bb_test[:, 0]) * (bb_test[:, 3] - bb_test[:, 1])
+              + (bb_gt[:, 2] - bb_gt[:, 0]) * (bb_gt[:, 3] - bb_gt[:, 1]) - wh)
+    return (o)
+
+
+def gate_pairs(bb_test, bb_gt):
+    """
+    Candidate pairs (i, j) of boxes that may overlap, found with a uniform grid on the box centres
+    instead of scoring all N x M pairs. The cell size is the largest box side, so two overlapping
+    boxes always have centres in the same or neighbouring cells; every pair with IOU > 0 is returned
+    once (plus some non-overlapping neighbours). Returns two index arrays sorted by i.
+    """
+    boxes = np.concatenate((bb_test[:, :4], bb_gt[:, :4]))
+    cell = max(float(np.abs(boxes[:, 2:4] - boxes[:, 0:2]).max()), 1.0)
+    cells = np.floor((boxes[:, 0:2] + boxes[:, 2:4]) / (2.0 * cell)).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # keep neighbour cells (-1 .. +1) non-negative
+    stride = cells[:, 1].max() + 2
+    keys = cells[:, 0] * stride + cells[:, 1]
+    test_keys, gt_keys = keys[:len(bb_test)], keys[len(bb_test):]
+
+    order = np.argsort(gt_keys, kind='stable')
+    sorted_keys = gt_keys[order]
+    # the 3 x 3 neighbouring cells of every test box, looked up in one pass
+    neighbours = (np.array([-1, 0, 1])[:, None] * stride + np.array([-1, 0, 1])[None, :]).ravel()
+    wanted = (test_keys[:, None] + neighbours[None, :]).ravel()
+    start = np.searchsorted(sorted_keys, wanted, side='left')
+    counts = np.searchsorted(sorted_keys, wanted, side='right') - start
+    total = int(counts.sum())
+    # expand each [start, start + count) range into one entry per candidate
+    first = np.repeat(start - np.cumsum(counts) + counts, counts)
+    rows = np.repeat(np.arange(len(wanted)) // len(neighbours), counts)
+    return rows, order[first + np.arange(total)]
+
+
+def _split_matches(matched_indices, iou, n_dets, n_trks, iou_threshold):
+    """
+    Drops the assigned pairs whose IOU is below the threshold and returns
+    (matches sorted by detection, unmatched detections, unmatched trackers) with boolean masks.
+    """
+    matches = matched_indices[iou >= iou_threshold].astype(int)
+    matches = matches[np.argsort(matches[:, 0], kind='stable')]
+    det_free = np.ones(n_dets, dtype=bool)
+    det_free[matches[:, 0]] = False
+    trk_free = np.ones(n_trks, dtype=bool)
+    trk_free[matches[:, 1]] = False
+    return matches, np.flatnonzero(det_free), np.flatnonzero(trk_free)
+
+
+# below this many detection x tracker pairs (about 140 x 140) the dense matrix is cheaper
+# than building the grid and the groups
+GATED_MIN_PAIRS = 20000
+
+
+def associate_detections_to_trackers(detections, trackers, iou_threshold=0.3, gated=None):
     """
     Assigns detections to tracked object (both represented as bounding boxes)
 
-    Returns 3 lists of matches, unmatched_detections and unmatched_trackers
+    gated - score only the pairs found by gate_pairs() and solve the assignment separately on every
+            connected group of overlapping boxes instead of one dense IOU matrix and one global
+            linear_assignment. None picks it automatically for large inputs (GATED_MIN_PAIRS).
+            Both ways reach the same total IOU: a maximum-IOU assignment splits into independent
+            ones over the connected groups. When several assignments tie, the chosen pairs may
+            differ. Needs iou_threshold > 0 (the dense path then never keeps an IOU 0 pair);
+            with iou_threshold <= 0 the dense path is always used, since it can keep pairs
+            that do not overlap at all.
+
+    Returns 3 arrays of matches (sorted by detection), unmatched_detections and unmatched_trackers (ascending)
     """
     if (len(trackers) == 0):
         return np.empty((0, 2), dtype=int), np.arange(len(detections)), np.empty((0, 5), dtype=int)
+    if (len(detections) == 0):
+        return np.empty((0, 2), dtype=int), np.empty(0, dtype=int), np.arange(len(trackers))
+    if gated is None:
+        gated = len(detections) * len(trackers) >= GATED_MIN_PAIRS
+    if gated and iou_threshold > 0:
+        return _associate_gated(detections, trackers, iou_threshold)
 
     iou_matrix = iou_batch(detections, trackers)
 
-    if min(iou_matrix.shape) > 0:
-        a = (iou_matrix > iou_threshold).astype(np.int32)
-        if a.sum(1).max() == 1 and a.sum(0).max() == 1:
-            matched_indices = np.stack(np.where(a), axis=1)
-        else:
-            matched_indices = linear_assignment(-iou_matrix)
+    a = (iou_matrix > iou_threshold).astype(np.int32)
+    if a.sum(1).max() == 1 and a.sum(0).max() == 1:
+        matched_indices = np.stack(np.where(a), axis=1)
     else:
-        matched_indices = np.empty(shape=(0, 2))
-
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if (d not in matched_indices[:, 0]):
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if (t not in matched_indices[:, 1]):
-            unmatched_trackers.append(t)
-
-    # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if (iou_matrix[m[0], m[1]] < iou_threshold):
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if (len(matches) == 0):
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
-
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+        matched_indices = linear_assignment(-iou_matrix).reshape(-1, 2)
+
+    iou = iou_matrix[matched_indices[:, 0], matched_indices[:, 1]]
+    return _split_matches(matched_indices, iou, len(detections), len(trackers), iou_threshold)
+
+
+def _associate_gated(detections, trackers, iou_threshold):
+    n_dets, n_trks = len(detections), len(trackers)
+    rows, cols = gate_pairs(detections, trackers)
+    iou = iou_pairs(detections[rows], trackers[cols])
+    overlap = iou > 0
+    rows, cols, iou = rows[overlap], cols[overlap], iou[overlap]
+
+    # same shortcut as the dense path: every box has at most one partner above the threshold
+    above = iou > iou_threshold
+    if above.any() and np.bincount(rows[above]).max() == 1 and np.bincount(cols[above]).max() == 1:
+        matched = np.stack((rows[above], cols[above]), axis=1)
+        return _split_matches(matched, iou[above], n_dets, n_trks, iou_threshold)
+
+    # connected groups of overlapping boxes (detections are nodes 0..D-1, trackers D..D+T-1)
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols + n_dets)), shape=(n_dets + n_trks,) * 2)
+    _, labels = connected_components(graph, directed=False)
+    group = labels[rows]
+    edges = np.bincount(group, minlength=labels.max() + 1)
+
+    # a group made of a single overlapping pair needs no solver
+    single = edges[group] == 1
+    matched = [np.stack((rows[single], cols[single]), axis=1)]
+    matched_iou = [iou[single]]
+
+    # 2 detections x 2 trackers (the usual shape when two vehicles are close): the best of the
+    # two possible pairings, or the solver below when both score the same
+    multi = np.flatnonzero(~single)
+    multi = multi[np.argsort(group[multi], kind='stable')]
+    if len(multi):
+        pairs, pairs_iou, multi = _solve_2x2_groups(rows, cols, iou, multi, group, n_dets, n_trks)
+        matched.append(pairs)
+        matched_iou.append(pairs_iou)
+
+    bounds = np.flatnonzero(np.diff(group[multi])) + 1
+    for edge_idx in np.split(multi, bounds) if len(multi) else []:
+        det_ids, r = np.unique(rows[edge_idx], return_inverse=True)
+        trk_ids, c = np.unique(cols[edge_idx], return_inverse=True)
+        sub = np.zeros((len(det_ids), len(trk_ids)))
+        sub[r, c] = iou[edge_idx]
+        assigned = linear_assignment(-sub).reshape(-1, 2)
+        matched.append(np.stack((det_ids[assigned[:, 0]], trk_ids[assigned[:, 1]]), axis=1))
+        matched_iou.append(sub[assigned[:, 0], assigned[:, 1]])
+
+    return _split_matches(np.concatenate(matched), np.concatenate(matched_iou), n_dets, n_trks, iou_threshold)
+
+
+def _solve_2x2_groups(rows, cols, iou, multi, group, n_dets, n_trks):
+    """
+    Vectorised assignment for every group of exactly 2 detections and 2 trackers.
+    multi holds the edges of all multi-edge groups; returns the chosen pairs, their IOU
+    and the edges of the groups left for the general solver.
+    """
+    g = group[multi]
+    n_groups = g.max() + 1
+    # distinct (group, node) keys, sorted, so the 2 nodes of a group are adjacent and ascending
+    det_keys = np.unique(g * n_dets + rows[multi])
+    trk_keys = np.unique(g * n_trks + cols[multi])
+    is_2x2 = (np.bincount(det_keys // n_dets, minlength=n_groups) == 2) & \
+             (np.bincount(trk_keys // n_trks, minlength=n_groups) == 2)
+    groups = np.flatnonzero(is_2x2)
+    det_of = (det_keys[is_2x2[det_keys // n_dets]] % n_dets).reshape(-1, 2)
+    trk_of = (trk_keys[is_2x2[trk_keys // n_trks]] % n_trks).reshape(-1, 2)
+
+    # IOU matrix of each group: row/column 1 is its second detection/tracker
+    slot = np.full(n_groups, -1)
+    slot[groups] = np.arange(len(groups))
+    edge = multi[is_2x2[g]]
+    k = slot[group[edge]]
+    sub = np.zeros((len(groups), 2, 2))
+    sub[k, (rows[edge] == det_of[k, 1]).astype(int), (cols[edge] == trk_of[k, 1]).astype(int)] = iou[edge]
+
+    diagonal = sub[:, 0, 0] + sub[:, 1, 1]
+    anti = sub[:, 0, 1] + sub[:, 1, 0]
+    decided = diagonal != anti
+    swap = (anti > diagonal)[decided].astype(int)
+    det_of, trk_of, sub = det_of[decided], trk_of[decided], sub[decided]
+    k = np.arange(len(sub))
+    pairs = np.concatenate((np.stack((det_of[:, 0], trk_of[k, swap]), axis=1),
+                            np.stack((det_of[:, 1], trk_of[k, 1 - swap]), axis=1)))
+    pairs_iou = np.concatenate((sub[k, 0, swap], sub[k, 1, 1 - swap]))
+
+    solved = np.zeros(n_groups, dtype=bool)
+    solved[groups[decided]] = True
+    return pairs, pairs_iou, multi[~solved[g]]
 
 
 class Sort(object):
-    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
+    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3, batched=False, gated=None):
         """
         Sets key parameters for SORT
+
+        batched - keep all tracks in one KalmanBoxTrackerBank and predict/update them in
+                  a single vectorised step instead of one KalmanBoxTracker per object
+        gated - passed to associate_detections_to_trackers (None: gated association for crowded frames)
         """
         self.max_age = max_age
         self.min_hits = min_hits
         self.iou_threshold = iou_threshold
-        self.trackers = []
+        self.batched = batched
+        self.gated = gated
+        self.trackers = KalmanBoxTrackerBank() if batched else []
         self.frame_count = 0
+        # ids are numbered per Sort instance, so trackers running in parallel threads
+        # (one per camera) never race on the shared KalmanBoxTracker.count
+        self.next_id = 0
+        # for each row returned by the last update(), the index into dets of its detection
+        self.last_det_indices = np.empty(0, dtype=int)
+        # ids (as returned, i.e. +1) of the trackers deleted by the last update(), so callers
+        # can drop any per-track state they keep
+        self.last_removed_ids = np.empty(0, dtype=int)
+
+    def _new_ids(self, n):
+        ids = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        return ids
 
     def update(self, dets=np.empty((0, 5))):
         """
@@ -218,14 +548,21 @@ class Sort(object):
           dets - a numpy array of detections in the format [[x1,y1,x2,y2,score],[x1,y1,x2,y2,score],...]
         Requires: this method must be called once for each frame even with empty detections (use np.empty((0, 5)) for frames without detections).
         Returns the a similar array, where the last column is the object ID.
+        After the call, last_det_indices[i] is the row of dets that produced returned track i,
+        so per-detection attributes (e.g. class) can be carried over without another matching pass,
+        and last_removed_ids lists the ids of the trackers this call deleted (they never come back).
 
         NOTE: The number of objects returned may differ from the number of detections provided.
         """
         self.frame_count += 1
+        if self.batched:
+            return self._update_batched(dets)
         # get predicted locations from existing trackers.
         trks = np.zeros((len(self.trackers), 5))
         to_del = []
         ret = []
+        det_indices = []
+        removed = []
         for t, trk in enumerate(trks):
             pos = self.trackers[t].predict()[0]
             trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
@@ -233,30 +570,103 @@ class Sort(object):
                 to_del.append(t)
         trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
         for t in reversed(to_del):
-            self.trackers.pop(t)
-        matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.iou_threshold)
+            removed.append(self.trackers.pop(t).id + 1)
+        matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.iou_threshold,
+                                                                                   gated=self.gated)
 
         # update matched trackers with assigned detections
+        for trk in self.trackers:
+            trk.det_idx = -1
         for m in matched:
             self.trackers[m[1]].update(dets[m[0], :])
+            self.trackers[m[1]].det_idx = m[0]
 
         # create and initialise new trackers for unmatched detections
-        for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :])
+        for i, track_id in zip(unmatched_dets, self._new_ids(len(unmatched_dets))):
+            trk = KalmanBoxTracker(dets[i, :], track_id=track_id)
+            trk.det_idx = i
             self.trackers.append(trk)
         i = len(self.trackers)
         for trk in reversed(self.trackers):
             d = trk.get_state()[0]
             if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
                 ret.append(np.concatenate((d, [trk.id + 1])).reshape(1, -1))  # +1 as MOT benchmark requires positive
+                det_indices.append(trk.det_idx)
             i -= 1
             # remove dead tracklet
             if (trk.time_since_update > self.max_age):
-                self.trackers.pop(i)
+                removed.append(self.trackers.pop(i).id + 1)
+        self.last_det_indices = np.array(det_indices, dtype=int)
+        self.last_removed_ids = np.array(removed, dtype=int)
         if (len(ret) > 0):
             return np.concatenate(ret)
         return np.empty((0, 5))
 
+    def predict(self):
+        """
+        Advances every tracker by one frame without detections, for frames between
+        detection keyframes. Unlike update(np.empty((0, 5))) this does not age the
+        trackers, so max_age and min_hits count keyframes only and tracks are not
+        dropped on the skipped frames.
+        Returns the tracks reported by the last update() at their predicted positions,
+        in the same format; last_det_indices is set to -1 for all of them.
+        """
+        if self.batched:
+            bank = self.trackers
+            boxes = bank.coast()[::-1]
+            ids = bank.ids[::-1]
+            show = (bank.time_since_update[::-1] < 1) & (
+                    (bank.hit_streak[::-1] >= self.min_hits) | (self.frame_count <= self.min_hits))
+            show &= ~np.any(np.isnan(boxes), axis=1)
+            ret = np.concatenate((boxes[show], ids[show, None] + 1), axis=1)
+        else:
+            ret = []
+            for trk in self.trackers:
+                d = trk.coast()[0]
+                if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits) \
+                        and not np.any(np.isnan(d)):
+                    ret.append(np.concatenate((d, [trk.id + 1])).reshape(1, -1))
+            ret = np.concatenate(ret[::-1]) if ret else np.empty((0, 5))
+        self.last_det_indices = np.full(len(ret), -1, dtype=int)
+        return ret
+
+    def _update_batched(self, dets):
+        """
+        Same steps as update() on a KalmanBoxTrackerBank, one vectorised call per stage.
+        """
+        bank = self.trackers
+        trks = bank.predict()
+        valid = ~np.any(np.isnan(trks), axis=1)
+        removed = [bank.ids[~valid] + 1]
+        if not valid.all():
+            bank.keep(valid)
+            trks = trks[valid]
+        matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks, self.iou_threshold,
+                                                                                   gated=self.gated)
+
+        # update matched trackers with assigned detections
+        bank.update(matched[:, 1], dets[matched[:, 0]], det_idx=matched[:, 0])
+
+        # create and initialise new trackers for unmatched detections
+        unmatched_dets = unmatched_dets.astype(int)
+        bank.add(dets[unmatched_dets], det_idx=unmatched_dets, ids=self._new_ids(len(unmatched_dets)))
+
+        # output in the same (reversed) order as the per-object path
+        state = bank.get_state()[::-1]
+        ids = bank.ids[::-1]
+        det_idx = bank.det_idx[::-1]
+        show = (bank.time_since_update[::-1] < 1) & (
+                (bank.hit_streak[::-1] >= self.min_hits) | (self.frame_count <= self.min_hits))
+        # remove dead tracklet
+        alive = bank.time_since_update <= self.max_age
+        removed.append(bank.ids[~alive] + 1)
+        bank.keep(alive)
+        self.last_det_indices = det_idx[show]
+        self.last_removed_ids = np.concatenate(removed)
+        if show.any():
+            return np.concatenate((state[show], ids[show, None] + 1), axis=1)  # +1 as MOT benchmark requires positive
+        return np.empty((0, 5))
+
 
 def parse_args():
     """Parse input arguments."""
@@ -272,10 +682,96 @@ def parse_args():
                         help="Minimum number of associated detections before track is initialised.",
                         type=int, default=3)
     parser.add_argument("--iou_threshold", help="Minimum IOU for match.", type=float, default=0.3)
+    parser.add_argument('--batched', dest='batched', help='Use the vectorised KalmanBoxTrackerBank [False]',
+                        action='store_true')
+    parser.add_argument('--check_batched', dest='check_batched',
+                        help='Replay every sequence through both tracker modes and verify they agree [False]',
+                        action='store_true')
+    parser.add_argument('--check_gated', dest='check_gated',
+                        help='Replay every sequence with gated and dense association and verify they agree [False]',
+                        action='store_true')
+    parser.add_argument('--check_synthetic', dest='check_synthetic',
+                        help='Run both checks on generated sequences (no MOT data needed) and exit [False]',
+                        action='store_true')
     args = parser.parse_args()
     return args
 
 
+def replay_sequence(seq_dets, **sort_kwargs):
+    """
+    Runs one MOT det.txt array through a fresh Sort instance and returns the per-frame
+    (tracks, last_det_indices, last_removed_ids) triples.
+    Track ids start from 1 in every Sort instance, so two replays of the same sequence are directly comparable.
+    """
+    mot_tracker = Sort(**sort_kwargs)
+    outputs = []
+    for frame in range(int(seq_dets[:, 0].max())):
+        frame += 1  # detection and frame numbers begin at 1
+        dets = seq_dets[seq_dets[:, 0] == frame, 2:7]
+        dets[:, 2:4] += dets[:, 0:2]  # convert to [x1,y1,w,h] to [x1,y1,x2,y2]
+        outputs.append((mot_tracker.update(dets), mot_tracker.last_det_indices, mot_tracker.last_removed_ids))
+    return outputs
+
+
+def synthetic_sequence(n_objects, n_frames=120, seed=0, miss_rate=0.05, size=(1920, 1080)):
+    """
+    Generates a MOT det.txt style array (frame, -1, x, y, w, h, score) of boxes moving at constant
+    speed with noise, some missed detections and objects that leave the frame and come back at the
+    opposite edge, so tracks are born, coast and die. Used to check the tracker modes without MOT data.
+    """
+    rng = np.random.RandomState(seed)
+    width, height = size
+    wh = rng.uniform(30, 120, (n_objects, 2))
+    xy = rng.uniform(0, 1, (n_objects, 2)) * (np.array(size) - wh)
+    velocity = rng.uniform(-8, 8, (n_objects, 2))
+    rows = []
+    for frame in range(1, n_frames + 1):
+        xy += velocity
+        xy %= np.array([width, height])  # re-enter at the opposite edge
+        seen = rng.uniform(size=n_objects) >= miss_rate
+        noisy = xy[seen] + rng.normal(0, 1.5, (seen.sum(), 2))
+        rows.append(np.column_stack((np.full(seen.sum(), frame), np.full(seen.sum(), -1), noisy, wh[seen],
+                                     rng.uniform(0.3, 1.0, seen.sum()))))
+    return np.concatenate(rows)
+
+
+def check_batched_equivalence(seq_dets, atol=1e-6, **sort_kwargs):
+    """
+    Replays seq_dets through the per-object and the batched Sort and checks that every frame
+    yields the same track ids and detection indices in the same order with boxes equal up to atol,
+    and deletes the same trackers.
+    Returns the largest absolute box difference; raises AssertionError on a mismatch.
+    """
+    reference = replay_sequence(seq_dets, batched=False, **sort_kwargs)
+    batched = replay_sequence(seq_dets, batched=True, **sort_kwargs)
+    return _compare_replays(reference, batched, atol)
+
+
+def _compare_replays(reference, other, atol):
+    max_diff = 0.0
+    for frame, ((a, a_idx, a_rm), (b, b_idx, b_rm)) in enumerate(zip(reference, other), start=1):
+        assert a.shape == b.shape, "frame %d: %d vs %d tracks" % (frame, len(a), len(b))
+        assert np.array_equal(a[:, 4], b[:, 4]), "frame %d: track ids differ" % frame
+        assert np.array_equal(a_idx, b_idx), "frame %d: detection indices differ" % frame
+        assert np.array_equal(np.sort(a_rm), np.sort(b_rm)), "frame %d: removed trackers differ" % frame
+        if len(a):
+            diff = float(np.abs(a[:, :4] - b[:, :4]).max())
+            assert diff <= atol, "frame %d: boxes differ by %g" % (frame, diff)
+            max_diff = max(max_diff, diff)
+    return max_diff
+
+
+def check_gated_equivalence(seq_dets, atol=0.0, **sort_kwargs):
+    """
+    Replays seq_dets through Sort with the gated and with the dense association and checks, like
+    check_batched_equivalence, that both give the same tracks on every frame.
+    Returns the largest absolute box difference; raises AssertionError on a mismatch.
+    """
+    reference = replay_sequence(seq_dets, gated=False, **sort_kwargs)
+    gated = replay_sequence(seq_dets, gated=True, **sort_kwargs)
+    return _compare_replays(reference, gated, atol)
+
+
 if __name__ == '__main__':
     # all train
     args = parse_args()
@@ -293,16 +789,38 @@ if __name__ == '__main__':
         fig = plt.figure()
         ax1 = fig.add_subplot(111, aspect='equal')
 
+    if (args.check_synthetic):
+        # 200 objects -> 40000 pairs, above GATED_MIN_PAIRS, so the automatic choice uses the gated path too
+        for n_objects in (10, 50, 200):
+            for seed in range(3):
+                seq_dets = synthetic_sequence(n_objects, seed=seed)
+                kwargs = dict(max_age=args.max_age, min_hits=args.min_hits, iou_threshold=args.iou_threshold)
+                batched_diff = check_batched_equivalence(seq_dets, **kwargs)
+                gated_diff = check_gated_equivalence(seq_dets, batched=True, **kwargs)
+                print("synthetic n=%d seed=%d: batched max box diff %.2e, gated max box diff %.2e"
+                      % (n_objects, seed, batched_diff, gated_diff))
+        exit()
+
     if not os.path.exists('output'):
         os.makedirs('output')
     pattern = os.path.join(args.seq_path, phase, '*', 'det', 'det.txt')
     for seq_dets_fn in glob.glob(pattern):
         mot_tracker = Sort(max_age=args.max_age,
                            min_hits=args.min_hits,
-                           iou_threshold=args.iou_threshold)  # create instance of the SORT tracker
+                           iou_threshold=args.iou_threshold,
+                           batched=args.batched)  # create instance of the SORT tracker
         seq_dets = np.loadtxt(seq_dets_fn, delimiter=',')
         seq = seq_dets_fn[pattern.find('*'):].split(os.path.sep)[0]
 
+        if (args.check_batched):
+            max_diff = check_batched_equivalence(seq_dets, max_age=args.max_age, min_hits=args.min_hits,
+                                                 iou_threshold=args.iou_threshold)
+            print("%s: batched tracker matches per-object tracker (max box diff %.2e)" % (seq, max_diff))
+        if (args.check_gated):
+            max_diff = check_gated_equivalence(seq_dets, max_age=args.max_age, min_hits=args.min_hits,
+                                               iou_threshold=args.iou_threshold, batched=args.batched)
+            print("%s: gated association matches dense association (max box diff %.2e)" % (seq, max_diff))
+
         with open(os.path.join('output', '%s.txt' % (seq)), 'w') as out_file:
             print("Processing %s." % (seq))
             for frame in range(int(seq_dets[:, 0].max())):
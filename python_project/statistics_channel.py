@@ -0,0 +1,74 @@
+import json
+import threading
+from typing import Dict, Iterator, Optional
+
+
+class StatisticsChannel:
+    """
+    Kênh đẩy thống kê tới trình duyệt bằng Server-Sent Events:
+    - publish(counts) được gọi khi có xe qua line: chỉ lưu bản mới nhất + tăng version (rẻ, không chặn).
+    - Mỗi client chờ tới khi version đổi rồi nhận 1 message gồm counts mới nhất và delta so với
+      lần gửi trước của chính client đó. Nhiều lần qua line dồn lại khi client chưa kịp đọc sẽ
+      gộp thành 1 message (coalescing).
+    """
+
+    def __init__(self, heartbeat: float = 15.0):
+        self.heartbeat = heartbeat
+        self._cond = threading.Condition()
+        self._counts: Dict[str, int] = {}
+        self._version = 0
+        self._closed = False
+        self.clients = 0
+
+    def publish(self, counts: Dict[str, int]):
+        with self._cond:
+            self._counts = dict(counts)
+            self._version += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self._counts)
+
+    def events(self, initial: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """Generator SSE cho 1 client; gửi trạng thái hiện tại ngay khi kết nối."""
+        with self._cond:
+            self.clients += 1
+            counts = dict(initial) if initial is not None else dict(self._counts)
+            seen = self._version
+        try:
+            yield self._format(counts, counts, seen)
+            sent = counts
+            while True:
+                with self._cond:
+                    if self._version == seen and not self._closed:
+                        self._cond.wait(self.heartbeat)
+                    if self._closed:
+                        return
+                    if self._version == seen:
+                        heartbeat = True
+                    else:
+                        heartbeat = False
+                        counts = dict(self._counts)
+                        seen = self._version
+                if heartbeat:
+                    # Comment SSE giữ kết nối (proxy thường cắt kết nối im lặng quá lâu)
+                    yield ": keep-alive\n\n"
+                    continue
+                delta = {k: v - sent.get(k, 0) for k, v in counts.items() if v != sent.get(k, 0)}
+                sent = counts
+                if delta:
+                    yield self._format(counts, delta, seen)
+        finally:
+            with self._cond:
+                self.clients -= 1
+
+    @staticmethod
+    def _format(counts: Dict[str, int], delta: Dict[str, int], version: int) -> str:
+        data = json.dumps({"counts": counts, "delta": delta, "version": version})
+        return f"id: {version}\nevent: counts\ndata: {data}\n\n"
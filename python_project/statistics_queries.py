@@ -0,0 +1,111 @@
+import datetime
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+VEHICLE_CLASSES = ("car", "truck", "bus", "motorcycle", "bicycle")
+
+# Biểu thức SQL gom period_start theo kỳ (dấu % nhân đôi vì query có tham số)
+PERIOD_EXPRESSIONS = {
+    "hour": "DATE_FORMAT(period_start, '%%Y-%%m-%%d %%H:00')",
+    "day": "DATE_FORMAT(period_start, '%%Y-%%m-%%d')",
+    "week": "DATE_FORMAT(DATE_SUB(DATE(period_start), INTERVAL WEEKDAY(period_start) DAY), '%%Y-%%m-%%d')",
+}
+
+# Stream của số liệu cũ trong vehicle_statistics (chỉ có 1 video xử lý tại 1 thời điểm)
+LEGACY_STREAM_ID = "default"
+
+
+def parse_date_range(start_date: Optional[str], end_date: Optional[str],
+                     default_days: int = 30) -> Tuple[datetime.datetime, datetime.datetime]:
+    """
+    Chuyển start_date/end_date dạng YYYY-MM-DD thành khoảng [start, end) theo datetime;
+    end_date được tính trọn ngày. Thiếu tham số thì lấy default_days ngày gần nhất.
+    Sai định dạng -> ValueError.
+    """
+    today = datetime.date.today()
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else today
+    start = (datetime.datetime.strptime(start_date, "%Y-%m-%d").date() if start_date
+             else end - datetime.timedelta(days=default_days - 1))
+    if start > end:
+        raise ValueError("start_date phải trước end_date")
+    return (datetime.datetime.combine(start, datetime.time()),
+            datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()))
+
+
+def build_range_query(group_by: str, stream_id: Optional[str] = None) -> str:
+    """
+    SQL tổng hợp số xe theo kỳ (hour/day/week) từ bảng gộp theo giờ vehicle_counts_hour
+    (được CrossingEventLog cộng dồn khi ghi), nên 1 năm chỉ quét ~8760 giờ mỗi stream.
+    Cộng thêm số liệu của bảng cũ vehicle_statistics (tính vào 00:00 của ngày đó) để lịch sử trước
+    khi có bảng gộp không bị mất; bảng này không còn được ghi thêm. Mỗi lần bấm lưu ở bản cũ ghi 1 ảnh
+    chụp số đếm cộng dồn, nên mỗi ngày chỉ lấy giá trị lớn nhất của từng class (không cộng các lần lưu).
+    """
+    if group_by not in PERIOD_EXPRESSIONS:
+        raise ValueError(f"group_by phải là một trong {', '.join(PERIOD_EXPRESSIONS)}")
+    class_sums = ",\n                   ".join(
+        f"SUM(CASE WHEN vehicle_class = '{c}' THEN count ELSE 0 END) AS {c}" for c in VEHICLE_CLASSES)
+    legacy_columns = ", ".join(f"MAX({c}_count) AS {c}" for c in VEHICLE_CLASSES)
+    stream_filter = "AND stream_id = %s" if stream_id else ""
+    legacy = "" if stream_id not in (None, LEGACY_STREAM_ID) else f"""
+            UNION ALL
+            SELECT CAST(date_recorded AS DATETIME) AS period_start, {legacy_columns}, MAX(total_count) AS total
+            FROM vehicle_statistics
+            WHERE date_recorded >= %s AND date_recorded < %s
+            GROUP BY date_recorded"""
+    return f"""
+        SELECT {PERIOD_EXPRESSIONS[group_by]} AS period,
+               {", ".join(f"SUM({c}) AS {c}" for c in VEHICLE_CLASSES)},
+               SUM(total) AS total
+        FROM (
+            SELECT hour_start AS period_start,
+                   {class_sums},
+                   SUM(count) AS total
+            FROM vehicle_counts_hour
+            WHERE hour_start >= %s AND hour_start < %s {stream_filter}
+            GROUP BY hour_start{legacy}
+        ) AS counts
+        GROUP BY period
+        ORDER BY period
+    """
+
+
+def query_statistics(cursor, start: datetime.datetime, end: datetime.datetime,
+                     group_by: str = "day", stream_id: Optional[str] = None) -> List[Dict]:
+    """Chạy truy vấn tổng hợp, trả về list dict {date, car, ..., total} theo thứ tự thời gian."""
+    params = (start, end, stream_id) if stream_id else (start, end)
+    if stream_id in (None, LEGACY_STREAM_ID):
+        params += (start.date(), end.date())
+    cursor.execute(build_range_query(group_by, stream_id), params)
+    keys = ("date",) + VEHICLE_CLASSES + ("total",)
+    return [dict(zip(keys, (row[0],) + tuple(int(v or 0) for v in row[1:]))) for row in cursor.fetchall()]
+
+
+class StatisticsCache:
+    """
+    Cache kết quả truy vấn thống kê trong process. Bị xoá mỗi khi có dữ liệu mới được ghi
+    (invalidate), ttl chỉ là giới hạn an toàn khi DB được ghi từ process khác.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[tuple, Tuple[float, List[Dict]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, key: tuple, value: List[Dict]):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, *_):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,303 @@
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from frame_broadcaster import FrameBroadcaster
+from metrics import metrics
+from statistics_channel import StatisticsChannel
+from vehicle_detections_system import VehicleDetectionSystem
+from video_pipeline import VideoPipeline
+
+
+class _InferenceRequest:
+    """1 lần gọi detect_batch của 1 stream, chờ scheduler trả kết quả."""
+
+    def __init__(self, frames: List, imgsz: Optional[int] = None, conf: Optional[float] = None):
+        self.frames = frames
+        self.options = (imgsz, conf)
+        self.results: Optional[List] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class SharedInferenceScheduler:
+    """
+    Dùng chung 1 model YOLO cho nhiều camera:
+    - Mỗi stream gọi detect_batch(frames) như bình thường (chặn tới khi có kết quả).
+    - 1 thread duy nhất gom frame của nhiều stream (tối đa max_batch frame, chờ tối đa
+      max_wait giây) rồi gọi model 1 lần, sau đó chia kết quả về lại từng stream.
+    - Stream có imgsz / conf riêng (vd: QoSController đã hạ chất lượng) được gọi model riêng
+      theo từng nhóm cùng (imgsz, conf). Request không ghi imgsz / conf dùng imgsz của model
+      (mặc định 640) và conf_thres lúc tạo scheduler, không đọc imgsz / conf_thres hiện tại của
+      detector dùng chung (QoSController có thể đang điều chỉnh chúng cho stream khác).
+    """
+
+    def __init__(self, detector: VehicleDetectionSystem, max_batch: int = 8, max_wait: float = 0.005):
+        self.detector = detector
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max_wait
+        self.conf_thres = detector.conf_thres
+        self._requests: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.frames = 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Request còn trong queue sẽ không được chạy nữa: trả lỗi để stream đang chờ không bị treo
+        while True:
+            try:
+                req = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            req.error = RuntimeError("SharedInferenceScheduler đã dừng")
+            req.done.set()
+
+    def detect_batch(self, frames: List, imgsz: Optional[int] = None, conf: Optional[float] = None) -> List:
+        """Gửi frame vào batch chung và chờ kết quả; RuntimeError nếu scheduler dừng trước khi chạy xong."""
+        req = _InferenceRequest(frames, imgsz, conf)
+        self._requests.put(req)
+        while not req.done.wait(0.5):
+            if self._stop.is_set() and not req.done.is_set() and (self._thread is None or not self._thread.is_alive()):
+                # Request vào queue sau khi stop() đã dọn queue
+                raise RuntimeError("SharedInferenceScheduler đã dừng")
+        if req.error is not None:
+            raise req.error
+        return req.results
+
+    def get_stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "frames": self.frames,
+            "avg_batch": self.frames / self.batches if self.batches else 0.0,
+            "pending": self._requests.qsize(),
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                pending = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            # Gom thêm request của các stream khác trong khoảng max_wait
+            n_frames = len(pending[0].frames)
+            deadline = time.monotonic() + self.max_wait
+            while n_frames < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(req)
+                n_frames += len(req.frames)
+
+            groups: Dict = {}
+            for req in pending:
+                groups.setdefault(req.options, []).append(req)
+            for (imgsz, conf), group in groups.items():
+                self._run(group, imgsz, conf)
+
+    def _run(self, pending: List[_InferenceRequest], imgsz: Optional[int], conf: Optional[float]):
+        frames = [f for req in pending for f in req.frames]
+        try:
+            if imgsz is None:
+                imgsz = getattr(self.detector.model, "imgsz", 640)
+            results = self.detector.detect_batch(frames, imgsz=imgsz,
+                                                 conf=self.conf_thres if conf is None else conf)
+        except Exception as e:
+            for req in pending:
+                req.error = e
+                req.done.set()
+            return
+
+        self.batches += 1
+        self.frames += len(frames)
+        offset = 0
+        for req in pending:
+            req.results = results[offset:offset + len(req.frames)]
+            offset += len(req.frames)
+            req.done.set()
+
+
+class _Stream:
+    """Trạng thái riêng của 1 camera: tracker, line đếm, số đếm, pipeline, luồng xem và kênh SSE."""
+
+    def __init__(self, stream_id: str, source: str, detector: VehicleDetectionSystem,
+                 pipeline: VideoPipeline, broadcaster: FrameBroadcaster, channel: StatisticsChannel):
+        self.stream_id = stream_id
+        self.source = source
+        self.detector = detector
+        self.pipeline = pipeline
+        self.broadcaster = broadcaster
+        self.channel = channel
+        self.started_at = time.time()
+
+    def is_running(self) -> bool:
+        return self.pipeline.is_running()
+
+    def get_stats(self) -> Dict:
+        return {
+            "stream_id": self.stream_id,
+            "source": self.source,
+            "running": self.is_running(),
+            "counting_line": self.detector.counting_line,
+            "counting_lines": [line._asdict() for line in self.detector.counting.lines],
+            "counts": self.detector.get_current_counts(),
+            "line_counts": self.detector.get_line_counts(),
+            "zone_counts": self.detector.get_zone_counts(),
+            "pipeline": self.pipeline.get_stats(),
+            "broadcast": self.broadcaster.get_stats(),
+            "started_at": self.started_at,
+        }
+
+
+class StreamManager:
+    """
+    Chạy nhiều nguồn video cùng lúc, mỗi stream có VehicleDetectionSystem riêng
+    (tracker/line/counts riêng) nhưng dùng chung model qua SharedInferenceScheduler.
+    Nếu có event_log, mọi lần xe qua line được ghi kèm stream_id.
+    Nếu có qos, stream bật qos_target được QoSController hạ / nâng chất lượng để giữ latency.
+    """
+
+    def __init__(self, shared_detector: VehicleDetectionSystem, max_batch: int = 8, max_wait: float = 0.005,
+                 event_log=None, qos=None):
+        self.shared_detector = shared_detector
+        self.event_log = event_log
+        self.qos = qos
+        self.scheduler = SharedInferenceScheduler(shared_detector, max_batch=max_batch, max_wait=max_wait)
+        self._streams: Dict[str, _Stream] = {}
+        self._lock = threading.Lock()
+
+    def start_stream(self, stream_id: str, source: str, line_start, line_end,
+                     batch_size: int = 1, live_rate: bool = False,
+                     detect_interval: int = 1, adaptive_detection: bool = False,
+                     roi: Optional[Dict] = None, lines: Optional[List] = None,
+                     zones: Optional[List] = None, decode_width: Optional[int] = None,
+                     decode_fps: Optional[float] = None, decoder: str = "auto",
+                     hwaccel: bool = False, live: Optional[bool] = None,
+                     qos_target: Optional[float] = None) -> _Stream:
+        """
+        Bắt đầu xử lý 1 nguồn; lỗi ValueError nếu stream_id đang chạy hoặc trùng stream_id của
+        shared_detector (dành cho luồng xử lý 1 video của app: metric, sự kiện DB và QoS theo id đó).
+        roi: tham số cho VehicleDetectionSystem.set_roi ({"margin": ...} / {"box": ...} / {"polygon": ...}).
+        lines / zones: nhiều line đếm và vùng (xem set_counting_lines / set_zones); không có lines
+        thì đếm theo 1 line line_start-line_end.
+        decode_width / decode_fps / decoder / hwaccel: thu nhỏ và giảm FPS lúc decode (xem VideoSource).
+        live: nguồn camera (RTSP / HTTP / webcam, mặc định tự nhận theo source) hoặc giả lập camera
+        từ file, đọc qua LiveSource (frame mới nhất thắng, tự kết nối lại).
+        qos_target: latency đầu-cuối mục tiêu (giây); có thì QoSController của manager điều chỉnh
+        imgsz / detect_interval / conf_thres của stream (không có thì giữ cố định).
+        """
+        if stream_id == self.shared_detector.stream_id:
+            raise ValueError(f"Stream id {stream_id} đã được dành cho luồng xử lý video chính")
+        # Model dùng chung được load (nếu app chưa preload xong) trước khi giữ lock,
+        # để các request khác tới manager không phải chờ load + warm-up
+        model = self.shared_detector.model
+        with self._lock:
+            current = self._streams.get(stream_id)
+            if current is not None and current.is_running():
+                raise ValueError(f"Stream {stream_id} đang chạy")
+
+            detector = VehicleDetectionSystem(
+                model=model,
+                conf_thres=self.scheduler.conf_thres,
+                detect_interval=detect_interval,
+                adaptive_detection=adaptive_detection,
+                stream_id=stream_id,
+            )
+            if lines:
+                detector.set_counting_lines(lines)
+            else:
+                detector.setup_counting_line(tuple(line_start), tuple(line_end))
+            detector.set_zones(zones or [])
+            detector.set_roi(**(roi or {}))
+            # Giữ broadcaster cũ khi khởi động lại stream để viewer đang xem không bị ngắt
+            broadcaster = current.broadcaster if current is not None else FrameBroadcaster(stream_id=stream_id)
+            channel = current.channel if current is not None else StatisticsChannel()
+            channel.publish(detector.get_current_counts())
+            detector.add_crossing_listener(lambda event: channel.publish(detector.get_current_counts()))
+            if self.event_log is not None:
+                detector.add_crossing_listener(lambda event: self.event_log.record(event, stream_id))
+            pipeline = VideoPipeline(
+                detector,
+                source,
+                batch_size=batch_size,
+                live_rate=live_rate,
+                on_frame=broadcaster.publish,
+                wants_frame=broadcaster.wants_frame,
+                infer=self.scheduler.detect_batch,
+                decode_width=decode_width,
+                decode_fps=decode_fps,
+                decoder=decoder,
+                hwaccel=hwaccel,
+                live=live,
+            )
+            stream = _Stream(stream_id, source, detector, pipeline, broadcaster, channel)
+            self._streams[stream_id] = stream
+            if self.qos is not None:
+                if qos_target:
+                    self.qos.attach(stream_id, detector, pipeline, qos_target)
+                else:
+                    self.qos.detach(stream_id)
+            self.scheduler.start()
+            pipeline.start()
+            return stream
+
+    def stop_stream(self, stream_id: str) -> bool:
+        """Dừng 1 stream (giữ lại số đếm để xem); trả về False nếu không có stream này."""
+        stream = self.get_stream(stream_id)
+        if stream is None:
+            return False
+        stream.pipeline.stop()
+        stream.pipeline.join()
+        return True
+
+    def remove_stream(self, stream_id: str) -> bool:
+        """Dừng và xoá hẳn stream khỏi manager."""
+        stopped = self.stop_stream(stream_id)
+        with self._lock:
+            stream = self._streams.pop(stream_id, None)
+        if stream is not None:
+            if self.qos is not None:
+                self.qos.detach(stream_id)
+            stream.broadcaster.close()
+            stream.channel.close()
+            metrics.remove(stream=stream_id)
+        return stopped
+
+    def stop_all(self):
+        with self._lock:
+            stream_ids = list(self._streams)
+        for stream_id in stream_ids:
+            self.stop_stream(stream_id)
+        self.scheduler.stop()
+
+    def get_stream(self, stream_id: str) -> Optional[_Stream]:
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def get_stats(self, stream_id: str) -> Optional[Dict]:
+        stream = self.get_stream(stream_id)
+        return stream.get_stats() if stream is not None else None
+
+    def list_streams(self) -> List[Dict]:
+        with self._lock:
+            streams = list(self._streams.values())
+        return [
+            {"stream_id": s.stream_id, "source": s.source, "running": s.is_running(),
+             "counts": s.detector.get_current_counts()}
+            for s in streams
+        ]
@@ -1,5 +1,7 @@
 import cv2
-import torch
+
+from model_registry import registry
+from vehicle_detections_system import VehicleDetectionSystem
 
 class VehicleDetector:
     """
@@ -7,42 +9,43 @@ class VehicleDetector:
     Chỉ nhận diện và vẽ bounding box, không đếm người.
     """
 
-    def __init__(self, model_path="yolov8s.pt", device='cpu'):
+    def __init__(self, model_path="YoloWeights/yolov8s.pt", backend="torch"):
         """
-        Khởi tạo mô hình YOLOv8.
+        Khởi tạo mô hình YOLOv8 (lấy từ model_registry: load từ file trên đĩa 1 lần, có warm-up,
+        không tải lại qua mạng mỗi lần khởi động).
         """
-        self.device = device
-        self.model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, force_reload=True).to(device)
-        self.classes_of_interest = ['car', 'truck', 'bus', 'motorcycle', 'bicycle']  # Lọc các class phương tiện
+        self.model = registry.get(backend, model_path)
+        self.class_names = VehicleDetectionSystem.VEHICLE_CLASS_IDS  # Lọc các class phương tiện
+        self.classes_of_interest = list(self.class_names.values())
 
     def process_frame(self, frame):
         """
         Nhận diện phương tiện trên 1 frame và vẽ bounding box.
         """
-        # Chạy mô hình YOLO
-        results = self.model(frame)
-
-        # Lấy kết quả dạng dict
-        detections = results.pandas().xyxy[0]  # x_min, y_min, x_max, y_max, confidence, class, name
+        # Chạy mô hình YOLO: mỗi dòng [x1, y1, x2, y2, conf, class_id]
+        detections = self.model([frame], classes=list(self.class_names))[0]
 
-        for _, row in detections.iterrows():
-            cls_name = row['name']
-            if cls_name in self.classes_of_interest:
-                x1, y1, x2, y2 = int(row['xmin']), int(row['ymin']), int(row['xmax']), int(row['ymax'])
-                confidence = row['confidence']
+        for x1, y1, x2, y2, confidence, cls_id in detections:
+            cls_name = self.class_names[int(cls_id)]
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
 
-                # Vẽ bounding box
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                label = f"{cls_name} {confidence:.2f}"
-                cv2.putText(frame, label, (x1, y1 - 10),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+            # Vẽ bounding box
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            label = f"{cls_name} {confidence:.2f}"
+            cv2.putText(frame, label, (x1, y1 - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
 
         return frame
 
     def predict(self, frame):
         """
         Trả về kết quả detection (không vẽ), dùng cho mục đích khác nếu cần.
+        DataFrame các cột xmin, ymin, xmax, ymax, confidence, class, name.
         """
-        results = self.model(frame)
-        detections = results.pandas().xyxy[0]
-        return detections[detections['name'].isin(self.classes_of_interest)]
+        import pandas as pd
+
+        detections = self.model([frame], classes=list(self.class_names))[0]
+        df = pd.DataFrame(detections, columns=['xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class'])
+        df['class'] = df['class'].astype(int)
+        df['name'] = df['class'].map(self.class_names)
+        return df
@@ -1,173 +1,599 @@
 import os
-from typing import Dict, Tuple, Optional
+import threading
+import time
+from typing import Callable, Dict, List, Tuple, Optional
 
 import cv2
 import numpy as np
-from ultralytics import YOLO
+from counting_zones import DIRECTIONS, CountingLine, CountingZones, Zone
+from metrics import metrics
+from model_registry import registry
 from sort import Sort  # cần có sort.py cùng thư mục, hoặc `pip install sort-tracker`
 
 
+class TrackState:
+    """
+    Trạng thái đếm của 1 track (thay cho các dict/set riêng theo track_id): class, đã được đếm
+    vào tổng chưa, frame cuối cùng còn thấy track và slot của track trong CountingZones (phía so
+    với từng line, trong/ngoài từng vùng). __slots__ để mỗi record nhỏ gọn.
+    """
+
+    __slots__ = ("cls_name", "counted", "last_seen", "slot")
+
+    def __init__(self, frame_index: int, slot: int):
+        self.cls_name: Optional[str] = None
+        self.counted = False
+        self.last_seen = frame_index
+        self.slot = slot
+
+
 class VehicleDetectionSystem:
     """
     Hệ thống nhận diện + tracking + đếm phương tiện qua line sử dụng YOLOv8 + SORT.
     - Map class theo COCO: {1: bicycle, 2: car, 3: motorcycle, 5: bus, 7: truck}
-    - Gán class cho track bằng IoU giữa bbox track và bbox detect của frame hiện tại.
-    - Đếm khi track đi từ 1 phía của line sang phía còn lại (tránh đếm trùng).
+    - Gán class cho track bằng chính detection mà SORT đã ghép (Sort.last_det_indices),
+      không cần ghép IoU lần 2.
+    - Nhiều line đếm (theo làn, theo hướng) và vùng đa giác trên 1 stream: mỗi frame kiểm tra
+      mọi track × mọi line / vùng trong 1 lần tính vector hoá (counting_zones.CountingZones).
+      Đếm khi bước di chuyển của track giữa 2 frame cắt đoạn line (xe nhanh nhảy qua line
+      vẫn được đếm), mỗi track tối đa 1 lần mỗi line; counts là số xe qua ít nhất 1 line.
+    - Trạng thái theo track (TrackState) bị xoá khi SORT xoá tracker đó, hoặc khi track không
+      xuất hiện quá track_ttl frame, nên bộ nhớ không tăng theo thời gian chạy (camera 24/7).
+    - detect_interval=K: chỉ chạy YOLO mỗi K frame (keyframe), các frame giữa chỉ
+      predict bằng Kalman của SORT rồi vẫn kiểm tra crossing. adaptive_detection=True
+      thì detect sớm hơn khi số track thay đổi hoặc có xe sắp chạm line.
+    - Đếm và vẽ là 2 bước tách rời: draw=False (chạy headless / chỉ lấy số liệu) bỏ qua toàn bộ
+      phần vẽ; VideoPipeline lấy render_state() rồi vẽ ở worker riêng, chỉ khi có người xem.
     """
 
     # COCO vehicle classes
     VEHICLE_CLASS_IDS = {1: "bicycle", 2: "car", 3: "motorcycle", 5: "bus", 7: "truck"}
+    # Thứ tự class trong các dict thống kê
+    COUNT_CLASSES = ("car", "truck", "bus", "motorcycle", "bicycle")
 
     def __init__(
         self,
         yolo_weights: str = "YoloWeights/yolov8s.pt",
         conf_thres: float = 0.3,
+        model=None,
+        detect_interval: int = 1,
+        adaptive_detection: bool = False,
+        backend: str = "torch",
+        stream_id: str = "default",
+        track_ttl: int = 900,
+        draw: bool = True,
     ):
-        # Load YOLOv8 (nếu dùng model custom, giữ đúng đường dẫn)
-        self.model = YOLO(yolo_weights)
+        # YOLOv8 được load lười qua model_registry ở lần detect đầu tiên (nếu dùng model custom, giữ đúng đường dẫn).
+        # backend: "torch" (ultralytics) hoặc "onnx" / "openvino" / "openvino-int8" cho máy chỉ có CPU.
+        # Truyền `model` đã load sẵn để nhiều stream dùng chung 1 model.
+        self.yolo_weights = yolo_weights
+        self.backend = backend
+        self._model = model
 
         # SORT tracker
-        self.tracker = Sort()  # có thể truyền max_age, min_hits, iou_threshold nếu cần
+        # batched=True: mọi track được predict/update trong 1 lần tính vector hoá (nhanh khi đông xe)
+        self.tracker = Sort(batched=True)  # có thể truyền max_age, min_hits, iou_threshold nếu cần
 
         # Tham số
         self.conf_thres = conf_thres
-
-        # Line để đếm: ((x1, y1), (x2, y2))
-        self.counting_line: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None
-
-        # Thống kê
-        self.counts: Dict[str, int] = {
-            "car": 0,
-            "truck": 0,
-            "bus": 0,
-            "motorcycle": 0,
-            "bicycle": 0,
-            "total": 0,
+        self.imgsz: Optional[int] = None  # kích thước ảnh đưa vào YOLO, None: theo model
+        self.detect_interval = max(1, int(detect_interval))
+        self.adaptive_detection = adaptive_detection
+
+        # Lịch keyframe: số frame còn lại tới lần detect kế tiếp, cờ ép detect ở frame sau.
+        # Trong VideoPipeline thread infer lập lịch còn thread track đặt cờ -> đọc/ghi cờ dưới lock
+        self._frames_until_detect = 0
+        self._force_detect = False
+        self._schedule_lock = threading.Lock()
+        self._last_keyframe_tracks = 0
+
+        # Các line đếm + vùng và trạng thái của track với chúng (xem set_counting_lines / set_zones)
+        self.counting = CountingZones()
+
+        # Vùng quan tâm (ROI) - chỉ phần này được đưa vào YOLO (xem set_roi)
+        self.roi_box: Optional[Tuple[int, int, int, int]] = None
+        self.roi_polygon: Optional[np.ndarray] = None
+        self.roi_margin: Optional[int] = None
+        self._roi_mask = None  # (bounds, mask) của đa giác, tính lại khi bounds đổi
+
+        # Tỉ lệ kích thước frame nhận được so với video gốc (< 1 khi nguồn thu nhỏ lúc decode,
+        # xem video_source.VideoSource). Line, vùng, ROI và track luôn theo toạ độ video gốc.
+        self.frame_scale = 1.0
+
+        # Thống kê: số xe qua line (mỗi xe 1 lần dù qua nhiều line), theo line + hướng, theo vùng
+        self.counts: Dict[str, int] = self._empty_counts()
+        self.line_counts: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self.zone_counts: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+        # Trạng thái của các track đang sống: class, đã đếm chưa, slot trong self.counting
+        self.tracks: Dict[int, TrackState] = {}
+        # Lưới an toàn: record không được cập nhật quá track_ttl frame thì bị xoá
+        # (bình thường record bị xoá ngay khi SORT xoá tracker)
+        self.track_ttl = max(1, int(track_ttl))
+
+        # Hàm được gọi mỗi khi có xe qua line, nhận 1 dict sự kiện (xem add_crossing_listener)
+        self.crossing_listeners: List[Callable[[Dict], None]] = []
+
+        # Vẽ box/line lên frame trong process_frame / track_and_count (False: chỉ đếm, không đụng tới frame)
+        self.draw = draw
+
+        # Số frame đã xử lý (tính từ 0), dùng để gắn vị trí frame cho sự kiện
+        self.frame_index = -1
+
+        # Track của frame vừa xử lý (Nx5: x1,y1,x2,y2,track_id)
+        self.last_tracks = np.empty((0, 5))
+
+        # Đo thời gian từng bước (GET /metrics), nhãn theo stream
+        self.stream_id = stream_id
+        self._metrics = {
+            stage: metrics.histogram("vehicle_stage_seconds", "Thời gian xử lý mỗi frame theo bước",
+                                     stream=stream_id, stage=stage)
+            for stage in ("detect", "track", "classify", "count", "draw")
         }
+        self._metrics["frames"] = metrics.counter("vehicle_frames_total", "Số frame đã xử lý", stream=stream_id)
+        self._metrics["keyframes"] = metrics.counter("vehicle_keyframes_total", "Số frame chạy YOLO",
+                                                     stream=stream_id)
+        self._metrics["tracks"] = metrics.gauge("vehicle_active_tracks", "Số track đang theo dõi", stream=stream_id)
+        self._metrics["records"] = metrics.gauge("vehicle_track_records", "Số record trạng thái theo track đang giữ",
+                                                 stream=stream_id)
+
+    @property
+    def model(self):
+        """Model detect; lần truy cập đầu tiên sẽ load (và warm-up) từ model_registry."""
+        if self._model is None:
+            self._model = registry.get(self.backend, self.yolo_weights)
+        return self._model
+
+    def load_model(self):
+        """Load trước model (vd: ở thread nền khi khởi động) để frame đầu tiên không phải chờ."""
+        return self.model
 
-        # Track đã đếm
-        self.tracked_ids = set()
+    # ---------- Public API cho Flask ----------
 
-        # Ghi nhớ class cho mỗi track_id
-        self.track_classes: Dict[int, str] = {}
+    @property
+    def counting_line(self) -> Optional[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """Line đếm đầu tiên ((x1, y1), (x2, y2)), None nếu chưa có line."""
+        if not self.counting.lines:
+            return None
+        line = self.counting.lines[0]
+        return line.start, line.end
 
-        # Ghi nhớ phía (sign) của tâm track so với line để phát hiện crossing
-        self.track_last_side: Dict[int, int] = {}
+    def setup_counting_line(self, start: Tuple[int, int], end: Tuple[int, int]):
+        """Thiết lập 1 line đếm duy nhất (thay các line hiện có)."""
+        self.set_counting_lines([{"name": "main", "start": start, "end": end}])
 
-    # ---------- Public API cho Flask ----------
+    def set_counting_lines(self, lines: List):
+        """
+        Thay toàn bộ line đếm. Mỗi line là {"name", "start": [x, y], "end": [x, y]},
+        CountingLine hoặc cặp (start, end) (tự đặt tên line_1, line_2...).
+        Line trùng tên với line cũ giữ số đếm (reset_counts để về 0); lỗi ValueError nếu trùng tên.
+        """
+        parsed = self.parse_lines(lines)
+        names = [line.name for line in parsed]
+        self.counting.set_lines(parsed)
+        self.line_counts = {name: self.line_counts.get(name) or
+                            {label: self._empty_counts() for label in DIRECTIONS.values()} for name in names}
 
-    def setup_counting_line(self, start: Tuple[int, int], end: Tuple[int, int]):
-        """Thiết lập line đếm."""
-        self.counting_line = (start, end)
+    @staticmethod
+    def parse_lines(lines: List) -> List[CountingLine]:
+        """Kiểm tra + chuẩn hoá line đếm như set_counting_lines mà không đổi detector (lỗi ValueError/KeyError/TypeError)."""
+        parsed = []
+        for i, line in enumerate(lines, 1):
+            if isinstance(line, dict):
+                name, start, end = line.get("name") or f"line_{i}", line["start"], line["end"]
+            elif isinstance(line, CountingLine):
+                name, start, end = line
+            else:
+                (start, end), name = line, f"line_{i}"
+            parsed.append(CountingLine(str(name), tuple(int(v) for v in start), tuple(int(v) for v in end)))
+        names = [line.name for line in parsed]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Tên line bị trùng: {names}")
+        return parsed
+
+    def add_counting_line(self, start: Tuple[int, int], end: Tuple[int, int], name: Optional[str] = None):
+        """Thêm 1 line đếm, giữ nguyên các line đã có."""
+        self.set_counting_lines(list(self.counting.lines) +
+                                [{"name": name or f"line_{len(self.counting.lines) + 1}", "start": start, "end": end}])
+
+    def set_zones(self, zones: List):
+        """
+        Thay toàn bộ vùng đếm. Mỗi vùng là {"name", "polygon": [[x, y], ...]} (ít nhất 3 đỉnh)
+        hoặc chỉ list đỉnh (tự đặt tên zone_1, zone_2...). get_zone_counts cho biết số xe đang
+        ở trong vùng (theo class) và số lượt xe đi vào vùng.
+        """
+        parsed = self.parse_zones(zones)
+        names = [zone.name for zone in parsed]
+        self.counting.set_zones(parsed)
+        self.zone_counts = {name: self.zone_counts.get(name) or
+                            {"occupancy": self._empty_counts(), "entered": self._empty_counts()} for name in names}
+
+    @staticmethod
+    def parse_zones(zones: List) -> List[Zone]:
+        """Kiểm tra + chuẩn hoá vùng đếm như set_zones mà không đổi detector."""
+        parsed = []
+        for i, zone in enumerate(zones, 1):
+            if isinstance(zone, dict):
+                name, polygon = zone.get("name") or f"zone_{i}", zone["polygon"]
+            elif isinstance(zone, Zone):
+                name, polygon = zone
+            else:
+                name, polygon = f"zone_{i}", zone
+            polygon = np.asarray(polygon, dtype=np.int32).reshape(-1, 2)
+            if len(polygon) < 3:
+                raise ValueError(f"Vùng {name} cần ít nhất 3 đỉnh")
+            parsed.append(Zone(str(name), polygon))
+        names = [zone.name for zone in parsed]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Tên vùng bị trùng: {names}")
+        return parsed
+
+    def add_zone(self, polygon: List[Tuple[int, int]], name: Optional[str] = None):
+        """Thêm 1 vùng, giữ nguyên các vùng đã có."""
+        self.set_zones(list(self.counting.zones) + [{"name": name or f"zone_{len(self.counting.zones) + 1}",
+                                                      "polygon": polygon}])
+
+    def set_roi(self, box: Optional[Tuple[int, int, int, int]] = None,
+                polygon: Optional[List[Tuple[int, int]]] = None, margin: Optional[int] = None):
+        """
+        Chỉ detect + track trong vùng quan tâm (ROI) thay vì cả frame:
+        - box=(x1, y1, x2, y2): hình chữ nhật cố định
+        - polygon=[(x, y), ...]: đa giác; YOLO chạy trên khung bao, phần ngoài đa giác bị tô xám
+        - margin=m: khung bao của các line đếm + vùng nới thêm m pixel mỗi phía (tự đổi theo line)
+        Không truyền gì: tắt ROI. Toạ độ detection được cộng lại offset nên track/đếm/vẽ
+        vẫn theo toạ độ frame gốc. margin cần đủ lớn để track kịp ổn định trước khi chạm line.
+        """
+        self.roi_box, self.roi_polygon, self.roi_margin = self.parse_roi(box, polygon, margin)
+        self._roi_mask = None
+
+    @staticmethod
+    def parse_roi(box=None, polygon=None, margin=None) -> Tuple:
+        """Kiểm tra + chuẩn hoá tham số của set_roi mà không đổi detector, trả về (box, polygon, margin)."""
+        box = tuple(int(v) for v in box) if box is not None else None
+        polygon = np.asarray(polygon, dtype=np.int32).reshape(-1, 2) if polygon is not None else None
+        margin = int(margin) if margin is not None else None
+        if polygon is not None and box is None:
+            x, y, w, h = cv2.boundingRect(polygon)
+            box = (x, y, x + w, y + h)
+        return box, polygon, margin
+
+    def add_crossing_listener(self, callback: Callable[[Dict], None]):
+        """
+        Đăng ký callback cho mỗi lần đếm 1 xe qua line. Callback chạy ngay trong thread
+        xử lý frame nên phải nhanh (chỉ đẩy vào queue/buffer). Sự kiện có dạng:
+        {"timestamp", "frame", "track_id", "class", "direction" (1/-1: phía của line sau khi qua), "line",
+         "first" (True nếu là lần qua line đầu tiên của xe, tức lần được cộng vào counts)}
+        Xe qua nhiều line thì có 1 sự kiện cho mỗi line.
+        """
+        self.crossing_listeners.append(callback)
 
     def reset_counts(self):
         """Reset thống kê và trạng thái tracking (dùng khi bắt đầu video mới)."""
-        for k in self.counts:
-            self.counts[k] = 0
-        self.tracked_ids.clear()
-        self.track_classes.clear()
-        self.track_last_side.clear()
+        for counts in self._all_counts():
+            for k in counts:
+                counts[k] = 0
+        self.tracks.clear()
+        self.counting.reset()
+        with self._schedule_lock:
+            self._frames_until_detect = 0
+            self._force_detect = False
+        self._last_keyframe_tracks = 0
+        self.frame_index = -1
+        self.last_tracks = np.empty((0, 5))
+
+    def plan_keyframes(self, n: int) -> List[bool]:
+        """
+        Lập lịch cho n frame tiếp theo: True = chạy YOLO, False = chỉ predict bằng SORT.
+        Với adaptive_detection, cờ ép detect (request_keyframe) được đặt trong track_and_count nên chỉ
+        có hiệu lực từ lần lập lịch sau: lịch của frame đã lập không đổi. Trong VideoPipeline các frame
+        đó đang nằm trong queue track, nên keyframe ép chậm nhất queue_size + batch_size frame
+        (camera: queue_size = batch_size, tức tối đa 2 * batch_size frame).
+        """
+        plan = []
+        with self._schedule_lock:
+            for _ in range(n):
+                if self._frames_until_detect <= 0 or self._force_detect:
+                    plan.append(True)
+                    self._frames_until_detect = self.detect_interval - 1
+                    self._force_detect = False
+                else:
+                    plan.append(False)
+                    self._frames_until_detect -= 1
+        return plan
+
+    def request_keyframe(self):
+        """Ép chạy YOLO ở frame được lập lịch kế tiếp (an toàn khi gọi từ thread khác plan_keyframes)."""
+        with self._schedule_lock:
+            self._force_detect = True
 
     def process_frame(self, frame):
         """
         Xử lý 1 frame:
         - YOLO detect (lọc class phương tiện)
         - SORT track
-        - Gán class cho track bằng IoU với detections
+        - Gán class cho track theo detection mà SORT đã ghép
         - Kiểm tra crossing line để đếm
-        - Vẽ kết quả lên frame
+        - Vẽ kết quả lên frame (trừ khi draw=False)
         """
         if frame is None or frame.size == 0:
             return frame
 
-        # 1) YOLO detect (lọc theo class và conf)
+        # 1) YOLO detect (lọc theo class và conf), chỉ trên keyframe
+        results = self.detect_frames([frame])[0] if self.plan_keyframes(1)[0] else None
+        return self.track_and_count(frame, results)
+
+    def process_frames(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Xử lý 1 batch frame liên tiếp:
+        - Gọi YOLO 1 lần cho cả batch (tận dụng vector hoá của CPU/GPU)
+        - Sau đó track + đếm lần lượt theo đúng thứ tự frame, nên kết quả đếm
+          giống hệt gọi process_frame cho từng frame.
+        - Với detect_interval > 1 chỉ các keyframe được đưa vào YOLO.
+        """
+        valid = [i for i, f in enumerate(frames) if f is not None and f.size > 0]
+        if not valid:
+            return list(frames)
+
+        keyframes = [i for i, key in zip(valid, self.plan_keyframes(len(valid))) if key]
+        results_by_frame = dict(zip(keyframes, self.detect_frames([frames[i] for i in keyframes]))) if keyframes else {}
+        processed = list(frames)
+        for i in valid:
+            processed[i] = self.track_and_count(frames[i], results_by_frame.get(i))
+        return processed
+
+    def detect_frames(self, frames: List[np.ndarray], infer: Optional[Callable] = None):
+        """
+        Detect cho các frame của chính detector này: cắt theo ROI rồi gọi `infer`
+        (mặc định detect_batch; StreamManager truyền scheduler dùng chung model).
+        Kết quả theo toạ độ vùng cắt, track_and_count cộng lại offset.
+        Vùng cắt được detect ở cùng tỉ lệ thu nhỏ như cả frame (imgsz nhỏ lại theo kích thước vùng cắt,
+        xem inference_size) thay vì phóng lên imgsz, nên chi phí giảm theo diện tích ROI; imgsz và
+        conf_thres của detector này luôn được truyền cho `infer`.
+        """
+        if not frames:
+            return []
+        start = time.perf_counter()
+        crops = [self.crop_to_roi(f) for f in frames]
+        infer = infer if infer is not None else self.detect_batch
+        results = infer(crops, imgsz=self.inference_size(frames[0], crops[0]), conf=self.conf_thres)
+        # Thời gian YOLO chia đều cho các frame trong batch
+        self._metrics["detect"].observe((time.perf_counter() - start) / len(frames), len(frames))
+        self._metrics["keyframes"].inc(len(frames))
+        return results
+
+    def inference_size(self, frame: np.ndarray, crop: np.ndarray) -> int:
+        """
+        imgsz cho vùng cắt: cùng tỉ lệ thu nhỏ như khi đưa cả frame vào YOLO ở self.imgsz (bội số 32).
+        Model export kích thước cố định (dynamic_imgsz=False) luôn chạy ở imgsz của nó.
+        """
+        if not getattr(self.model, "dynamic_imgsz", True):
+            return self.model.imgsz
+        full_size = self.imgsz or getattr(self.model, "imgsz", 640)
+        if crop is frame:
+            return full_size
+        scale = full_size / max(frame.shape[:2])
+        return min(full_size, max(32, int(np.ceil(max(crop.shape[:2]) * scale / 32)) * 32))
+
+    def crop_to_roi(self, frame: np.ndarray) -> np.ndarray:
+        """Phần frame đưa vào YOLO (view, không copy, trừ khi ROI là đa giác)."""
+        bounds = self._roi_bounds(frame.shape)
+        if bounds is None:
+            return frame
+        x1, y1, x2, y2 = bounds
+        crop = frame[y1:y2, x1:x2]
+        if self.roi_polygon is not None:
+            crop = crop.copy()
+            crop[~self._polygon_mask(bounds)] = 114
+        return crop
+
+    def detect_batch(self, frames: List[np.ndarray], imgsz: Optional[int] = None, conf: Optional[float] = None):
+        """Chạy YOLO cho 1 list frame, trả về list Results theo thứ tự frame (mặc định self.imgsz / self.conf_thres)."""
         # Lưu ý: 'classes' chỉ áp dụng nếu model là COCO. Nếu dùng model custom, bỏ `classes=...`
-        results = self.model(
-            frame,
+        imgsz = imgsz or self.imgsz
+        kwargs = {"imgsz": imgsz} if imgsz else {}
+        return self.model(
+            frames,
             verbose=False,
-            conf=self.conf_thres,
+            conf=self.conf_thres if conf is None else conf,
             classes=list(self.VEHICLE_CLASS_IDS.keys()),
-        )[0]
-
-        det_boxes = []   # [[x1,y1,x2,y2]]
-        det_scores = []  # [conf]
-        det_clsids = []  # [int]
-
-        if results.boxes is not None and len(results.boxes) > 0:
-            for b in results.boxes:
-                # xyxy có shape (1,4) -> lấy hàng đầu
-                x1, y1, x2, y2 = b.xyxy[0].tolist()
-                conf = float(b.conf[0].item())
-                clsid = int(b.cls[0].item())
-                # đảm bảo toạ độ int và trong ảnh
-                det_boxes.append([int(x1), int(y1), int(x2), int(y2)])
-                det_scores.append(conf)
-                det_clsids.append(clsid)
-
-        # 2) SORT update: đầu vào dạng [x1, y1, x2, y2, score]
-        dets_for_sort = []
-        for box, score in zip(det_boxes, det_scores):
-            dets_for_sort.append([box[0], box[1], box[2], box[3], score])
-        dets_for_sort = np.array(dets_for_sort, dtype=float) if dets_for_sort else np.empty((0, 5))
-
-        tracked_objects = self.tracker.update(dets_for_sort)  # Nx5: x1,y1,x2,y2,track_id
-
-        # 3) Gán class cho từng track qua IoU với det boxes
-        #    tracked_objects shape (N,5). Nếu N==0 thì bỏ qua
-        if len(tracked_objects) > 0 and len(det_boxes) > 0:
-            track_boxes = tracked_objects[:, :4]
-            matches = self._match_tracks_to_dets_iou(track_boxes, det_boxes, iou_thres=0.1)
-            # matches: list of (t_idx, d_idx)
-            for t_idx, d_idx in matches:
-                track_id = int(tracked_objects[t_idx, 4])
-                clsid = det_clsids[d_idx]
-                cls_name = self.VEHICLE_CLASS_IDS.get(clsid)
-                if cls_name:
-                    self.track_classes[track_id] = cls_name
-
-        # 4) Vẽ line
-        if self.counting_line:
-            (lx1, ly1), (lx2, ly2) = self.counting_line
-            cv2.line(frame, (lx1, ly1), (lx2, ly2), (0, 0, 255), 2)
-
-        # 5) Xử lý từng track: đếm crossing + vẽ box/label
-        for trk in tracked_objects:
-            x1, y1, x2, y2, tid = trk
-            x1, y1, x2, y2, tid = int(x1), int(y1), int(x2), int(y2), int(tid)
-            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-
-            cls_name = self.track_classes.get(tid, None)
-
-            # Đếm crossing nếu có line & biết class
-            if self.counting_line and cls_name is not None:
-                side = self._point_side_of_line((cx, cy), self.counting_line)
-                last_side = self.track_last_side.get(tid, None)
-
-                if last_side is None:
-                    # Khởi tạo phía ban đầu
-                    self.track_last_side[tid] = side
-                else:
-                    # Khi đổi phía (cross), và chưa đếm cho tid này trước đó → đếm
-                    if side != 0 and last_side != 0 and side != last_side and tid not in self.tracked_ids:
-                        self.tracked_ids.add(tid)
-                        self.counts[cls_name] += 1
-                        self.counts["total"] += 1
-                    # Cập nhật phía hiện tại
-                    self.track_last_side[tid] = side
-
-            # Vẽ box + label
-            color = (0, 255, 0)
+            **kwargs,
+        )
+
+    def track_and_count(self, frame, results, draw: Optional[bool] = None):
+        """
+        Từ kết quả YOLO của 1 frame: SORT track, gán class, đếm crossing và vẽ.
+        results=None (frame không phải keyframe): chỉ predict vị trí track bằng Kalman.
+        draw: vẽ lên frame hay không (mặc định theo self.draw); frame chỉ bị sửa khi vẽ.
+        Thời gian từng bước được ghi vào metrics (stage track / classify / count / draw).
+        """
+        t0 = time.perf_counter()
+        self.frame_index += 1
+        if results is None:
+            tracked_objects = self.tracker.predict()
+            det_clsids = np.empty(0, dtype=int)
+        else:
+            # 2) SORT update: đầu vào dạng [x1, y1, x2, y2, score]
+            dets_for_sort, det_clsids = self._results_to_dets(results)
+            bounds = self._roi_bounds(frame.shape)
+            if bounds is not None:
+                # Toạ độ trong vùng cắt ROI -> toạ độ frame gốc
+                dets_for_sort[:, [0, 2]] += bounds[0]
+                dets_for_sort[:, [1, 3]] += bounds[1]
+            if self.frame_scale != 1.0:
+                dets_for_sort[:, :4] /= self.frame_scale
+
+            tracked_objects = self.tracker.update(dets_for_sort)  # Nx5: x1,y1,x2,y2,track_id
+            # Tracker SORT vừa xoá sẽ không quay lại (id không dùng lại) -> bỏ trạng thái của nó
+            for tid in self.tracker.last_removed_ids.tolist():
+                self._drop_track(tid)
+
+            # Số track đổi so với keyframe trước -> cảnh đang thay đổi, detect sớm
+            if self.adaptive_detection and len(tracked_objects) != self._last_keyframe_tracks:
+                self.request_keyframe()
+            self._last_keyframe_tracks = len(tracked_objects)
+        self.last_tracks = tracked_objects
+        t1 = time.perf_counter()
+
+        # 3) Gán class cho từng track theo detection mà SORT đã ghép với track đó
+        #    last_det_indices[i] = chỉ số trong dets_for_sort của track thứ i
+        for trk, d_idx in zip(tracked_objects, self.tracker.last_det_indices):
+            tid = int(trk[4])
+            state = self.tracks.get(tid)
+            if state is None:
+                state = self.tracks[tid] = TrackState(self.frame_index, self.counting.alloc())
+            else:
+                state.last_seen = self.frame_index
+            if d_idx < 0:
+                continue
+            cls_name = self.VEHICLE_CLASS_IDS.get(det_clsids[d_idx])
+            if cls_name:
+                state.cls_name = cls_name
+        if self.frame_index % self.track_ttl == 0:
+            self._expire_tracks()
+        t2 = time.perf_counter()
+
+        # 4) Đếm crossing
+        self._count_crossings(tracked_objects)
+        t3 = time.perf_counter()
+
+        # 5) Vẽ ROI, line, box/label
+        if self.draw if draw is None else draw:
+            self.draw_annotations(frame, self.render_state(frame.shape))
+            self._metrics["draw"].observe(time.perf_counter() - t3)
+
+        m = self._metrics
+        m["track"].observe(t1 - t0)
+        m["classify"].observe(t2 - t1)
+        m["count"].observe(t3 - t2)
+        m["frames"].inc()
+        m["tracks"].set(len(tracked_objects))
+        m["records"].set(len(self.tracks))
+        return frame
+
+    def _count_crossings(self, tracked_objects: np.ndarray):
+        """
+        Kiểm tra mọi track đã biết class × mọi line / vùng trong 1 lần (CountingZones.update),
+        rồi cộng số đếm và phát sự kiện cho các lần qua line mới.
+        """
+        if not self.counting.lines and not self.counting.zones:
+            return
+        rows, slots, classes = [], [], []
+        for i, tid in enumerate(tracked_objects[:, 4].astype(int).tolist()):
+            state = self.tracks.get(tid)
+            # Chỉ đếm khi đã biết class
+            if state is not None and state.cls_name is not None:
+                rows.append(i)
+                slots.append(state.slot)
+                classes.append(state.cls_name)
+        if not rows:
+            # Không còn track nào đã biết class: các vùng đang trống
+            for zone in self.counting.zones:
+                occupancy = self.zone_counts[zone.name]["occupancy"]
+                occupancy.update(dict.fromkeys(occupancy, 0))
+            return
+        boxes = tracked_objects[rows, :4].astype(int)
+        centers = (boxes[:, :2] + boxes[:, 2:]) // 2
+        slots = np.array(slots)
+        crossed, line_idx, direction, inside, entered = self.counting.update(slots, centers)
+
+        for r, l, d in zip(crossed.tolist(), line_idx.tolist(), direction.tolist()):
+            tid, cls_name = int(tracked_objects[rows[r], 4]), classes[r]
+            line = self.counting.lines[l]
+            line_counts = self.line_counts[line.name][DIRECTIONS[d]]
+            line_counts[cls_name] += 1
+            line_counts["total"] += 1
+            state = self.tracks[tid]
+            first = not state.counted
+            if first:
+                state.counted = True
+                self.counts[cls_name] += 1
+                self.counts["total"] += 1
+            self._emit_crossing(tid, cls_name, d, line.name, first)
+
+        if self.counting.zones:
+            codes = np.array([self.COUNT_CLASSES.index(c) for c in classes])
+            n_classes = len(self.COUNT_CLASSES)
+            for z, zone in enumerate(self.counting.zones):
+                stats = self.zone_counts[zone.name]
+                occupancy = np.bincount(codes[inside[:, z]], minlength=n_classes).tolist()
+                stats["occupancy"].update(zip(self.COUNT_CLASSES, occupancy))
+                stats["occupancy"]["total"] = int(inside[:, z].sum())
+                for cls_name, n in zip(self.COUNT_CLASSES, np.bincount(codes[entered[:, z]], minlength=n_classes)):
+                    stats["entered"][cls_name] += int(n)
+                stats["entered"]["total"] += int(entered[:, z].sum())
+
+        # Xe sắp chạm 1 line chưa đếm nó (cách line < nửa chiều cao box) -> detect ở frame sau
+        if self.adaptive_detection and self.counting.near_uncounted(slots, centers, (boxes[:, 3] - boxes[:, 1]) / 2):
+            self.request_keyframe()
+
+    def render_state(self, shape) -> Dict:
+        """
+        Những gì cần vẽ cho frame vừa xử lý (ROI, line, vùng + số xe trong vùng, box + nhãn track),
+        chụp lại ngay sau track_and_count để worker khác vẽ sau mà không đọc trạng thái đang đổi.
+        """
+        tracks = np.array(self.last_tracks, copy=True)
+        bounds = self._roi_bounds(shape)
+        if bounds is not None and self.frame_scale != 1.0:
+            bounds = tuple(int(round(v / self.frame_scale)) for v in bounds)
+        labels = []
+        for tid in tracks[:, 4].astype(int).tolist():
+            state = self.tracks.get(tid)
+            cls_name = state.cls_name if state is not None else None
+            labels.append(f"{cls_name or 'obj'}-{tid}")
+        return {
+            "tracks": tracks,
+            "labels": labels,
+            "roi_bounds": bounds,
+            "roi_polygon": self.roi_polygon,
+            "lines": list(self.counting.lines),
+            "zones": [(zone.name, zone.polygon, self.zone_counts[zone.name]["occupancy"]["total"])
+                      for zone in self.counting.zones],
+        }
+
+    @staticmethod
+    def draw_annotations(frame, state: Dict, scale: float = 1.0):
+        """Vẽ render_state lên frame; frame đã thu nhỏ theo tỉ lệ scale thì toạ độ được nhân theo."""
+        def pt(p):
+            return int(p[0] * scale), int(p[1] * scale)
+
+        if state["roi_polygon"] is not None:
+            cv2.polylines(frame, [(state["roi_polygon"] * scale).astype(np.int32)], True, (255, 255, 0), 1)
+        elif state["roi_bounds"] is not None:
+            cv2.rectangle(frame, pt(state["roi_bounds"][:2]), pt(state["roi_bounds"][2:]), (255, 255, 0), 1)
+        for name, polygon, occupancy in state["zones"]:
+            cv2.polylines(frame, [(polygon * scale).astype(np.int32)], True, (0, 165, 255), 2)
+            x, y = pt(polygon[0])
+            cv2.putText(frame, f"{name}: {occupancy}", (x, max(0, y - 8)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 165, 255), 2)
+        for line in state["lines"]:
+            cv2.line(frame, pt(line.start), pt(line.end), (0, 0, 255), 2)
+            if len(state["lines"]) > 1:
+                x, y = pt(line.start)
+                cv2.putText(frame, line.name, (x, max(0, y - 8)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+
+        boxes = state["tracks"][:, :4].astype(int)
+        centers = (boxes[:, :2] + boxes[:, 2:]) // 2
+        if scale != 1.0:
+            boxes = (boxes * scale).astype(int)
+            centers = (centers * scale).astype(int)
+        color = (0, 255, 0)
+        for (x1, y1, x2, y2), (cx, cy), label in zip(boxes.tolist(), centers.tolist(), state["labels"]):
             cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            label = f"{cls_name or 'obj'}-{tid}"
             cv2.putText(frame, label, (x1, max(0, y1 - 8)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
             cv2.circle(frame, (cx, cy), 3, (255, 0, 0), -1)
 
-        return frame
-
     def get_current_counts(self) -> Dict[str, int]:
         """Trả về dict thống kê hiện tại."""
         return dict(self.counts)
 
+    def get_line_counts(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Số đếm theo line và hướng: {line: {"positive"/"negative": {class: n, "total": n}}}."""
+        return {name: {label: dict(c) for label, c in by_dir.items()} for name, by_dir in self.line_counts.items()}
+
+    def get_zone_counts(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Theo vùng: {zone: {"occupancy": xe đang trong vùng, "entered": số lượt vào vùng}} theo class."""
+        return {name: {key: dict(c) for key, c in stats.items()} for name, stats in self.zone_counts.items()}
+
     def save_counts_to_file(self, filename: str) -> str:
         """Lưu thống kê vào file txt và trả về đường dẫn."""
         os.makedirs("Data/Example Results", exist_ok=True)
@@ -179,73 +605,87 @@ class VehicleDetectionSystem:
 
     # ---------- Helpers ----------
 
-    @staticmethod
-    def _iou(boxA, boxB) -> float:
-        """
-        IoU của 2 box [x1,y1,x2,y2]
-        """
-        xA = max(boxA[0], boxB[0])
-        yA = max(boxA[1], boxB[1])
-        xB = min(boxA[2], boxB[2])
-        yB = min(boxA[3], boxB[3])
-
-        interW = max(0, xB - xA + 1)
-        interH = max(0, yB - yA + 1)
-        interArea = interW * interH
-
-        if interArea <= 0:
-            return 0.0
-
-        boxAArea = max(0, (boxA[2] - boxA[0] + 1)) * max(0, (boxA[3] - boxA[1] + 1))
-        boxBArea = max(0, (boxB[2] - boxB[0] + 1)) * max(0, (boxB[3] - boxB[1] + 1))
-        iou = interArea / float(boxAArea + boxBArea - interArea + 1e-9)
-        return float(iou)
-
-    def _match_tracks_to_dets_iou(self, track_boxes, det_boxes, iou_thres=0.1):
-        """
-        Ghép mỗi track box với det box có IoU cao nhất (>= iou_thres).
-        Trả về list các cặp (track_idx, det_idx).
-        """
-        matches = []
-        if len(track_boxes) == 0 or len(det_boxes) == 0:
-            return matches
-
-        T = len(track_boxes)
-        D = len(det_boxes)
-
-        used_dets = set()
-        for t_idx in range(T):
-            best_iou = 0.0
-            best_d = -1
-            for d_idx in range(D):
-                if d_idx in used_dets:
-                    continue
-                iou = self._iou(track_boxes[t_idx], det_boxes[d_idx])
-                if iou > best_iou:
-                    best_iou = iou
-                    best_d = d_idx
-            if best_d >= 0 and best_iou >= iou_thres:
-                matches.append((t_idx, best_d))
-                used_dets.add(best_d)
-        return matches
+    def _empty_counts(self) -> Dict[str, int]:
+        counts = {c: 0 for c in self.COUNT_CLASSES}
+        counts["total"] = 0
+        return counts
+
+    def _all_counts(self) -> List[Dict[str, int]]:
+        return ([self.counts] + [c for by_dir in self.line_counts.values() for c in by_dir.values()]
+                + [c for stats in self.zone_counts.values() for c in stats.values()])
+
+    def _drop_track(self, tid: int):
+        state = self.tracks.pop(tid, None)
+        if state is not None:
+            self.counting.free(state.slot)
+
+    def _expire_tracks(self):
+        """Xoá record của track không còn xuất hiện quá track_ttl frame."""
+        oldest = self.frame_index - self.track_ttl
+        for tid in [tid for tid, state in self.tracks.items() if state.last_seen < oldest]:
+            self._drop_track(tid)
+
+    def _emit_crossing(self, track_id: int, cls_name: str, direction: int, line: str, first: bool = True):
+        if not self.crossing_listeners:
+            return
+        event = {"timestamp": time.time(), "frame": self.frame_index, "track_id": track_id,
+                 "class": cls_name, "direction": direction, "line": line, "first": first}
+        for callback in self.crossing_listeners:
+            callback(event)
 
     @staticmethod
-    def _point_side_of_line(p: Tuple[int, int],
-                            line: Tuple[Tuple[int, int], Tuple[int, int]]) -> int:
-        """
-        Xác định phía của điểm p so với line.
-        Trả về:
-          1  : một phía
-         -1  : phía còn lại
-          0  : nằm gần như trên line
-        """
-        (x1, y1), (x2, y2) = line
-        x, y = p
-        # Cross product sign
-        val = (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1)
-        if val > 0:
-            return 1
-        elif val < 0:
-            return -1
+    def _results_to_dets(results) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Đọc kết quả YOLO 1 lần dưới dạng mảng liền (không tạo object cho từng box):
+        trả về dets (N,5) float [x1,y1,x2,y2,score] cho SORT và clsids (N,) int.
+        results là mảng (N,6) của DetectorBackend hoặc Results của ultralytics.
+        """
+        if isinstance(results, np.ndarray):
+            dets = np.empty((len(results), 5))
+            np.trunc(results[:, :4], out=dets[:, :4], casting="unsafe")
+            dets[:, 4] = results[:, 4]
+            return dets, results[:, 5].astype(int)
+
+        boxes = results.boxes
+        if boxes is None or len(boxes) == 0:
+            return np.empty((0, 5)), np.empty(0, dtype=int)
+
+        boxes = boxes.cpu().numpy()
+        dets = np.empty((len(boxes), 5))
+        # toạ độ lấy phần nguyên như trước (int(x))
+        np.trunc(boxes.xyxy, out=dets[:, :4], casting="unsafe")
+        dets[:, 4] = boxes.conf
+        return dets, boxes.cls.astype(int)
+
+    def _roi_bounds(self, shape) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Khung ROI (x1, y1, x2, y2) theo toạ độ frame (đã nhân frame_scale) và cắt theo kích thước
+        frame, None nếu không dùng ROI.
+        """
+        if self.roi_margin is not None and (self.counting.lines or self.counting.zones):
+            points = [p for line in self.counting.lines for p in (line.start, line.end)]
+            points += [tuple(p) for zone in self.counting.zones for p in zone.polygon.tolist()]
+            xs, ys = [p[0] for p in points], [p[1] for p in points]
+            m = self.roi_margin
+            box = (min(xs) - m, min(ys) - m, max(xs) + m, max(ys) + m)
+        elif self.roi_box is not None:
+            box = self.roi_box
         else:
-            return 0
+            return None
+        if self.frame_scale != 1.0:
+            box = tuple(int(round(v * self.frame_scale)) for v in box)
+        h, w = shape[:2]
+        x1, y1, x2, y2 = max(0, box[0]), max(0, box[1]), min(w, box[2]), min(h, box[3])
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return x1, y1, x2, y2
+
+    def _polygon_mask(self, bounds: Tuple[int, int, int, int]) -> np.ndarray:
+        key = (bounds, self.frame_scale)
+        if self._roi_mask is None or self._roi_mask[0] != key:
+            x1, y1, x2, y2 = bounds
+            mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+            polygon = np.round(self.roi_polygon * self.frame_scale).astype(np.int32)
+            cv2.fillPoly(mask, [polygon - (x1, y1)], 1)
+            self._roi_mask = (key, mask.astype(bool))
+        return self._roi_mask[1]
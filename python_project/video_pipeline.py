@@ -0,0 +1,352 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import cv2
+
+from metrics import metrics
+from video_source import LiveSource, VideoSource, is_live_source
+
+# Đánh dấu hết dữ liệu, được chuyền từ stage này sang stage sau
+_END = object()
+
+
+class StageStats:
+    """Thống kê 1 stage: số item, thời gian xử lý (trung bình / lần cuối / max)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, seconds: float, n: int = 1):
+        self.count += n
+        self.total_time += seconds
+        self.last_time = seconds / n
+        self.max_time = max(self.max_time, self.last_time)
+
+    def snapshot(self, in_queue: Optional[queue.Queue] = None) -> Dict:
+        return {
+            "items": self.count,
+            "avg_ms": 1000.0 * self.total_time / self.count if self.count else 0.0,
+            "last_ms": 1000.0 * self.last_time,
+            "max_ms": 1000.0 * self.max_time,
+            "queue_depth": in_queue.qsize() if in_queue is not None else 0,
+            "queue_max": in_queue.maxsize if in_queue is not None else 0,
+        }
+
+
+class VideoPipeline:
+    """
+    Pipeline xử lý video theo stage, mỗi stage 1 thread, nối bằng queue giới hạn:
+        decode -> infer (YOLO theo batch, chỉ keyframe) -> track (SORT + đếm) -> render (tuỳ chọn)
+    - Queue đầy thì stage trước phải chờ (back-pressure), không tốn RAM vô hạn.
+    - Track không vẽ gì lên frame. Render (chỉ có khi truyền on_frame) vẽ box/line lên bản thu nhỏ
+      (rộng tối đa render_width) ở thread riêng, và chỉ khi wants_frame() cho biết đang cần frame
+      (vd: có người xem và frame trước đã encode xong), tối đa render_fps frame/giây.
+      Renderer chậm không làm chậm đếm: queue render chỉ giữ frame mới nhất.
+    - live_rate=True: decoder phát frame đúng FPS của video (mô phỏng camera);
+      mặc định chạy nhanh nhất có thể, không sleep cố định.
+    - live (mặc định: tự nhận theo video_path rtsp:// / http:// / chỉ số webcam): đọc qua LiveSource,
+      frame mới nhất thắng (frame cũ bị bỏ và đếm vào vehicle_dropped_frames_total{reason="stale"}),
+      decode chỉ lấy frame khi infer sẵn sàng nên YOLO luôn chạy trên frame mới nhất, tự kết nối lại
+      khi mất kết nối. live=True với file: giả lập camera (phát đúng FPS, hết file thì phát lại).
+    - Decode qua VideoSource: thread đọc trước vào ring buffer cấp phát sẵn (không tạo mảng mới
+      mỗi frame), decode_width / decode_fps thu nhỏ và giảm FPS ngay lúc decode (decoder="ffmpeg"
+      dùng ffmpeg -vf scale,fps). Buffer được trả về ring khi frame đã đếm (và vẽ) xong.
+    - get_stats() trả về độ sâu queue và latency từng stage để biết stage nào nghẽn.
+    """
+
+    def __init__(
+        self,
+        detector,
+        video_path: str,
+        batch_size: int = 1,
+        queue_size: int = 8,
+        live_rate: bool = False,
+        on_counts: Optional[Callable[[Dict[str, int]], None]] = None,
+        on_frame: Optional[Callable] = None,
+        infer: Optional[Callable] = None,
+        wants_frame: Optional[Callable[[], bool]] = None,
+        render_width: Optional[int] = 960,
+        render_fps: Optional[float] = None,
+        decode_width: Optional[int] = None,
+        decode_fps: Optional[float] = None,
+        decoder: str = "auto",
+        hwaccel: bool = False,
+        live: Optional[bool] = None,
+    ):
+        self.detector = detector
+        # Hàm detect theo batch; mặc định dùng model của detector,
+        # có thể thay bằng scheduler dùng chung giữa nhiều camera
+        self.infer = infer if infer is not None else detector.detect_batch
+        self.video_path = video_path
+        self.batch_size = max(1, int(batch_size))
+        self.live_rate = live_rate
+        self.on_counts = on_counts
+        self.on_frame = on_frame
+        self.wants_frame = wants_frame
+        self.render_width = render_width
+        self._render_interval = 1.0 / render_fps if render_fps else 0.0
+        self._next_render = 0.0
+        self.render_skipped = 0  # frame đã được chọn để vẽ nhưng bị frame mới hơn thay trước khi kịp vẽ
+        self.live = is_live_source(video_path) if live is None else live
+        # Camera: decode chỉ lấy frame khi infer cần (mỗi release = 1 frame), nên frame không nằm chờ
+        # trong queue tới cũ; LiveSource luôn đưa frame mới nhất
+        self._demand = threading.Semaphore(0) if self.live else None
+        if self.live:
+            queue_size = self.batch_size
+        self.source_options = {"width": decode_width, "fps": decode_fps, "decoder": decoder, "hwaccel": hwaccel,
+                               # Đủ buffer cho mọi frame có thể đang nằm trong các queue + batch + stage
+                               "ring_size": 2 * queue_size + self.batch_size + 4}
+        self.source = None
+
+        self._decode_q: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._track_q: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._render_q: Optional[queue.Queue] = queue.Queue(maxsize=1) if on_frame else None
+
+        self._stop = threading.Event()
+        self._threads = []
+        self.error: Optional[Exception] = None
+
+        self.stats = {name: StageStats(name) for name in ("decode", "infer", "track", "render")}
+        self._latency = StageStats("end_to_end")
+        self._latency_window = StageStats("end_to_end")  # từ lần take_latency_window() trước
+        self._started_at = None
+
+        # Metrics cho /metrics (infer/track/... theo bước do detector tự đo)
+        stream = getattr(detector, "stream_id", "default")
+        self._stream = stream
+        self._hist = {
+            "render": metrics.histogram("vehicle_stage_seconds", stream=stream, stage="render"),
+            "end_to_end": metrics.histogram("vehicle_frame_latency_seconds",
+                                            "Thời gian từ lúc decode xong tới khi track + đếm xong", stream=stream),
+        }
+        for name, q in (("infer", self._decode_q), ("track", self._track_q), ("render", self._render_q)):
+            if q is not None:
+                metrics.gauge("vehicle_queue_depth", "Số item đang chờ trong queue đầu vào của stage",
+                              fn=q.qsize, stream=stream, queue=name)
+        metrics.gauge("vehicle_pipeline_fps", "FPS trung bình của pipeline", fn=self._fps, stream=stream)
+        metrics.counter("vehicle_dropped_frames_total", "Số frame bị bỏ (theo lý do)",
+                        fn=lambda: self.render_skipped, stream=stream, reason="render_skipped")
+
+    # ---------- Điều khiển ----------
+
+    def start(self):
+        stages = [self._decode_loop, self._infer_loop, self._track_loop]
+        if self._render_q is not None:
+            stages.append(self._render_loop)
+        self._started_at = time.monotonic()
+        for target in stages:
+            t = threading.Thread(target=self._run_stage, args=(target,), daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        for t in self._threads:
+            t.join(timeout)
+
+    def is_running(self) -> bool:
+        return any(t.is_alive() for t in self._threads)
+
+    def get_stats(self) -> Dict:
+        """Độ sâu queue đầu vào + latency của từng stage, latency đầu-cuối và FPS."""
+        inputs = {"decode": None, "infer": self._decode_q, "track": self._track_q, "render": self._render_q}
+        return {
+            "stages": {name: st.snapshot(inputs[name]) for name, st in self.stats.items()},
+            "end_to_end": self._latency.snapshot(),
+            "fps": self._fps(),
+            "render_skipped": self.render_skipped,
+            "source": self.source.get_stats() if self.source is not None else None,
+            "running": self.is_running(),
+        }
+
+    def take_latency_window(self) -> StageStats:
+        """Latency đầu-cuối của các frame xong từ lần gọi trước (vd: QoSController đo mỗi chu kỳ)."""
+        window, self._latency_window = self._latency_window, StageStats("end_to_end")
+        return window
+
+    def frames_in_flight(self) -> int:
+        """Số frame đã decode nhưng chưa track xong (đang nằm trong queue / đang infer)."""
+        return self.stats["decode"].count - self.stats["track"].count
+
+    def _fps(self) -> float:
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        return self.stats["track"].count / elapsed if elapsed > 0 else 0.0
+
+    # ---------- Helpers cho queue ----------
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """put có chặn (back-pressure) nhưng vẫn thoát được khi stop()."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_stage(self, target):
+        try:
+            target()
+        except Exception as e:
+            print(f"Lỗi trong pipeline ({target.__name__}): {e}")
+            self.error = e
+            self._stop.set()
+
+    # ---------- Các stage ----------
+
+    def _decode_loop(self):
+        try:
+            source_class = LiveSource if self.live else VideoSource
+            self.source = source_class(self.video_path, stream_id=self._stream, **self.source_options)
+        except (IOError, ValueError) as e:
+            print(f"Không thể mở video: {self.video_path} ({e})")
+            self._put(self._decode_q, _END)
+            return
+        # Track / đếm theo toạ độ video gốc dù frame đã thu nhỏ lúc decode
+        self.detector.frame_scale = self.source.scale
+
+        fps = self.source.fps
+        t0 = time.monotonic()
+        index = 0
+        try:
+            while not self._stop.is_set():
+                if self._demand is not None and not self._demand.acquire(timeout=0.1):
+                    continue
+                while not self._stop.is_set():
+                    try:
+                        frame = self.source.read(timeout=0.1)
+                        break
+                    except queue.Empty:
+                        continue
+                else:
+                    break
+                if frame is None:
+                    break
+                self.stats["decode"].record(self.source.last_decode_time)
+
+                if self.live_rate and not self.live:
+                    # Chỉ chờ phần còn thiếu so với thời điểm frame lẽ ra xuất hiện
+                    delay = t0 + index / fps - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                index += 1
+
+                # Camera: latency đầu-cuối tính từ lúc grab frame
+                captured_at = self.source.last_captured_at if self.live else time.monotonic()
+                if not self._put(self._decode_q, (frame, captured_at)):
+                    self.source.release(frame)
+                    break
+        finally:
+            self.source.close()
+            self._put(self._decode_q, _END)
+
+    def _infer_loop(self):
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < self.batch_size:
+                if self._demand is not None:
+                    self._demand.release()
+                item = self._get(self._decode_q)
+                if item is _END:
+                    done = True
+                    break
+                batch.append(item)
+            if batch:
+                # Chỉ keyframe mới vào YOLO, frame còn lại để tracker tự predict (results=None)
+                plan = self.detector.plan_keyframes(len(batch))
+                keys = [i for i, key in enumerate(plan) if key]
+                results = [None] * len(batch)
+                if keys:
+                    start = time.perf_counter()
+                    for i, res in zip(keys, self.detector.detect_frames([batch[i][0] for i in keys], self.infer)):
+                        results[i] = res
+                    self.stats["infer"].record(time.perf_counter() - start, len(keys))
+                for (frame, t_decoded), res in zip(batch, results):
+                    if not self._put(self._track_q, (frame, res, t_decoded)):
+                        return
+        self._put(self._track_q, _END)
+
+    def _track_loop(self):
+        while True:
+            item = self._get(self._track_q)
+            if item is _END:
+                break
+            frame, results, t_decoded = item
+            start = time.perf_counter()
+            self.detector.track_and_count(frame, results, draw=False)
+            self.stats["track"].record(time.perf_counter() - start)
+            latency = time.monotonic() - t_decoded
+            self._latency.record(latency)
+            self._latency_window.record(latency)
+            self._hist["end_to_end"].observe(latency)
+
+            if self.on_counts is not None:
+                self.on_counts(self.detector.get_current_counts())
+            if self._render_q is not None and self._should_render():
+                self._offer_render((frame, self.detector.render_state(frame.shape)))
+            else:
+                self.source.release(frame)
+        if self._render_q is not None:
+            self._put(self._render_q, _END)
+
+    def _should_render(self) -> bool:
+        if self.wants_frame is not None and not self.wants_frame():
+            return False
+        if self._render_interval:
+            now = time.monotonic()
+            if now < self._next_render:
+                return False
+            self._next_render = now + self._render_interval
+        return True
+
+    def _offer_render(self, item):
+        """Đưa frame cho render không chặn: frame cũ chưa kịp vẽ bị thay bằng frame mới."""
+        try:
+            self._render_q.put_nowait(item)
+        except queue.Full:
+            try:
+                replaced, _ = self._render_q.get_nowait()
+                self.source.release(replaced)
+                self.render_skipped += 1
+            except queue.Empty:
+                pass
+            self._render_q.put_nowait(item)  # chỉ thread track put vào queue này nên chắc chắn còn chỗ
+
+    def _render_loop(self):
+        while True:
+            item = self._get(self._render_q)
+            if item is _END:
+                break
+            frame, state = item
+            start = time.perf_counter()
+            scale = 1.0
+            if self.render_width and frame.shape[1] > self.render_width:
+                # Vẽ trên bản thu nhỏ thay vì frame gốc đủ độ phân giải
+                scale = self.render_width / frame.shape[1]
+                image = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            else:
+                image = frame.copy()
+            # Buffer decode được dùng lại ngay; frame gửi đi (broadcaster giữ lại để encode) là bản riêng
+            self.source.release(frame)
+            self.detector.draw_annotations(image, state, scale * self.detector.frame_scale)
+            self.on_frame(image)
+            elapsed = time.perf_counter() - start
+            self.stats["render"].record(elapsed)
+            self._hist["render"].observe(elapsed)
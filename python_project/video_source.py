@@ -0,0 +1,499 @@
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+DECODERS = ("auto", "opencv", "ffmpeg")
+# Nguồn trực tiếp (camera): đọc theo kiểu frame mới nhất thắng + tự kết nối lại (xem LiveSource)
+LIVE_SCHEMES = ("rtsp://", "rtsps://", "rtmp://", "http://", "https://", "udp://", "tcp://")
+
+
+class FrameRing:
+    """
+    N buffer frame cấp phát 1 lần lúc mở nguồn: acquire() lấy 1 buffer trống (chờ nếu đang dùng
+    hết - back-pressure cho decoder), release() trả lại sau khi frame đã dùng xong.
+    Không cấp phát mảng mới cho mỗi frame như cap.read().
+    """
+
+    def __init__(self, size: int, shape: Tuple[int, int, int]):
+        self.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(max(1, int(size)))]
+        self._index = {id(buf): i for i, buf in enumerate(self.buffers)}
+        self._in_use = set()
+        self._free: queue.Queue = queue.Queue()
+        for i in range(len(self.buffers)):
+            self._free.put(i)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.buffers)
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        try:
+            i = self._free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            self._in_use.add(i)
+        return self.buffers[i]
+
+    def release(self, frame: np.ndarray):
+        """Trả buffer về ring; bỏ qua nếu frame không thuộc ring hoặc đã trả rồi."""
+        i = self._index.get(id(frame))
+        with self._lock:
+            if i is None or i not in self._in_use:
+                return
+            self._in_use.discard(i)
+        self._free.put(i)
+
+    @property
+    def in_use(self) -> int:
+        return len(self._in_use)
+
+
+def probe(path: str) -> Tuple[int, int, float]:
+    """(width, height, fps) của nguồn video."""
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise IOError(f"Không thể mở video: {path}")
+        return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                cap.get(cv2.CAP_PROP_FPS) or 30.0)
+    finally:
+        cap.release()
+
+
+def is_live_source(path) -> bool:
+    """URL camera / stream (rtsp://, http://, ...) hoặc chỉ số webcam ("0", 1)."""
+    if isinstance(path, int):
+        return True
+    return str(path).isdigit() or str(path).lower().startswith(LIVE_SCHEMES)
+
+
+def output_size(src_width: int, src_height: int, width: Optional[int]) -> Tuple[int, int]:
+    """Kích thước sau khi thu nhỏ về rộng `width` (giữ tỉ lệ, chiều cao chẵn); không phóng to."""
+    if not width or width >= src_width:
+        return src_width, src_height
+    return int(width) // 2 * 2, max(2, int(round(src_height * width / src_width / 2)) * 2)
+
+
+class _OpenCVReader:
+    """
+    Đọc bằng cv2.VideoCapture thẳng vào buffer của ring (cap.read(buf) dùng lại buffer khi cùng
+    kích thước). Thu nhỏ: decode vào 1 buffer tạm dùng lại rồi cv2.resize ghi thẳng vào buffer ring.
+    Giảm FPS: frame bị bỏ chỉ grab() (không chuyển màu / copy ra numpy).
+    hwaccel=True: nhờ backend FFmpeg của OpenCV decode bằng phần cứng nếu có (VIDEO_ACCELERATION_ANY).
+    """
+
+    name = "opencv"
+
+    def __init__(self, path: str, width: Optional[int] = None, fps: Optional[float] = None, hwaccel: bool = False):
+        params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY] if hwaccel else []
+        self.cap = cv2.VideoCapture(int(path) if str(path).isdigit() else path, cv2.CAP_ANY, params)
+        if not self.cap.isOpened():
+            raise IOError(f"Không thể mở video: {path}")
+        if is_live_source(path):
+            # Bộ đệm trong của OpenCV càng nhỏ càng ít frame cũ (không phải backend nào cũng hỗ trợ)
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        src_w, src_h = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        src_fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.src_size = (src_w, src_h)
+        out_w, out_h = output_size(src_w, src_h, width)
+        self.shape = (out_h, out_w, 3)
+        self._scratch = np.empty((src_h, src_w, 3), dtype=np.uint8) if (out_w, out_h) != (src_w, src_h) else None
+        self._step = src_fps / fps if fps and fps < src_fps else 1.0
+        self.fps = src_fps / self._step
+        self._pos = 0
+        self._next_keep = 0.0
+        # Mảng cấp phát ngoài ring: buffer tạm khi thu nhỏ + mỗi lần OpenCV không ghi được vào
+        # buffer có sẵn (vd: video đổi kích thước giữa chừng)
+        self.allocations = 1 if self._scratch is not None else 0
+
+    def read_into(self, buf: np.ndarray) -> bool:
+        while self._pos < self._next_keep - 1e-6:
+            if not self.cap.grab():
+                return False
+            self._pos += 1
+        target = self._scratch if self._scratch is not None else buf
+        ok, out = self.cap.read(target)
+        if not ok:
+            return False
+        self._pos += 1
+        self._next_keep += self._step
+        if out is not target:
+            self.allocations += 1
+        if self._scratch is not None or out is not target:
+            cv2.resize(out, (buf.shape[1], buf.shape[0]), dst=buf, interpolation=cv2.INTER_AREA)
+        return True
+
+    def close(self):
+        self.cap.release()
+
+
+class _FFmpegReader:
+    """
+    Chạy `ffmpeg -vf fps=..,scale=..` và đọc frame BGR thô qua pipe thẳng vào buffer ring (readinto),
+    nên thu nhỏ + giảm FPS được làm ngay trong ffmpeg (nhiều thread, hwaccel tuỳ chọn) thay vì
+    decode đủ độ phân giải rồi mới resize trong Python.
+    """
+
+    name = "ffmpeg"
+
+    def __init__(self, path: str, width: Optional[int] = None, fps: Optional[float] = None, hwaccel: bool = False):
+        src_w, src_h, src_fps = probe(path)
+        self.src_size = (src_w, src_h)
+        out_w, out_h = output_size(src_w, src_h, width)
+        self.shape = (out_h, out_w, 3)
+        self.fps = float(fps) if fps and fps < src_fps else src_fps
+        filters = []
+        if self.fps != src_fps:
+            filters.append(f"fps={self.fps:g}")
+        if (out_w, out_h) != (src_w, src_h):
+            filters.append(f"scale={out_w}:{out_h}:flags=area")
+        cmd = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+        if str(path).lower().startswith("rtsp"):
+            cmd += ["-rtsp_transport", "tcp", "-fflags", "nobuffer", "-flags", "low_delay"]
+        if hwaccel:
+            cmd += ["-hwaccel", "auto"]
+        cmd += ["-i", path]
+        if filters:
+            cmd += ["-vf", ",".join(filters)]
+        cmd += ["-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+        self.allocations = 0
+
+    def read_into(self, buf: np.ndarray) -> bool:
+        view = memoryview(buf).cast("B")
+        got = 0
+        while got < len(view):
+            n = self.proc.stdout.readinto(view[got:])
+            if not n:
+                return False
+            got += n
+        return True
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+def open_reader(path: str, width: Optional[int] = None, fps: Optional[float] = None,
+                decoder: str = "auto", hwaccel: bool = False):
+    """
+    decoder="auto": ffmpeg (nếu có trong PATH) khi cần thu nhỏ / giảm FPS, còn lại OpenCV.
+    Lỗi ValueError nếu decoder không hợp lệ.
+    """
+    if decoder not in DECODERS:
+        raise ValueError(f"decoder phải là một trong {DECODERS}")
+    if decoder == "auto":
+        use_ffmpeg = (width or fps) and not str(path).isdigit() and shutil.which("ffmpeg")
+        decoder = "ffmpeg" if use_ffmpeg else "opencv"
+    if decoder == "ffmpeg":
+        return _FFmpegReader(path, width, fps, hwaccel)
+    return _OpenCVReader(path, width, fps, hwaccel)
+
+
+class VideoSource:
+    """
+    Nguồn video đọc trước (read-ahead) ở thread riêng vào FrameRing:
+    - read() trả về frame kế tiếp (là 1 buffer của ring) hoặc None khi hết video / lỗi;
+      người dùng phải gọi release(frame) khi không dùng frame nữa để decoder dùng lại buffer.
+    - width / fps: thu nhỏ và giảm FPS ngay lúc decode (xem open_reader); scale = tỉ lệ
+      kích thước frame trả về so với video gốc.
+    - get_stats(): thông lượng decode, số buffer, số lần cấp phát (allocations_per_frame ~ 0
+      khi buffer được dùng lại đúng cách).
+    """
+
+    def __init__(self, path: str, width: Optional[int] = None, fps: Optional[float] = None,
+                 decoder: str = "auto", hwaccel: bool = False, ring_size: int = 16, stream_id: str = "default"):
+        self.path = path
+        self.reader = open_reader(path, width, fps, decoder, hwaccel)
+        self.shape = self.reader.shape
+        self.fps = self.reader.fps
+        self.scale = self.shape[1] / self.reader.src_size[0] if self.reader.src_size[0] else 1.0
+        self.ring = FrameRing(ring_size, self.shape)
+        self.error: Optional[Exception] = None
+
+        self.frames = 0
+        self.decode_time = 0.0
+        self.last_decode_time = 0.0
+        self._started_at = time.monotonic()
+        self._ready: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._hist = metrics.histogram("vehicle_stage_seconds", stream=stream_id, stage="decode")
+        metrics.gauge("vehicle_decode_fps", "Số frame decode được mỗi giây (thread decode)",
+                      fn=self._decode_fps, stream=stream_id)
+        metrics.counter("vehicle_decode_allocations_total", "Số mảng frame cấp phát cho decode (ring + ngoài ring)",
+                        fn=self.allocations, stream=stream_id)
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def allocations(self) -> int:
+        return len(self.ring) + self.reader.allocations
+
+    def read(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """Frame kế tiếp; None khi hết video. Lỗi queue.Empty nếu quá timeout."""
+        return self._ready.get(timeout=timeout)
+
+    def release(self, frame: np.ndarray):
+        self.ring.release(frame)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def get_stats(self) -> Dict:
+        return {
+            "decoder": self.reader.name,
+            "width": self.shape[1],
+            "height": self.shape[0],
+            "fps": self.fps,
+            "frames": self.frames,
+            "decode_fps": self._decode_fps(),
+            "throughput_fps": self.frames / max(1e-9, time.monotonic() - self._started_at),
+            "buffers": len(self.ring),
+            "buffers_in_use": self.ring.in_use,
+            "ready": self._ready.qsize(),
+            "allocations": self.allocations(),
+            "allocations_per_frame": self.allocations() / self.frames if self.frames else 0.0,
+        }
+
+    def _decode_fps(self) -> float:
+        return self.frames / self.decode_time if self.decode_time > 0 else 0.0
+
+    def _read_loop(self):
+        try:
+            while not self._stop.is_set():
+                buf = self.ring.acquire(timeout=0.1)
+                if buf is None:
+                    continue  # mọi buffer đang được dùng: chờ phía sau release
+                start = time.perf_counter()
+                ok = self.reader.read_into(buf)
+                elapsed = time.perf_counter() - start
+                if not ok:
+                    self.ring.release(buf)
+                    break
+                self.frames += 1
+                self.decode_time += elapsed
+                self.last_decode_time = elapsed
+                self._hist.observe(elapsed)
+                self._ready.put(buf)
+        except Exception as e:
+            print(f"Lỗi khi đọc video {self.path}: {e}")
+            self.error = e
+        finally:
+            self.reader.close()
+            self._ready.put(None)
+
+
+class LiveSource:
+    """
+    Nguồn trực tiếp (RTSP / HTTP / webcam) theo kiểu frame mới nhất thắng: thread grabber đọc liên tục
+    (bộ đệm của camera / OpenCV không bị dồn), chỉ giữ 1 frame mới nhất; read() luôn trả frame mới nhất,
+    frame chưa kịp đọc đã bị frame mới thay được đếm vào `dropped`.
+    - Mất kết nối / hết stream: tự kết nối lại, chờ reconnect_delay rồi gấp đôi mỗi lần thất bại
+      (tối đa max_reconnect_delay), về lại reconnect_delay khi đọc được frame. max_reconnects=None: thử mãi.
+    - simulate=True (mặc định khi path là file): phát file đúng FPS như camera và phát lại từ đầu
+      khi hết file (qua đường kết nối lại), để thử nghiệm ở máy local không cần camera / RTSP server.
+    Cùng giao diện với VideoSource (read / release / close / get_stats, shape, fps, scale).
+    """
+
+    def __init__(self, path: str, width: Optional[int] = None, fps: Optional[float] = None,
+                 decoder: str = "auto", hwaccel: bool = False, ring_size: int = 4, stream_id: str = "default",
+                 simulate: Optional[bool] = None, reconnect_delay: float = 0.5, max_reconnect_delay: float = 30.0,
+                 max_reconnects: Optional[int] = None):
+        self.path = path
+        self.options = {"width": width, "fps": fps, "decoder": decoder, "hwaccel": hwaccel}
+        self.simulate = not is_live_source(path) if simulate is None else simulate
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_reconnects = max_reconnects
+        # Kết nối lần đầu lỗi thì báo ngay (sai URL...), các lần sau mới tự kết nối lại
+        self.reader = open_reader(path, **self.options)
+        self.shape = self.reader.shape
+        self.fps = self.reader.fps
+        self.scale = self.shape[1] / self.reader.src_size[0] if self.reader.src_size[0] else 1.0
+        # Ring nhỏ: 1 frame đang đọc vào + 1 frame mới nhất + các frame phía sau đang giữ
+        self.ring = FrameRing(max(3, ring_size), self.shape)
+        self._discard: Optional[np.ndarray] = None  # đọc bỏ khi phía sau giữ hết buffer
+        self._closed_allocations = 0  # cấp phát của các reader đã đóng (trước khi kết nối lại)
+        self.error: Optional[Exception] = None
+
+        self.frames = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.decode_time = 0.0
+        self.last_decode_time = 0.0
+        self.last_captured_at = 0.0  # lúc grab frame gần nhất mà read() trả ra
+        self._latest: Optional[np.ndarray] = None
+        self._latest_at = 0.0
+        self._ended = False
+        self._cond = threading.Condition()
+        self._started_at = time.monotonic()
+        self._stop = threading.Event()
+        self._hist = metrics.histogram("vehicle_stage_seconds", stream=stream_id, stage="decode")
+        metrics.gauge("vehicle_decode_fps", "Số frame decode được mỗi giây (thread decode)",
+                      fn=self._decode_fps, stream=stream_id)
+        metrics.counter("vehicle_decode_allocations_total", "Số mảng frame cấp phát cho decode (ring + ngoài ring)",
+                        fn=self.allocations, stream=stream_id)
+        metrics.counter("vehicle_dropped_frames_total", "Số frame bị bỏ (theo lý do)",
+                        fn=lambda: self.dropped, stream=stream_id, reason="stale")
+        metrics.counter("vehicle_source_reconnects_total", "Số lần kết nối lại nguồn trực tiếp",
+                        fn=lambda: self.reconnects, stream=stream_id)
+        metrics.gauge("vehicle_source_connected", "1 nếu nguồn trực tiếp đang kết nối",
+                      fn=lambda: float(self.reader is not None), stream=stream_id)
+        self._thread = threading.Thread(target=self._grab_loop, daemon=True)
+        self._thread.start()
+
+    def allocations(self) -> int:
+        reader = self.reader.allocations if self.reader is not None else 0
+        return len(self.ring) + self._closed_allocations + reader + (self._discard is not None)
+
+    def read(self, timeout: Optional[float] = None) -> Optional[np.ndarray]:
+        """Frame mới nhất (chờ nếu chưa có); None khi đã dừng. Lỗi queue.Empty nếu quá timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._latest is not None or self._ended, timeout):
+                raise queue.Empty
+            frame, self._latest = self._latest, None
+            if frame is not None:
+                self.last_captured_at = self._latest_at
+            return frame
+
+    def release(self, frame: np.ndarray):
+        self.ring.release(frame)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def get_stats(self) -> Dict:
+        return {
+            "decoder": self.reader.name if self.reader is not None else None,
+            "live": True,
+            "connected": self.reader is not None,
+            "width": self.shape[1],
+            "height": self.shape[0],
+            "fps": self.fps,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+            "decode_fps": self._decode_fps(),
+            "throughput_fps": self.frames / max(1e-9, time.monotonic() - self._started_at),
+            "buffers": len(self.ring),
+            "buffers_in_use": self.ring.in_use,
+            "allocations": self.allocations(),
+            "allocations_per_frame": self.allocations() / self.frames if self.frames else 0.0,
+        }
+
+    def _decode_fps(self) -> float:
+        return self.frames / self.decode_time if self.decode_time > 0 else 0.0
+
+    def _reconnect(self, delay: float) -> bool:
+        """Chờ delay rồi mở lại nguồn; False nếu vẫn lỗi."""
+        if self._stop.wait(delay):
+            return False
+        self.reconnects += 1
+        try:
+            reader = open_reader(self.path, **self.options)
+        except (IOError, ValueError) as e:
+            print(f"Lỗi khi kết nối lại {self.path}: {e}")
+            return False
+        if reader.shape != self.shape:
+            # Ring cấp phát theo kích thước lúc đầu, không đổi giữa chừng
+            print(f"Lỗi khi kết nối lại {self.path}: kích thước frame đổi từ {self.shape} thành {reader.shape}")
+            reader.close()
+            return False
+        self.reader = reader
+        return True
+
+    def _buffer(self) -> np.ndarray:
+        """Buffer trống để đọc frame kế tiếp: lấy từ ring, hết thì lấy lại frame mới nhất chưa ai đọc."""
+        buf = self.ring.acquire(timeout=0)
+        if buf is not None:
+            return buf
+        with self._cond:
+            if self._latest is not None:
+                buf, self._latest = self._latest, None
+                self.dropped += 1
+                return buf
+        # Phía sau đang giữ hết buffer: vẫn đọc (bỏ) để camera không bị dồn frame
+        if self._discard is None:
+            self._discard = np.empty(self.shape, dtype=np.uint8)
+        return self._discard
+
+    def _publish(self, buf: np.ndarray):
+        with self._cond:
+            if self._latest is not None:
+                self.ring.release(self._latest)
+                self.dropped += 1
+            self._latest = buf
+            self._latest_at = time.monotonic()
+            self._cond.notify_all()
+
+    def _grab_loop(self):
+        delay = self.reconnect_delay
+        failures = 0
+        t0, index = time.monotonic(), 0
+        try:
+            while not self._stop.is_set():
+                if self.reader is None:
+                    if self.max_reconnects is not None and failures >= self.max_reconnects:
+                        print(f"Lỗi: mất kết nối {self.path}, đã thử kết nối lại {failures} lần, dừng đọc")
+                        break
+                    failures += 1
+                    if not self._reconnect(delay):
+                        delay = min(delay * 2, self.max_reconnect_delay)
+                        continue
+                    t0, index = time.monotonic(), 0
+
+                buf = self._buffer()
+                start = time.perf_counter()
+                try:
+                    ok = self.reader.read_into(buf)
+                except Exception as e:
+                    print(f"Lỗi khi đọc video {self.path}: {e}")
+                    ok = False
+                elapsed = time.perf_counter() - start
+                if not ok:
+                    if buf is not self._discard:
+                        self.ring.release(buf)
+                    print(f"Mất kết nối / hết stream {self.path}, đang kết nối lại")
+                    reader, self.reader = self.reader, None
+                    reader.close()
+                    self._closed_allocations += reader.allocations
+                    continue
+                delay, failures = self.reconnect_delay, 0
+                self.frames += 1
+                self.decode_time += elapsed
+                self.last_decode_time = elapsed
+                self._hist.observe(elapsed)
+
+                if self.simulate:
+                    # Phát file như camera: frame chỉ "xuất hiện" đúng thời điểm theo FPS
+                    index += 1
+                    wait = t0 + index / self.fps - time.monotonic()
+                    if wait > 0 and self._stop.wait(wait):
+                        if buf is not self._discard:
+                            self.ring.release(buf)
+                        break
+                if buf is self._discard:
+                    self.dropped += 1
+                else:
+                    self._publish(buf)
+        except Exception as e:
+            print(f"Lỗi khi đọc video {self.path}: {e}")
+            self.error = e
+        finally:
+            if self.reader is not None:
+                self.reader.close()
+            with self._cond:
+                self._ended = True
+                self._cond.notify_all()